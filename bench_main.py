@@ -0,0 +1,403 @@
+"""Benchmark the ingestion and query paths of the Flask application.
+
+Run with the App Engine SDK on the Python path, for example:
+
+    python bench_main.py --documents 15000 --requests 2000 --concurrency 16
+
+Every benchmark runs against the local in-memory search backend, wrapped
+in a stand-in for the Search API with configurable injected latency and
+error rates. The results are printed as JSON so that they can be compared
+across runs.
+"""
+
+import argparse
+import base64
+import collections
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+from google.appengine.api import memcache
+from google.appengine.ext import testbed
+from google.appengine.runtime import apiproxy_errors
+
+import main
+
+main._USERNAME = 'username'
+main._PASSWORD = 'password'
+main._BACKEND = 'local'
+
+WORDS = ['cat', 'dog', 'lasagna', 'robotic', 'future', 'fancy', 'alley',
+         'mondays', 'happy', 'content', 'product', 'loves', 'hates']
+"""List of words to build documents and queries from."""
+
+class DelayedFuture(object):
+
+    """Future that completes latency seconds after it was created.
+
+    It raises error from get_result if error is not None.
+    """
+
+    def __init__(self, future, latency, error=None):
+        self._future = future
+        self._ready = time.time() + latency
+        self._error = error
+
+    def get_result(self):
+        delay = self._ready - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if self._error is not None:
+            raise self._error
+        return self._future.get_result()
+
+class FaultyIndex(main._LocalIndex):
+
+    """Local index that stands in for the Search API service.
+
+    Every call takes latency seconds and raises DeadlineExceededError with
+    probability error_rate.
+    """
+
+    def __init__(self, name, latency=0, error_rate=0):
+        super(FaultyIndex, self).__init__(name)
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(0)
+
+    def _delay(self, future):
+        error = None
+        if self._random.random() < self.error_rate:
+            error = apiproxy_errors.DeadlineExceededError()
+        return DelayedFuture(future, self.latency, error)
+
+    def put_async(self, documents):
+        return self._delay(super(FaultyIndex, self).put_async(documents))
+
+    def delete_async(self, document_ids):
+        return self._delay(
+            super(FaultyIndex, self).delete_async(document_ids))
+
+    def search_async(self, query):
+        return self._delay(super(FaultyIndex, self).search_async(query))
+
+def make_data(count, seed=0):
+    """Return a dictionary of count document identifiers to random text."""
+    generator = random.Random(seed)
+    return dict(
+        ('doc{0:06d}'.format(i), u' '.join(generator.sample(WORDS, 5)))
+        for i in xrange(0, count))
+
+def percentile(values, fraction):
+    """Return the nearest-rank fraction percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def summarize(latencies, elapsed):
+    """Return a dictionary of throughput and latency percentiles."""
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed > 0 else None,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99)
+    }
+
+def peak_memory():
+    """Return the peak resident set size of the process in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset():
+    """Reset the state the application shares between requests."""
+    main._search_cache.clear()
+    memcache.flush_all()
+    main._tenants.clear()
+    main._write_budget.reset()
+    for sizer in main._batch_sizers.itervalues():
+        sizer.reset()
+    for breaker in main._breakers.itervalues():
+        breaker.reset()
+    main._local_indexes.clear()
+    main._prefix_indexes.clear()
+
+def microbenchmark(function, repeat):
+    """Return the best of repeat runs of function in seconds."""
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def bench_is_valid_doc_id(data, repeat):
+    """Benchmark validating the document identifiers of data."""
+    ids = [k.encode('ascii') for k in data]
+    seconds = microbenchmark(
+        lambda: [main._is_valid_doc_id(doc_id) for doc_id in ids], repeat)
+    return {'items': len(ids), 'seconds': seconds}
+
+def legacy_is_valid_doc_id(doc_id):
+    """Return whether doc_id is valid checking it character by character.
+
+    This is how main._is_valid_doc_id validated identifiers before they
+    were matched against a precompiled pattern.
+    """
+    if isinstance(doc_id, str):
+        length = len(doc_id)
+        if (length <= 0) or (main.search.MAXIMUM_DOCUMENT_ID_LENGTH < length):
+            return False
+        if doc_id.startswith('!'):
+            return False
+        if doc_id.startswith('__') and doc_id.endswith('__'):
+            return False
+        for c in doc_id:
+            if c not in main._VISIBLE_PRINTABLE_ASCII:
+                return False
+        return True
+    return False
+
+def bench_validate(data, repeat, length=200):
+    """Benchmark validating identifiers of length characters in bulk.
+
+    The identifiers of data are padded to length characters and a tenth
+    of them made invalid, then validated like delete_view did before and
+    does now.
+    """
+    values = [(k + '-' * length)[:length] for k in data]
+    for i in xrange(0, len(values), 10):
+        values[i] = values[i][:-1] + ' '
+
+    def legacy():
+        ids = []
+        for value in values:
+            try:
+                doc_id = value.encode('ascii')
+            except UnicodeEncodeError:
+                continue
+            if legacy_is_valid_doc_id(doc_id):
+                ids.append(doc_id)
+        return ids
+    legacy_seconds = microbenchmark(legacy, repeat)
+    seconds = microbenchmark(
+        lambda: main._validate_doc_ids(values, collections.Counter()),
+        repeat)
+    return {'items': len(values), 'legacy_seconds': legacy_seconds,
+            'seconds': seconds, 'speedup': legacy_seconds / seconds}
+
+def bench_make_documents(data, repeat):
+    """Benchmark building the documents of data like put_view."""
+    seconds = microbenchmark(
+        lambda: main._make_documents(data.iteritems(), collections.Counter()),
+        repeat)
+    return {'items': len(data), 'seconds': seconds}
+
+def bench_put(data, repeat, latency, error_rate):
+    """Benchmark putting the documents of data in batches."""
+    documents = [main._make_document(k, v) for k, v in data.iteritems()]
+    results = []
+    for _ in xrange(0, repeat):
+        reset()
+        index = FaultyIndex('bench', latency, error_rate)
+        start = time.time()
+        summary = main._put(index, documents)
+        results.append(time.time() - start)
+    return {
+        'batches': len(summary),
+        'items': len(documents),
+        'retries': sum(entry['attempts'] - 1 for entry in summary),
+        'seconds': min(results)
+    }
+
+def bench_suggest(data, repeat):
+    """Benchmark answering prefix queries from the prefix index of data."""
+    prefix_index = main._PrefixIndex()
+    prefix_index.update(
+        [main._make_document(k, v) for k, v in data.iteritems()])
+    prefixes = [word[:length] for word in WORDS
+                for length in xrange(1, len(word) + 1)]
+
+    def suggest():
+        # Clear the top documents to time computing them
+        prefix_index._top.clear()
+        for prefix in prefixes:
+            prefix_index.suggest(prefix)
+    seconds = microbenchmark(suggest, repeat)
+    return {'items': len(prefixes), 'seconds': seconds,
+            'seconds_per_item': seconds / len(prefixes)}
+
+COLD_START_SCRIPT = """
+import base64, json, sys, time
+start = time.time()
+import main
+loaded = time.time() - start
+client = main.app.test_client()
+warmup = None
+if sys.argv[1] == 'warm':
+    start = time.time()
+    client.get('/_ah/warmup')
+    warmup = time.time() - start
+headers = {'Authorization': 'Basic ' + base64.b64encode('username:password')}
+start = time.time()
+client.get('/', query_string={'q': 'cat'}, headers=headers)
+print json.dumps({'first_request': time.time() - start, 'load': loaded,
+                  'report': main._startup.report(), 'warmup': warmup})
+"""
+"""String Python script measuring a cold start of the application."""
+
+def bench_cold_start(repeat):
+    """Benchmark loading the application and serving its first request.
+
+    Every run starts a new interpreter, once serving the first request cold
+    and once after the warmup request.
+    """
+    environment = dict(os.environ, BASIC_AUTH_USERNAME='username',
+                       BASIC_AUTH_PASSWORD='password', SEARCH_BACKEND='local',
+                       PYTHONPATH=os.pathsep.join(sys.path))
+    result = {}
+    for mode in ['cold', 'warm']:
+        runs = [json.loads(subprocess.check_output(
+            [sys.executable, '-c', COLD_START_SCRIPT, mode],
+            env=environment).splitlines()[-1]) for _ in xrange(0, repeat)]
+        result[mode] = {
+            'first_request': min(run['first_request'] for run in runs),
+            'imports': min(run['report']['imports'] for run in runs),
+            'initialization': min(run['report']['initialization']
+                                  for run in runs),
+            'load': min(run['load'] for run in runs)
+        }
+        if mode == 'warm':
+            result[mode]['warmup'] = min(run['warmup'] for run in runs)
+    return result
+
+def load(app, requests, concurrency, make_request):
+    """Drive requests requests against app from concurrency threads.
+
+    Args:
+        app: WSGI application.
+        requests: Integer total number of requests to make.
+        concurrency: Integer number of threads making requests.
+        make_request: Function that takes a werkzeug test client and an
+            integer request number, makes the request and returns the
+            response.
+    Returns:
+        Dictionary of throughput, latency percentiles and status counts.
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    counter = iter(xrange(0, requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                return
+            start = time.time()
+            response = make_request(client, number)
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                statuses[response.status_code] = statuses.get(
+                    response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker)
+               for _ in xrange(0, concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, time.time() - start)
+    result['statuses'] = dict((str(k), v) for k, v in statuses.iteritems())
+    return result
+
+def bench_load(data, requests, concurrency, latency, error_rate):
+    """Load test putting data then searching it through the WSGI app."""
+    reset()
+    index = FaultyIndex(main._USERNAME, latency, error_rate)
+    main._local_indexes[main._USERNAME] = index
+    headers = {'Authorization': 'Basic ' + base64.b64encode(
+        '{0}:{1}'.format(main._USERNAME, main._PASSWORD))}
+    items = data.items()
+    # Split the documents in one put request per thread
+    chunk = max(-(-len(items) // concurrency), 1)
+
+    def put(client, number):
+        body = json.dumps(dict(items[number * chunk:(number + 1) * chunk]))
+        return client.put('/', data=body, headers=headers,
+                          content_type='application/json')
+
+    put_result = load(main.app, min(concurrency, len(items)), concurrency, put)
+    put_result['documents'] = len(index)
+
+    generator = random.Random(1)
+    queries = [' '.join(generator.sample(WORDS, generator.randint(1, 2)))
+               for _ in xrange(0, 200)]
+
+    def get(client, number):
+        return client.get('/', query_string={'q': queries[number % 200]},
+                          headers=headers)
+
+    get_result = load(main.app, requests, concurrency, get)
+    get_result['cache_hits'] = main._search_cache.hits
+    get_result['cache_misses'] = main._search_cache.misses
+    return {'get': get_result, 'put': put_result}
+
+def main_function(argv):
+    """Run the benchmarks and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--documents', type=int, default=main._SAFETY_LIMIT,
+                        help='number of documents to put')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs of each microbenchmark')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='number of search requests in the load test')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='number of threads in the load test')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds each Search API call takes')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='probability of a Search API call failing')
+    parser.add_argument('--output', default='-',
+                        help='file to write the JSON results to')
+    args = parser.parse_args(argv)
+
+    # The digests of the documents put are kept in memcache
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+
+    data = make_data(args.documents)
+    results = {
+        'arguments': vars(args),
+        'microbenchmarks': {
+            'is_valid_doc_id': bench_is_valid_doc_id(data, args.repeat),
+            'make_documents': bench_make_documents(data, args.repeat),
+            'validate': bench_validate(data, args.repeat),
+            'suggest': bench_suggest(data, args.repeat),
+            'cold_start': bench_cold_start(args.repeat),
+            'put': bench_put(data, args.repeat, args.latency,
+                             args.error_rate)
+        },
+        'load': bench_load(data, args.requests, args.concurrency,
+                           args.latency, args.error_rate)
+    }
+    results['peak_memory_kb'] = peak_memory()
+    bed.deactivate()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print output
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main_function(sys.argv[1:])
@@ -1,16 +1,47 @@
 """A Flask application wrapper around the App Engine Search API."""
 
+import array
+import base64
+import bisect
+import cgi
+import collections
+import cProfile
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
 import logging
+import marshal
+import math
 import os
+import random
 import re
 import string
+import threading
+import time
+import uuid
+import zlib
 
+# Importing the App Engine and Flask packages dominates the cold start
+_IMPORT_START = time.time()
+"""Float time at which importing the third party packages started."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.runtime import apiproxy_errors
 
 import flask
 import werkzeug.exceptions
 
+_IMPORT_SECONDS = time.time() - _IMPORT_START
+"""Float number of seconds importing the third party packages took."""
+
 # This is also used as the name of the search index
 _USERNAME = os.environ.get('BASIC_AUTH_USERNAME')
 """String expected HTTP basic authentication username."""
@@ -18,250 +49,4078 @@ _USERNAME = os.environ.get('BASIC_AUTH_USERNAME')
 _PASSWORD = os.environ.get('BASIC_AUTH_PASSWORD')
 """String expected HTTP basic authentication password."""
 
-### Search API wrapper
+# JSON object mapping usernames to objects with their 'password' and
+# optionally their 'index' name, which defaults to the username, and their
+# write budget 'limit'. Replaces BASIC_AUTH_USERNAME and BASIC_AUTH_PASSWORD
+_TENANTS = os.environ.get('BASIC_AUTH_TENANTS')
+"""String JSON configuration of the tenants or None."""
+
+# Either 'search' for the App Engine Search API or 'local' for the
+# in-memory inverted index
+_BACKEND = os.environ.get('SEARCH_BACKEND', 'search')
+"""String name of the search backend to use."""
+
+# JSON array of search queries to prime the search result cache with when
+# a new instance is warmed up
+_WARMUP_QUERIES = os.environ.get('SEARCH_WARMUP_QUERIES')
+"""String JSON array of the queries to prime the cache with or None."""
+
+# Fraction of the authenticated requests to profile, 0 to only profile
+# the requests with the _PROFILE_HEADER header
+_PROFILE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+"""Float probability of profiling an authenticated request."""
+
+_SHARDS = int(os.environ.get('SEARCH_SHARDS', 1))
+"""Integer number of shard indexes to spread the documents over."""
+
+# Set while resharding to the number of shards documents are moved from
+_PREVIOUS_SHARDS = int(os.environ.get('SEARCH_PREVIOUS_SHARDS', 0))
+"""Integer number of shard indexes documents are being moved from."""
+
+### Search API wrapper
+
+_BATCH_SIZE = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+"""Integer maximum number of documents the index can handle per request."""
+
+# Search API imposes this limit to ensure the reliability of the service
+_SAFETY_LIMIT = 15000
+"""Integer maximum number of documents that can be put/deleted per minute."""
+
+_VISIBLE_PRINTABLE_ASCII = frozenset(
+    set(string.printable) - set(string.whitespace))
+"""frozenset of valid ASCII characters for the document identifier."""
+
+# Field names are case sensitive and can only contain ASCII characters.
+# They must start with a letter and can contain letters, digits, or
+# underscores. A field name cannot be longer than 500 characters.
+_FIELD_NAME = 't'
+"""String default field name for the text in a document."""
+
+_BUDGET_WINDOW = 60
+"""Integer number of seconds over which the write budget is metered."""
+
+_BUDGET_TIMEOUT = 30
+"""Integer maximum number of seconds a request waits for write budget."""
+
+class _BudgetExceededError(Exception):
+
+    """Raised when write budget is not available in time for all documents.
+
+    Attributes:
+        deferred: List of the string identifiers of the documents that were
+            not put/deleted.
+        retry_after: Integer number of seconds until the budget for the
+            deferred documents becomes available.
+        summary: List of dictionaries summarizing the calls made before
+            the budget ran out, as returned by _dispatch.
+    """
+
+    def __init__(self, deferred, retry_after, summary=None):
+        super(_BudgetExceededError, self).__init__(
+            '{0} documents exceed the write budget.'.format(len(deferred)))
+        self.deferred = deferred
+        self.retry_after = retry_after
+        self.summary = [] if summary is None else summary
+
+class _WriteBudget(object):
+
+    """Sliding window budget of documents put/deleted per minute.
+
+    The budget is shared by every request on the instance so that
+    concurrent requests together stay under the Search API safety limit.
+    Requests reserve budget before making a put/delete call and wait for
+    older reservations to leave the window if there is not enough left.
+    A budget with a shared budget, like the budget of a tenant, reserves
+    the documents from both, so that all of them together stay under the
+    limit of the shared budget too.
+    """
+
+    def __init__(self, limit=_SAFETY_LIMIT, window=_BUDGET_WINDOW,
+                 shared=None):
+        """Initialize an unused budget.
+
+        Args:
+            limit: Optional integer maximum number of documents per window.
+            window: Optional number of seconds in the sliding window.
+            shared: Optional _WriteBudget to reserve the documents from as
+                well.
+        """
+        self.limit = limit
+        self.window = window
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._reservations = collections.deque()
+        self._used = 0
+
+    def _expire(self, now):
+        """Drop the reservations that left the window before now."""
+        while self._reservations and (
+            self._reservations[0][0] + self.window <= now):
+            self._used -= self._reservations.popleft()[1]
+
+    def _wait_time(self, count, now):
+        """Return the number of seconds until count documents are free."""
+        needed = self._used + count - self.limit
+        for timestamp, reserved in self._reservations:
+            needed -= reserved
+            if needed <= 0:
+                return max(timestamp + self.window - now, 0)
+        return self.window
+
+    def reset(self):
+        """Forget every reservation."""
+        with self._lock:
+            self._reservations.clear()
+            self._used = 0
+
+    def usage(self):
+        """Return a dictionary describing the current budget usage."""
+        with self._lock:
+            self._expire(time.time())
+            return {
+                'limit': self.limit,
+                'remaining': self.limit - self._used,
+                'used': self._used,
+                'window': self.window
+            }
+
+    def retry_after(self, count):
+        """Return the integer number of seconds until count is available."""
+        shared = 0 if self.shared is None else self.shared.retry_after(count)
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            if self._used + count <= self.limit:
+                return shared
+            return max(int(math.ceil(self._wait_time(count, now))), shared)
+
+    def acquire(self, count, timeout=0):
+        """Reserve budget for count documents.
+
+        Args:
+            count: Integer number of documents to put/delete.
+            timeout: Optional maximum number of seconds to wait for the
+                budget to become available. Defaults to not waiting.
+        Returns:
+            True if the budget was reserved. False otherwise.
+        Raises:
+            ValueError if count is larger than the budget limit.
+        """
+        if count > self.limit:
+            raise ValueError('count exceeds the write budget limit.')
+        deadline = time.time() + timeout
+        while True:
+            with self._lock:
+                now = time.time()
+                self._expire(now)
+                if self._used + count <= self.limit:
+                    if (self.shared is None) or self.shared.acquire(count):
+                        self._reservations.append((now, count))
+                        self._used += count
+                        return True
+                    wait = self.shared.retry_after(count)
+                else:
+                    wait = self._wait_time(count, now)
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+_write_budget = _WriteBudget()
+"""_WriteBudget of documents put/deleted shared by all requests."""
+
+_MAX_IN_FLIGHT = 10
+"""Integer maximum number of put/delete calls in flight per request."""
+
+_MAX_RETRIES = 3
+"""Integer maximum number of retries of a batch that exceeded a deadline."""
+
+_RETRY_DELAY = 0.5
+"""Float number of seconds to wait before the first retry of a batch."""
+
+_MIN_BATCH_SIZE = 10
+"""Integer minimum number of documents in an adaptively sized batch."""
+
+_TARGET_LATENCY = 2
+"""Integer number of seconds above which a call is considered slow."""
+
+class _BatchSizer(object):
+
+    """Adapt the put/delete batch size to the observed latency and errors.
+
+    The size grows additively after fast successful calls and is halved
+    after slow calls or calls that exceeded their deadline. It stays
+    between _MIN_BATCH_SIZE and _BATCH_SIZE.
+    """
+
+    def __init__(self, minimum=_MIN_BATCH_SIZE, maximum=_BATCH_SIZE,
+                 target=_TARGET_LATENCY):
+        """Initialize the batch size to maximum.
+
+        Args:
+            minimum: Optional integer minimum batch size.
+            maximum: Optional integer maximum batch size.
+            target: Optional number of seconds above which a call is slow.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.size = maximum
+        """Integer number of documents in the next batch."""
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Reset the batch size to the maximum."""
+        with self._lock:
+            self.size = self.maximum
+
+    def failure(self):
+        """Halve the batch size after a call exceeded its deadline."""
+        with self._lock:
+            self.size = max(self.size // 2, self.minimum)
+
+    def success(self, latency):
+        """Adapt the batch size after a successful call.
+
+        Args:
+            latency: Number of seconds the call took.
+        """
+        if latency > self.target:
+            self.failure()
+            return
+        with self._lock:
+            self.size = min(self.size + self.minimum, self.maximum)
+
+_batch_sizers = {
+    'delete': _BatchSizer(),
+    'put': _BatchSizer()
+}
+"""Dictionary of _BatchSizer per Search API write operation."""
+
+_BREAKER_THRESHOLD = 5
+"""Integer minimum number of overload errors that open a breaker."""
+
+_BREAKER_WINDOW = 20
+"""Integer number of the latest calls whose errors can open a breaker."""
+
+_BREAKER_ERROR_RATE = 0.5
+"""Float fraction of the calls in the window failing that opens a breaker."""
+
+_BREAKER_COOLDOWN = 30
+"""Integer number of seconds a breaker stays open before a probe call."""
+
+_OVERLOAD_ERRORS = (apiproxy_errors.DeadlineExceededError,
+                    apiproxy_errors.OverQuotaError)
+"""Tuple of the exception types of Search API calls that are overloaded."""
+
+class _CircuitOpenError(_BudgetExceededError):
+
+    """Raised when calls are shed because a circuit breaker is open.
+
+    It is a _BudgetExceededError so that the shed writes are deferred and
+    answered like writes over the write budget.
+    """
+
+    def __init__(self, deferred, retry_after, summary=None):
+        Exception.__init__(
+            self, '{0} documents were shed by the circuit breaker.'.format(
+                len(deferred)))
+        self.deferred = deferred
+        self.retry_after = retry_after
+        self.summary = [] if summary is None else summary
+
+class _CircuitBreaker(object):
+
+    """Circuit breaker of the calls of a Search API operation.
+
+    The breaker is closed and lets every call through until at least
+    threshold of the latest window calls, and error_rate of them, failed
+    with an overload error. It then opens and sheds every call for cooldown
+    seconds, after which it is half-open and lets a single probe call
+    through. Only the probe moves the breaker out of half-open: it closes
+    again if the probe succeeds and opens again if it fails. The outcomes
+    of the calls started before the probe, such as the calls in flight when
+    the breaker opened, are ignored. A probe that never completes is
+    replaced after another cooldown.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, operation, threshold=_BREAKER_THRESHOLD,
+                 cooldown=_BREAKER_COOLDOWN, window=_BREAKER_WINDOW,
+                 error_rate=_BREAKER_ERROR_RATE):
+        """Initialize a closed breaker.
+
+        Args:
+            operation: String name of the Search API operation.
+            threshold: Optional integer minimum number of overload errors
+                in the window that open the breaker.
+            cooldown: Optional integer number of seconds the breaker stays
+                open before a probe call.
+            window: Optional integer number of the latest calls whose
+                errors are counted.
+            error_rate: Optional float fraction of the calls in the window
+                failing with an overload error that opens the breaker.
+        """
+        self.operation = operation
+        self._threshold = threshold
+        self._cooldown = cooldown
+        self._error_rate = error_rate
+        self._outcomes = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Close the breaker and forget the errors."""
+        self.state = self.CLOSED
+        """String state of the breaker."""
+        self._outcomes.clear()
+        self._opened = 0
+        self._probe = None
+
+    def _transition(self, state):
+        """Change the state of the breaker with the lock held."""
+        if state == self.OPEN:
+            self._opened = time.time()
+            self._probe = None
+            logging.error('Shedding Search API {0} calls.'.format(
+                self.operation))
+        elif state == self.CLOSED:
+            self._outcomes.clear()
+            self._probe = None
+        self.state = state
+        _metrics.increment('circuit_breaker_transitions_total', {
+            'operation': self.operation, 'state': state})
+
+    def allow(self):
+        """Return True if a call may be made now.
+
+        A True result while the breaker is half-open makes the call the
+        probe.
+        """
+        with self._lock:
+            now = time.time()
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if now < self._opened + self._cooldown:
+                    return False
+                self._transition(self.HALF_OPEN)
+            if (self._probe is None) or (now >= self._probe + self._cooldown):
+                self._probe = now
+                return True
+            return False
+
+    def shedding(self):
+        """Return True if the breaker is open and not ready for a probe."""
+        with self._lock:
+            return (self.state == self.OPEN) and (
+                time.time() < self._opened + self._cooldown)
+
+    def retry_after(self):
+        """Return the integer number of seconds until the next probe."""
+        with self._lock:
+            start = self._opened
+            if self.state == self.HALF_OPEN:
+                start = self._probe or 0
+            return max(int(math.ceil(start + self._cooldown - time.time())),
+                       1)
+
+    def record(self, error=None, start=None):
+        """Record the outcome of a call.
+
+        Outcomes are ignored while the breaker is open, and while it is
+        half-open unless they are the outcome of the probe.
+
+        Args:
+            error: Optional exception the call raised. Only overload errors
+                count as failures since other errors are answers of the
+                Search API.
+            start: Optional float time at which the call started. Defaults
+                to now.
+        """
+        failure = isinstance(error, _OVERLOAD_ERRORS)
+        with self._lock:
+            if self.state == self.CLOSED:
+                self._outcomes.append(failure)
+                failures = sum(self._outcomes)
+                if ((failures >= self._threshold) and
+                    (failures >= self._error_rate * len(self._outcomes))):
+                    self._transition(self.OPEN)
+            elif ((self.state == self.HALF_OPEN) and
+                  (self._probe is not None) and
+                  ((start is None) or (start >= self._probe))):
+                self._transition(self.OPEN if failure else self.CLOSED)
+
+_breakers = {
+    'delete': _CircuitBreaker('delete'),
+    'put': _CircuitBreaker('put'),
+    'search': _CircuitBreaker('search')
+}
+"""Dictionary of _CircuitBreaker per Search API operation."""
+
+def _shed_retry_after(operation):
+    """Return seconds to retry after if a call of operation must be shed.
+
+    Writes are shed first: they are shed while any breaker is shedding,
+    whereas searches are only shed while the search breaker is.
+
+    Args:
+        operation: String name of the Search API operation.
+    Returns:
+        Integer number of seconds after which to retry the call or None if
+        the call may be made now.
+    """
+    if operation != 'search':
+        for breaker in _breakers.itervalues():
+            if (breaker.operation != operation) and breaker.shedding():
+                return breaker.retry_after()
+    breaker = _breakers[operation]
+    if breaker.allow():
+        return None
+    return breaker.retry_after()
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""Tuple of upper bounds in seconds of the latency histogram buckets."""
+
+_SIZE_BUCKETS = (1, 10, 25, 50, 100, 200)
+"""Tuple of upper bounds of the batch size histogram buckets."""
+
+_METRICS_PREFIX = 'recap_'
+"""String prefix of the names of the exported metrics."""
+
+class _Metrics(object):
+
+    """Thread safe registry of counters and histograms.
+
+    Metrics are identified by their name and a dictionary of labels and
+    rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def clear(self):
+        """Drop every metric."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def increment(self, name, labels=None, value=1):
+        """Add value to the counter name with labels.
+
+        Args:
+            name: String name of the counter.
+            labels: Optional dictionary of string label names to values.
+            value: Optional number to add. Defaults to 1.
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, buckets=_LATENCY_BUCKETS):
+        """Record value in the histogram name with labels.
+
+        Args:
+            name: String name of the histogram.
+            value: Number to record.
+            labels: Optional dictionary of string label names to values.
+            buckets: Optional tuple of increasing bucket upper bounds.
+                Defaults to _LATENCY_BUCKETS.
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    buckets, [0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def get(self, name, labels=None):
+        """Return the value of the counter name with labels or 0."""
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def render(self, gauges=None, tenant=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        Args:
+            gauges: Optional dictionary mapping string names to the current
+                values of gauges to render with the metrics.
+            tenant: Optional string name of the tenant to render the
+                metrics for. Metrics labeled with another tenant are left
+                out. Defaults to rendering every metric.
+        Returns:
+            String of the metrics, one sample per line.
+        """
+        def labels_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(k, v)
+                                  for k, v in labels) + '}'
+
+        def visible(item):
+            labels = dict(item[0][1])
+            return (tenant is None) or (
+                labels.get('tenant', tenant) == tenant)
+
+        lines = []
+        with self._lock:
+            counters = sorted(filter(visible, self._counters.items()))
+            histograms = sorted(filter(visible, self._histograms.items()))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append('# TYPE {0}{1} gauge'.format(_METRICS_PREFIX, name))
+            lines.append('{0}{1} {2}'.format(_METRICS_PREFIX, name, value))
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0}{1} counter'.format(
+                    _METRICS_PREFIX, name))
+            lines.append('{0}{1}{2} {3}'.format(
+                _METRICS_PREFIX, name, labels_text(labels), value))
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0}{1} histogram'.format(
+                    _METRICS_PREFIX, name))
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append('{0}{1}_bucket{2} {3}'.format(
+                    _METRICS_PREFIX, name,
+                    labels_text(labels, [('le', bound)]), cumulative))
+            lines.append('{0}{1}_bucket{2} {3}'.format(
+                _METRICS_PREFIX, name, labels_text(labels, [('le', '+Inf')]),
+                count))
+            lines.append('{0}{1}_sum{2} {3}'.format(
+                _METRICS_PREFIX, name, labels_text(labels), total))
+            lines.append('{0}{1}_count{2} {3}'.format(
+                _METRICS_PREFIX, name, labels_text(labels), count))
+        return '\n'.join(lines) + '\n'
+
+_metrics = _Metrics()
+"""_Metrics of the Search API calls and requests of this instance."""
+
+def _record_timing(stage, start, end=None):
+    """Record that the current request spent the start to end in stage.
+
+    The wall-clock times of the stages are sent in the Server-Timing header
+    of the response, so concurrent calls of a stage count once. Calls
+    outside of a request are ignored.
+
+    Args:
+        stage: String name of the stage.
+        start: Float time at which the stage started.
+        end: Optional float time at which the stage ended. Defaults to now.
+    """
+    if flask.has_request_context():
+        timings = flask.g.setdefault('timings', collections.OrderedDict())
+        timings.setdefault(stage, []).append(
+            (start, time.time() if end is None else end))
+
+def _covered_seconds(intervals):
+    """Return the number of seconds covered by any of intervals.
+
+    Args:
+        intervals: Iterable of (start, end) tuples of float times.
+    Returns:
+        Float number of seconds in the union of intervals.
+    """
+    seconds = 0
+    until = float('-inf')
+    for start, end in sorted(intervals):
+        if end > until:
+            seconds += end - max(start, until)
+            until = end
+    return seconds
+
+def _record_call(operation, size, start, error=None):
+    """Record a Search API call that just completed in the metrics.
+
+    Args:
+        operation: String name of the Search API operation.
+        size: Integer number of documents or queries in the call.
+        start: Float time at which the call started.
+        error: Optional exception the call raised.
+    """
+    end = time.time()
+    seconds = end - start
+    labels = {'operation': operation}
+    _metrics.increment('search_api_calls_total', labels)
+    if operation in _breakers:
+        _breakers[operation].record(error, start)
+    _metrics.observe('search_api_batch_size', size, labels, _SIZE_BUCKETS)
+    _metrics.observe('search_api_latency_seconds', seconds, labels)
+    if error is not None:
+        _metrics.increment('search_api_errors_total', {
+            'error': type(error).__name__, 'operation': operation})
+    elif operation in ('delete', 'put'):
+        _metrics.increment('documents_total', labels, size)
+    _record_timing(operation, start, end)
+
+def _record_tenant_documents(tenant, operation, size):
+    """Record size documents put/deleted for tenant in the metrics.
+
+    Args:
+        tenant: _Tenant object that wrote the documents or None.
+        operation: String name of the Search API operation ('put' or
+            'delete').
+        size: Integer number of documents written.
+    """
+    if tenant is not None:
+        _metrics.increment('tenant_documents_total', {
+            'operation': operation, 'tenant': tenant.name}, size)
+
+_CACHE_SIZE = 1000
+"""Integer maximum number of search results to keep in the cache."""
+
+_CACHE_TTL = 60
+"""Integer number of seconds a cached search result remains fresh."""
+
+class _SearchCache(object):
+
+    """Bounded LRU cache of search results with a time to live.
+
+    Results are keyed on the index name and the normalized search query.
+    Every index has a write generation that is bumped whenever documents
+    are put in or deleted from it. Results cached under an older
+    generation are never returned, so a cached result cannot outlive a
+    write made by this instance.
+    """
+
+    def __init__(self, size=_CACHE_SIZE, ttl=_CACHE_TTL):
+        """Initialize an empty cache.
+
+        Args:
+            size: Optional integer maximum number of cached results.
+            ttl: Optional number of seconds a cached result remains fresh.
+        """
+        self._size = size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self.hits = 0
+        """Integer number of lookups answered from the cache."""
+        self.misses = 0
+        """Integer number of lookups not answered from the cache."""
+        self.evictions = 0
+        """Integer number of results dropped to stay within size."""
+        self.stale_hits = 0
+        """Integer number of stale results served while shedding searches."""
+
+    def clear(self):
+        """Drop every cached result and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.stale_hits = 0
+
+    def generation(self, index_name):
+        """Return the integer write generation of the index index_name."""
+        with self._lock:
+            return self._generations.get(index_name, 0)
+
+    def invalidate(self, index_name):
+        """Bump the write generation of the index index_name.
+
+        Args:
+            index_name: String name of the index that was written to.
+        """
+        with self._lock:
+            self._generations[index_name] = (
+                self._generations.get(index_name, 0) + 1)
+
+    def get(self, index_name, query, stale=False):
+        """Return the cached result for query or None.
+
+        Stale results are kept until they are replaced or evicted, so that
+        they can be served while the Search API is unavailable.
+
+        Args:
+            index_name: String name of the searched index.
+            query: String normalized search query.
+            stale: Optional boolean to return the result even if it expired
+                or was cached in an older generation.
+        Returns:
+            List of string document identifiers if a fresh result, or any
+            result if stale, is cached for query. None otherwise.
+        """
+        key = (index_name, query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                generation, expires, result = entry
+                if stale or (
+                    (generation == self._generations.get(index_name, 0)) and
+                    (time.time() < expires)):
+                    # Move the entry to the most recently used end
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    if stale:
+                        self.stale_hits += 1
+                    else:
+                        self.hits += 1
+                    return list(result)
+            if not stale:
+                self.misses += 1
+            return None
+
+    def set(self, index_name, query, generation, result):
+        """Cache result for query if generation is still current.
+
+        Args:
+            index_name: String name of the searched index.
+            query: String normalized search query.
+            generation: Integer write generation read before the search
+                was made. The result is discarded if the index was written
+                to since.
+            result: List of string document identifiers to cache.
+        """
+        key = (index_name, query)
+        with self._lock:
+            if generation != self._generations.get(index_name, 0):
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (
+                generation, time.time() + self._ttl, tuple(result))
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+_search_cache = _SearchCache()
+"""_SearchCache of recent search results shared by all requests."""
+
+_FLIGHT_TIMEOUT = 10
+"""Integer number of seconds to wait for an identical search in flight."""
+
+class _FlightTimeoutError(Exception):
+
+    """Exception raised when an identical search in flight took too long."""
+
+class _SingleFlight(object):
+
+    """Coalesce identical concurrent calls into a single call.
+
+    The first thread to call a function under a key becomes the leader and
+    makes the call. Threads calling under the same key while the call is in
+    flight wait for the leader and share its result or exception instead of
+    making their own call.
+    """
+
+    def __init__(self):
+        """Initialize with no call in flight."""
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        """Integer number of calls made."""
+        self.followers = 0
+        """Integer number of calls saved by waiting for a call in flight."""
+        self.timeouts = 0
+        """Integer number of waits that gave up on a call in flight."""
+
+    def clear(self):
+        """Reset the counters.
+
+        Calls in flight complete normally.
+        """
+        with self._lock:
+            self.leaders = 0
+            self.followers = 0
+            self.timeouts = 0
+
+    def in_flight(self):
+        """Return the integer number of calls in flight."""
+        with self._lock:
+            return len(self._flights)
+
+    def do(self, key, function, timeout=_FLIGHT_TIMEOUT):
+        """Return the result of function, sharing calls in flight for key.
+
+        Args:
+            key: Hashable key identifying identical calls.
+            function: Function without arguments to call.
+            timeout: Optional number of seconds to wait for the result of
+                the call in flight.
+        Returns:
+            The result of function.
+        Raises:
+            The exception raised by function.
+            _FlightTimeoutError if the call in flight did not complete in
+                timeout seconds.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                # Event signalled with the result or the exception
+                flight = self._flights[key] = [threading.Event(), None, None]
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+
+        event = flight[0]
+        if leader:
+            try:
+                flight[1] = function()
+            except Exception as e:
+                flight[2] = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                event.set()
+            return flight[1]
+
+        if not event.wait(timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise _FlightTimeoutError(
+                'Timed out waiting for the call in flight.')
+        if flight[2] is not None:
+            raise flight[2]
+        return flight[1]
+
+_search_flights = _SingleFlight()
+"""_SingleFlight of the searches in flight shared by all requests."""
+
+_DIGEST_NAMESPACE = 'digests'
+"""String memcache namespace of the document content digests."""
+
+def _document_digest(document):
+    """Return a compact string digest of the fields of document.
+
+    Args:
+        document: search.Document object to digest.
+    Returns:
+        String of the first 8 bytes of the SHA-1 digest of the field names
+        and values of document.
+    """
+    digest = hashlib.sha1()
+    for field in document.fields:
+        digest.update(field.name)
+        digest.update('\0')
+        digest.update(field.value.encode('utf-8'))
+        digest.update('\0')
+    return digest.digest()[:8]
+
+class _DigestStore(object):
+
+    """Store of the content digest of the documents put, kept in memcache.
+
+    Every instance remembers the digests of the documents it puts and
+    forgets those of the documents it deletes, so a document is only
+    unchanged if its last put through any instance had the same content.
+    Memcache may evict digests at any time, which only means documents are
+    put again. A digest that cannot be replaced or forgotten is logged, and
+    callers should offer a way to put documents regardless of the store.
+    """
+
+    def __init__(self, namespace=_DIGEST_NAMESPACE):
+        """Initialize a store of the digests in a memcache namespace.
+
+        Args:
+            namespace: Optional string memcache namespace of the digests.
+        """
+        self._namespace = namespace
+
+    @staticmethod
+    def _key(index_name, doc_id):
+        """Return the memcache key of the digest of doc_id in the index."""
+        # Document identifiers may be longer than memcache keys
+        return hashlib.sha1('{0}\0{1}'.format(index_name, doc_id)).hexdigest()
+
+    def forget(self, index_name, ids):
+        """Forget the digests of the documents with identifiers in ids.
+
+        Args:
+            index_name: String name of the index.
+            ids: Iterable of string document identifiers.
+        """
+        self._forget_keys([self._key(index_name, doc_id) for doc_id in ids])
+
+    def _forget_keys(self, keys):
+        """Forget the digests with the memcache keys in keys."""
+        if keys and not memcache.delete_multi(keys,
+                                              namespace=self._namespace):
+            logging.error('Unable to forget {0} document digests.'.format(
+                len(keys)))
+
+    def update(self, index_name, documents):
+        """Remember the digests of documents that were put in the index.
+
+        Args:
+            index_name: String name of the index.
+            documents: Iterable of search.Document objects.
+        """
+        digests = dict((self._key(index_name, document.doc_id),
+                        _document_digest(document))
+                       for document in documents)
+        failed = memcache.set_multi(digests, namespace=self._namespace)
+        # A previous digest would make the documents look unchanged
+        self._forget_keys(failed)
+
+    def iter_changed(self, index_name, documents, counts):
+        """Yield the documents that changed since they were put.
+
+        The digests are looked up batch by batch, so an iterator of
+        documents is read as the documents are requested. The previous
+        digests of the changed documents are forgotten before they are
+        yielded, so that a put that fails does not leave them unchanged.
+
+        Args:
+            index_name: String name of the index.
+            documents: Iterable of search.Document objects.
+            counts: Dictionary whose 'skipped' count is incremented for
+                each unchanged document.
+        Yields:
+            search.Document objects that are not known to be unchanged.
+        """
+        iterator = iter(documents)
+        while True:
+            batch = list(itertools.islice(iterator, _BATCH_SIZE))
+            if not batch:
+                return
+            keys = [self._key(index_name, document.doc_id)
+                    for document in batch]
+            digests = memcache.get_multi(keys, namespace=self._namespace)
+            changed = []
+            stale = []
+            for key, document in zip(keys, batch):
+                digest = digests.get(key)
+                if digest == _document_digest(document):
+                    counts['skipped'] += 1
+                else:
+                    changed.append(document)
+                    if digest is not None:
+                        stale.append(key)
+            self._forget_keys(stale)
+            for document in changed:
+                yield document
+
+_digest_store = _DigestStore()
+"""_DigestStore of the documents put by every instance."""
+
+_DOC_ID_PATTERN = re.compile(
+    r'[!-~]{{1,{0}}}\Z'.format(search.MAXIMUM_DOCUMENT_ID_LENGTH))
+"""Compiled regular expression of visible printable ASCII identifiers."""
+
+def _is_valid_doc_id(doc_id):
+    """Return True if doc_id is a valid ASCII document identifier.
+
+    A doc_id must contain only visible, printable ASCII characters (ASCII
+    codes 33 through 126 inclusive) and be no longer than 500 characters.
+    A document identifier cannot begin with an exclamation point ('!'), and
+    it can't begin and end with double underscores ("__").
+
+    Args:
+        doc_id: String ASCII document identifier to test.
+    Returns:
+        True if doc_id is a valid ASCII document identifier. False otherwise.
+    """
+    return (isinstance(doc_id, str) and
+            (_DOC_ID_PATTERN.match(doc_id) is not None) and
+            (doc_id[0] != '!') and
+            not ((doc_id[:2] == '__') and (doc_id[-2:] == '__')))
+
+def _rejection_reason(doc_id, text=u'text'):
+    """Return why doc_id and text do not make a valid document or None.
+
+    This is only called for the rejected entries, so it favors clarity over
+    speed.
+
+    Args:
+        doc_id: Document identifier.
+        text: Optional text of the document.
+    Returns:
+        String name of the reason. None if doc_id and text are valid.
+    """
+    if not isinstance(doc_id, basestring):
+        return 'invalid_id_type'
+    try:
+        doc_id = doc_id.encode('ascii')
+    except UnicodeError:
+        return 'non_ascii_id'
+    if not doc_id:
+        return 'empty_id'
+    if len(doc_id) > search.MAXIMUM_DOCUMENT_ID_LENGTH:
+        return 'id_too_long'
+    if _DOC_ID_PATTERN.match(doc_id) is None:
+        return 'invisible_character'
+    if not _is_valid_doc_id(doc_id):
+        return 'reserved_id'
+    if not (isinstance(text, basestring) and (len(text) > 0)):
+        return 'invalid_text'
+    return None
+
+def _ascii_doc_id(value):
+    """Return value as a valid ASCII document identifier or None.
+
+    Args:
+        value: Document identifier, usually a unicode string.
+    Returns:
+        String ASCII document identifier if value is valid. None otherwise.
+    """
+    try:
+        doc_id = value.encode('ascii')
+    except (AttributeError, UnicodeError):
+        return None
+    return doc_id if _is_valid_doc_id(doc_id) else None
+
+def _validate_doc_ids(values, rejected=None):
+    """Return the valid document identifiers in values as ASCII strings.
+
+    Every value is checked with the precompiled _DOC_ID_PATTERN instead of
+    character by character, and the reason of a rejection is only worked
+    out for the rejected values.
+
+    Args:
+        values: Iterable of document identifiers, usually unicode strings.
+        rejected: Optional collections.Counter incremented by the reason
+            each value is rejected for.
+    Returns:
+        List of the string ASCII document identifiers of the valid values
+        in values, in order.
+    """
+    ids = []
+    for value in values:
+        doc_id = _ascii_doc_id(value)
+        if doc_id is not None:
+            ids.append(doc_id)
+        elif rejected is not None:
+            rejected[_rejection_reason(value)] += 1
+    return ids
+
+def _make_document(doc_id, text, rejected=None):
+    """Return a document with the text in its _FIELD_NAME field or None.
+
+    Args:
+        doc_id: String document identifier.
+        text: String text of the document. It is truncated to the maximum
+            field value length.
+        rejected: Optional collections.Counter incremented by the reason
+            the document is rejected for.
+    Returns:
+        search.Document object if doc_id is a valid ASCII document
+        identifier and text is a non-empty string. None otherwise.
+    """
+    documents = _make_documents([(doc_id, text)], rejected)
+    return documents[0] if documents else None
+
+def _make_documents(entries, rejected=None):
+    """Return the documents of the valid (doc_id, text) pairs in entries.
+
+    The names looked up in every iteration are bound once, so a whole
+    payload is built in a single call.
+
+    Args:
+        entries: Iterable of (doc_id, text) tuples. The text of a document
+            is truncated to the maximum field value length.
+        rejected: Optional collections.Counter incremented by the reason
+            each entry is rejected for.
+    Returns:
+        List of search.Document objects.
+    """
+    documents = []
+    ascii_doc_id = _ascii_doc_id
+    Document = search.Document
+    TextField = search.TextField
+    name = _FIELD_NAME
+    length = search.MAXIMUM_FIELD_VALUE_LENGTH
+    for doc_id, text in entries:
+        ascii_id = ascii_doc_id(doc_id)
+        if (ascii_id is not None) and isinstance(text, basestring) and text:
+            documents.append(Document(doc_id=ascii_id, fields=[
+                TextField(name=name, value=text[:length])]))
+        elif rejected is not None:
+            rejected[_rejection_reason(doc_id, text)] += 1
+    return documents
+
+def _read_ndjson_documents(lines, rejected=None):
+    """Yield the documents in newline delimited JSON lines.
+
+    Every line is a JSON object with the document identifier as 'id' and
+    its text as 'text'. Lines that are not a valid document are skipped.
+    Lines are read as documents are requested, so only the documents not
+    yet put are held in memory.
+
+    Args:
+        lines: Iterable of string lines of newline delimited JSON.
+        rejected: Optional collections.Counter incremented by the reason
+            each line is rejected for.
+    Yields:
+        search.Document objects.
+    """
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            entry = None
+        if not isinstance(entry, dict):
+            if (rejected is not None) and line.strip():
+                rejected['malformed'] += 1
+            continue
+        document = _make_document(entry.get('id'), entry.get('text'),
+                                  rejected)
+        if document is not None:
+            yield document
+
+_OPERATORS_PATTERN = re.compile('[:=<>]')
+"""Compiled regular expression matching the relational operators."""
+
+def _strip_operators(query, replacement=' '):
+    """Return query without the relational operators (:=<>).
+
+    Args:
+        query: String search query.
+        replacement: Optional string replacement string for the relational
+            operators. Defaults to space.
+    Returns:
+        String query without the relational operators (:=<>).
+    """
+    if not isinstance(query, basestring):
+        raise TypeError('query must be a string.')
+    if not isinstance(replacement, basestring):
+        raise TypeError('replacement must be a string.')
+    return _OPERATORS_PATTERN.sub(replacement, query)
+
+def _wait_any(futures):
+    """Return a future from futures that has completed, waiting if needed.
+
+    Args:
+        futures: List of Search API futures.
+    Returns:
+        The first future in futures to complete. Futures that are not
+        backed by an RPC are complete by definition.
+    """
+    rpcs = {}
+    for future in futures:
+        rpc = getattr(future, '_rpc', None)
+        if rpc is None:
+            return future
+        rpcs[rpc] = future
+    # wait_any returns None if an RPC that is not in rpcs finished instead
+    rpc = apiproxy_stub_map.UserRPC.wait_any(rpcs.keys())
+    return rpcs.get(rpc, futures[0])
+
+_TRANSIENT_RESULT_CODES = frozenset([
+    search.OperationResult.CONCURRENT_TRANSACTION,
+    search.OperationResult.TIMEOUT,
+    search.OperationResult.TRANSIENT_ERROR])
+"""frozenset of the codes of the per-document results worth retrying."""
+
+def _item_id(item):
+    """Return the document identifier of a document or identifier item."""
+    return getattr(item, 'doc_id', item)
+
+def _partition_results(batch, results):
+    """Split batch by the per-document results of a failed put/delete call.
+
+    Args:
+        batch: List of the items passed to the call.
+        results: List of search.OperationResult objects of the call. Items
+            without a result for their document identifier are assumed to
+            have failed transiently, and items with several results to
+            have failed if any of them did.
+    Returns:
+        Tuple of the lists of the items of batch that succeeded, that
+        failed transiently and that failed permanently.
+    """
+    codes = {}
+    for result in results:
+        if codes.get(result.id, search.OperationResult.OK) == (
+            search.OperationResult.OK):
+            codes[result.id] = result.code
+    succeeded = []
+    transient = []
+    failed = []
+    for item in batch:
+        code = codes.get(_item_id(item),
+                         search.OperationResult.TRANSIENT_ERROR)
+        if code == search.OperationResult.OK:
+            succeeded.append(item)
+        elif code in _TRANSIENT_RESULT_CODES:
+            transient.append(item)
+        else:
+            failed.append(item)
+    return succeeded, transient, failed
+
+def _dispatch(operation, call, items, callback=None, budget=None):
+    """Make call for batches of items with a bounded number in flight.
+
+    At most _MAX_IN_FLIGHT calls are in flight at a time and they are
+    completed in whatever order they finish. Batches that exceed their
+    deadline are split to the current batch size and retried with an
+    exponential backoff up to _MAX_RETRIES times. When a call fails for
+    some of the documents only, the documents that failed transiently are
+    retried the same way, batched together with those of other calls
+    waiting to be retried, and the others are reported as failed. Every
+    batch reserves its documents from the write budget before it is
+    dispatched, so batches are no larger than the limit of the budget, and
+    the remaining batches are deferred while the circuit
+    breakers shed writes or once a call exceeded the quota. Deferred
+    documents include the unread items and the batches waiting to be
+    retried.
+
+    Items are read from items only as batches are dispatched, so an
+    iterator is never held in memory beyond the batches in flight.
+
+    Args:
+        operation: String name of the Search API operation ('put' or
+            'delete') used to pick the _BatchSizer and in log messages.
+        call: Function that takes a list of items and returns a future.
+        items: Iterable of items to pass to call in batches.
+        callback: Optional function called with the list of items of each
+            batch that were put/deleted successfully.
+        budget: Optional _WriteBudget to reserve the documents from.
+            Defaults to _write_budget.
+    Returns:
+        List of dictionaries summarizing each batch in the order they
+        completed. A summary has the integer number of items in the batch
+        ('size'), the integer number of calls made for it ('attempts'),
+        the float number of seconds the last call took ('latency'), the
+        string name of the exception it raised or None ('error') and the
+        list of the document identifiers of the items that failed and are
+        not retried ('failed').
+    Raises:
+        _BudgetExceededError if the write budget did not become available
+            in time for every batch or a call exceeded the quota. Its
+            summary is that of the batches that completed.
+        _CircuitOpenError if batches were shed by the circuit breakers.
+    """
+    if budget is None:
+        budget = _write_budget
+    sizer = _batch_sizers[operation]
+    iterator = iter(items)
+    exhausted = False
+    deadline = time.time() + _BUDGET_TIMEOUT
+    # Heap of (not before, sequence number, attempts, batch) to retry
+    retries = []
+    sequence = 0
+    in_flight = {}
+    summary = []
+    count = 0
+    deferred = []
+    shed_retry_after = None
+    stopped = False
+    over_quota = False
+    # Attempts and items of the last queued retry of transient failures
+    transient_retry = (None, None)
+    try:
+        while True:
+            while (not stopped) and (len(in_flight) < _MAX_IN_FLIGHT):
+                if retries and (retries[0][0] <= time.time()):
+                    _, _, attempts, batch = heapq.heappop(retries)
+                    if batch is transient_retry[1]:
+                        transient_retry = (None, None)
+                else:
+                    batch = []
+                    if not exhausted:
+                        size = min(sizer.size, budget.limit)
+                        batch = list(itertools.islice(iterator, size))
+                        exhausted = len(batch) < size
+                        count += len(batch)
+                    if not batch:
+                        break
+                    attempts = 0
+                shed_retry_after = _shed_retry_after(operation)
+                if (shed_retry_after is not None) or (
+                    not budget.acquire(
+                        len(batch), max(deadline - time.time(), 0))):
+                    deferred = [_item_id(item) for item in batch]
+                    stopped = True
+                    break
+                in_flight[call(batch)] = (batch, attempts + 1, time.time())
+
+            if not in_flight:
+                if retries and not stopped:
+                    time.sleep(max(retries[0][0] - time.time(), 0))
+                    continue
+                break
+
+            future = _wait_any(in_flight.keys())
+            batch, attempts, start = in_flight.pop(future)
+            error = None
+            try:
+                future.get_result()
+            except (search.DeleteError, search.PutError,
+                    apiproxy_errors.DeadlineExceededError,
+                    apiproxy_errors.OverQuotaError) as e:
+                error = e
+            latency = time.time() - start
+            _record_call(operation, len(batch), start, error)
+            failed = []
+            if isinstance(error, (search.DeleteError, search.PutError)):
+                succeeded, transient, failed = _partition_results(
+                    batch, error.results)
+                if succeeded and (callback is not None):
+                    callback(succeeded)
+                if transient and (attempts <= _MAX_RETRIES):
+                    if (transient_retry[0] == attempts) and (
+                        len(transient_retry[1]) + len(transient) <=
+                        min(sizer.size, budget.limit)):
+                        # Retry with the failures of another batch
+                        transient_retry[1].extend(transient)
+                    else:
+                        transient_retry = (attempts, transient)
+                        heapq.heappush(retries, (
+                            time.time() + _RETRY_DELAY * 2 ** (attempts - 1),
+                            sequence, attempts, transient))
+                        sequence += 1
+                else:
+                    failed.extend(transient)
+                if failed:
+                    logging.error(
+                        'Unable to {0} {1} documents in search index.'.format(
+                            operation, len(failed)))
+                failed = [_item_id(item) for item in failed]
+            elif isinstance(error, apiproxy_errors.DeadlineExceededError):
+                sizer.failure()
+                if attempts <= _MAX_RETRIES:
+                    not_before = (time.time() +
+                                  _RETRY_DELAY * 2 ** (attempts - 1))
+                    size = min(sizer.size, budget.limit)
+                    for i in xrange(0, len(batch), size):
+                        heapq.heappush(retries, (
+                            not_before, sequence, attempts,
+                            batch[i:i+size]))
+                        sequence += 1
+                    continue
+                logging.error(
+                    'Deadline exceeded for Search API {0} call.'.format(
+                        operation))
+                failed = [_item_id(item) for item in batch]
+            elif isinstance(error, apiproxy_errors.OverQuotaError):
+                logging.error(
+                    'Quota exceeded for Search API {0} {1} calls.'.format(
+                        count, operation))
+                # Stop making calls that are bound to exceed the quota too
+                stopped = True
+                over_quota = True
+                failed = [_item_id(item) for item in batch]
+            else:
+                sizer.success(latency)
+                if callback is not None:
+                    callback(batch)
+            summary.append({
+                'attempts': attempts,
+                'error': None if error is None else type(error).__name__,
+                'failed': failed,
+                'latency': latency,
+                'size': len(batch)
+            })
+    finally:
+        # Do not abandon the calls in flight if reading items raised
+        for future in in_flight:
+            try:
+                future.get_result()
+            except (search.Error, apiproxy_errors.Error):
+                pass
+
+    if stopped:
+        # Batches that exceed their deadline after stopping are deferred too
+        for retry in retries:
+            deferred.extend(_item_id(item) for item in retry[3])
+        deferred.extend(_item_id(item) for item in iterator)
+    if deferred:
+        if over_quota:
+            # The Search API quota is replenished per minute
+            raise _BudgetExceededError(deferred, _BUDGET_WINDOW, summary)
+        if shed_retry_after is not None:
+            raise _CircuitOpenError(deferred, shed_retry_after, summary)
+        raise _BudgetExceededError(deferred, budget.retry_after(
+            min(len(deferred), _BATCH_SIZE)), summary)
+    return summary
+
+def _delete(search_index, ids, callback=None):
+    """Delete documents with document identifiers in ids.
+
+    The digests and prefix index terms of the documents are forgotten and
+    the search result cache of the index is invalidated once the delete
+    calls complete.
+
+    Args:
+        search_index: search.Index object to the index from which to delete.
+        ids: List of string document identifiers to delete.
+        callback: Optional function called with each list of document
+            identifiers that was deleted successfully.
+    Returns:
+        List of dictionaries summarizing each delete call as returned by
+        _dispatch.
+    Raises:
+        ValueError if ids is longer than the Search API safety limit.
+        _BudgetExceededError if the write budget did not become available
+            in time for every batch.
+    """
+    length = len(ids)
+    if length > _SAFETY_LIMIT:
+        raise ValueError('ids exceeds the Search API safety limit.')
+
+    _digest_store.forget(search_index.name, ids)
+    _get_prefix_index(search_index.name).remove(ids)
+    tenant = _tenants.for_index(search_index.name)
+
+    def on_success(batch):
+        _record_tenant_documents(tenant, 'delete', len(batch))
+        if callback is not None:
+            callback(batch)
+
+    try:
+        return _dispatch('delete', search_index.delete_async, ids,
+                         on_success, _tenants.budget(search_index.name))
+    finally:
+        if length > 0:
+            _search_cache.invalidate(search_index.name)
+
+def _put(search_index, documents, callback=None):
+    """Put documents in the search index.
+
+    If a document with the same document identifier already exists in the
+    search index, then that document is replaced. The search result cache
+    of the index is invalidated once the put calls complete and the digest
+    and prefix index terms of every document put successfully are
+    remembered.
+
+    Args:
+        search_index: search.Index object to the index to which to put.
+        documents: List or iterator of search.Document objects to put. An
+            iterator is read lazily as batches are dispatched and must
+            enforce the Search API safety limit itself.
+        callback: Optional function called with each list of documents that
+            was put successfully.
+    Returns:
+        List of dictionaries summarizing each put call as returned by
+        _dispatch.
+    Raises:
+        ValueError if documents is longer than the Search API safety limit.
+        _BudgetExceededError if the write budget did not become available
+            in time for every batch.
+    """
+    if isinstance(documents, collections.Iterator):
+        documents = (document for document in documents
+                     if isinstance(document, search.Document))
+    else:
+        documents = [document for document in documents
+                     if isinstance(document, search.Document)]
+        if len(documents) > _SAFETY_LIMIT:
+            raise ValueError('documents exceeds the Search API safety limit.')
+        if not documents:
+            return []
+
+    tenant = _tenants.for_index(search_index.name)
+
+    def on_success(batch):
+        _digest_store.update(search_index.name, batch)
+        _get_prefix_index(search_index.name).update(batch)
+        _record_tenant_documents(tenant, 'put', len(batch))
+        if callback is not None:
+            callback(batch)
+
+    try:
+        return _dispatch('put', search_index.put_async, documents, on_success,
+                         _tenants.budget(search_index.name))
+    finally:
+        _search_cache.invalidate(search_index.name)
+
+def _normalize_query(query):
+    """Return query normalized for a global search or None.
+
+    Args:
+        query: String search query.
+    Returns:
+        String query stripped of surrounding whitespace and relational
+        operators. None if query is empty or too long to search.
+    Raises:
+        TypeError if query is not a string.
+    """
+    if not isinstance(query, basestring):
+        raise TypeError('query must be a non-empty string.')
+    query = query.strip()
+    length = len(query)
+    if (length <= 0) or (search.MAXIMUM_QUERY_LENGTH < length):
+        return None
+    return _strip_operators(query)
+
+def _run_query(search_index, query, options, raise_errors=False):
+    """Return the results of searching the index for query or None.
+
+    Args:
+        search_index: search.Index object to the index to search.
+        query: String normalized search query.
+        options: search.QueryOptions object of the options for the search.
+        raise_errors: Optional boolean to raise the error of a failed
+            Search API call instead of returning None.
+    Returns:
+        search.SearchResults object. None if the query is not parseable or
+        the Search API call failed.
+    """
+    try:
+        # Create search.Query in try-catch to catch QueryError
+        # if the search query is not parseable
+        query_object = search.Query(query, options=options)
+    except search.Error:
+        return None
+    start = time.time()
+    try:
+        result = search_index.search(query_object)
+    except search.Error as e:
+        _record_call('search', 1, start, e)
+        if raise_errors:
+            raise
+        return None
+    except apiproxy_errors.DeadlineExceededError as e:
+        _record_call('search', 1, start, e)
+        logging.error('Deadline exceeded for Search API search call.')
+        if raise_errors:
+            raise
+        return None
+    except apiproxy_errors.OverQuotaError as e:
+        _record_call('search', 1, start, e)
+        logging.error('Quota exceeded for Search API search call.')
+        if raise_errors:
+            raise
+        return None
+    _record_call('search', 1, start)
+    return result
+
+def _search(search_index, query):
+    """Return document IDs matching a global search of the index for query.
+
+    Results are answered from the search result cache when a fresh result
+    for the normalized query is cached. Concurrent identical searches of the
+    index share a single Search API call. While the circuit breaker sheds
+    searches, a stale cached result is returned if there is one.
+
+    Args:
+        search_index: search.Index object to the index to search.
+        query: String search query.
+    Returns:
+        List of string document identifiers whose full text match a global
+        search of the index for query.
+    Raises:
+        _CircuitOpenError if the search was shed and no result is cached.
+    """
+    query = _normalize_query(query)
+    if query is None:
+        return []
+
+    generation = _search_cache.generation(search_index.name)
+    result = _search_cache.get(search_index.name, query)
+    if result is not None:
+        return result
+
+    def search_query():
+        retry_after = _shed_retry_after('search')
+        if retry_after is not None:
+            raise _CircuitOpenError([], retry_after)
+        options_arguments = {
+            'limit': search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH,
+            'ids_only': True
+        }
+        options = search.QueryOptions(**options_arguments)
+        result = _run_query(search_index, query, options)
+        if result is None:
+            return None
+        result = [doc.doc_id for doc in result.results]
+        _search_cache.set(search_index.name, query, generation, result)
+        return result
+
+    # Searches started before a write are not shared with later requests
+    try:
+        result = _search_flights.do(
+            (search_index.name, query, generation), search_query)
+    except _FlightTimeoutError:
+        logging.error('Timed out waiting for Search API search call.')
+        return []
+    except _CircuitOpenError:
+        result = _search_cache.get(search_index.name, query, stale=True)
+        if result is None:
+            raise
+        return result
+    if result is None:
+        return []
+    return list(result)
+
+def _search_many(search_index, queries):
+    """Return document IDs matching a global search for each query.
+
+    Identical normalized queries are searched once. Queries that are not
+    answered from the search result cache are searched concurrently. While
+    the circuit breaker sheds searches, stale cached results are returned
+    and queries without one fail with the name of _CircuitOpenError.
+
+    Args:
+        search_index: search.Index object to the index to search.
+        queries: List of string search queries.
+    Returns:
+        Tuple of a dictionary mapping each query that was searched to the
+        list of string document identifiers that match it and a dictionary
+        mapping each query that could not be searched to the string name
+        of the error.
+    """
+    generation = _search_cache.generation(search_index.name)
+    # Map each normalized query to the queries that normalize to it
+    normalized = collections.defaultdict(list)
+    results = {}
+    for query in queries:
+        if isinstance(query, basestring):
+            key = _normalize_query(query)
+            if key is None:
+                results[query] = []
+            else:
+                normalized[key].append(query)
+
+    options_arguments = {
+        'limit': search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH,
+        'ids_only': True
+    }
+    options = search.QueryOptions(**options_arguments)
+    futures = {}
+    errors = {}
+    for key, originals in normalized.iteritems():
+        result = _search_cache.get(search_index.name, key)
+        if result is None and (_shed_retry_after('search') is not None):
+            result = _search_cache.get(search_index.name, key, stale=True)
+            if result is None:
+                for query in originals:
+                    errors[query] = _CircuitOpenError.__name__
+                continue
+        if result is not None:
+            for query in originals:
+                results[query] = list(result)
+            continue
+        try:
+            futures[key] = search_index.search_async(
+                search.Query(key, options=options))
+        except search.Error as e:
+            for query in originals:
+                errors[query] = type(e).__name__
+
+    start = time.time()
+    for key, future in futures.iteritems():
+        try:
+            result = future.get_result()
+        except (search.Error, apiproxy_errors.Error) as e:
+            _record_call('search', 1, start, e)
+            logging.error('Unable to make Search API search call.')
+            for query in normalized[key]:
+                errors[query] = type(e).__name__
+            continue
+        _record_call('search', 1, start)
+        result = [doc.doc_id for doc in result.results]
+        _search_cache.set(search_index.name, key, generation, result)
+        for query in normalized[key]:
+            results[query] = list(result)
+    return results, errors
+
+_PROJECTIONS = frozenset(['snippet', 'text'])
+"""Frozen set of the string names of the fields a search can return."""
+
+_RESPONSE_TEXT_LIMIT = 256 * 1024
+"""Integer maximum number of characters of text in a search response."""
+
+def _search_page(search_index, query, limit, cursor=None, fields=None,
+                 raise_errors=False):
+    """Return a page of document IDs matching a global search for query.
+
+    Only the document identifiers are read unless fields is given. With
+    'text' the stored text of the documents is returned as well and with
+    'snippet' an HTML snippet of their text around the query terms.
+
+    Args:
+        search_index: search.Index object to the index to search.
+        query: String search query.
+        limit: Integer maximum number of document identifiers in the page.
+        cursor: Optional string web safe cursor returned with the previous
+            page. Defaults to the first page.
+        fields: Optional string name in _PROJECTIONS of the field to return
+            with the documents. Defaults to only their identifiers.
+        raise_errors: Optional boolean to raise the error of a failed
+            Search API call instead of returning an empty last page.
+    Returns:
+        Tuple of the list of string document identifiers in the page, or
+        of search.ScoredDocument objects if fields is given, and the string
+        web safe cursor to the next page or None if this is the last page.
+    Raises:
+        ValueError if limit is out of range or cursor is malformed.
+        _CircuitOpenError if the search was shed by the circuit breaker.
+    """
+    if not (0 < limit <= search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH):
+        raise ValueError('limit is out of range.')
+    cursor = search.Cursor(web_safe_string=cursor)
+    query = _normalize_query(query)
+    if query is None:
+        return [], None
+    retry_after = _shed_retry_after('search')
+    if retry_after is not None:
+        raise _CircuitOpenError([], retry_after)
+
+    options_arguments = {
+        'cursor': cursor,
+        'limit': limit
+    }
+    if fields == 'text':
+        options_arguments['returned_fields'] = [_FIELD_NAME]
+    elif fields == 'snippet':
+        options_arguments['snippeted_fields'] = [_FIELD_NAME]
+    else:
+        options_arguments['ids_only'] = True
+    options = search.QueryOptions(**options_arguments)
+    result = _run_query(search_index, query, options, raise_errors)
+    if result is None:
+        return [], None
+    results = list(result.results)
+    if fields is None:
+        results = [doc.doc_id for doc in results]
+    if (result.cursor is None) or (len(results) < limit):
+        return results, None
+    return results, result.cursor.web_safe_string
+
+def _project(documents, fields, length=None, size=_RESPONSE_TEXT_LIMIT):
+    """Return the documents of a search as JSON serializable objects.
+
+    Every object has the document identifier as 'id', its text or snippet
+    as fields and whether that value was cut short as 'truncated'. Texts
+    are cut to length characters and to what remains of size characters
+    for the whole response. Snippets are HTML, so they are never cut but
+    dropped as null once they no longer fit.
+
+    Args:
+        documents: List of search.ScoredDocument objects returned by
+            _search_page for fields.
+        fields: String name in _PROJECTIONS of the field to return.
+        length: Optional integer maximum number of characters of each text.
+            Defaults to the whole text.
+        size: Optional integer maximum number of characters of text or
+            snippets in all the objects.
+    Returns:
+        List of dictionaries in the order of documents.
+    """
+    result = []
+    for document in documents:
+        if fields == 'snippet':
+            value = None
+            for expression in document.expressions:
+                if expression.name == _FIELD_NAME:
+                    value = expression.value
+        else:
+            value = _document_text(document)
+        truncated = False
+        if value is not None:
+            limit = size
+            if (fields == 'text') and (length is not None):
+                limit = min(length, size)
+            if len(value) > limit:
+                value = value[:limit] if fields == 'text' else None
+                truncated = True
+            if value is not None:
+                size -= len(value)
+        result.append(
+            {'id': document.doc_id, fields: value, 'truncated': truncated})
+    return result
+
+def _iter_search(search_index, query):
+    """Yield every document ID matching a global search for query.
+
+    The results are read page by page with cursors, so only one page is
+    held in memory at a time. A failed Search API call raises its error
+    rather than end the results as if they were complete.
+
+    Args:
+        search_index: search.Index object to the index to search.
+        query: String search query.
+    Yields:
+        String document identifiers.
+    Raises:
+        search.Error or apiproxy_errors.Error if a Search API call failed.
+    """
+    cursor = None
+    while True:
+        ids, cursor = _search_page(
+            search_index, query,
+            search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH, cursor,
+            raise_errors=True)
+        for doc_id in ids:
+            yield doc_id
+        if cursor is None:
+            return
+
+_REINDEX_LIMIT = _BATCH_SIZE * _MAX_IN_FLIGHT
+"""Integer default maximum number of documents to copy per reindex step."""
+
+def _document_text(document):
+    """Return the text of the _FIELD_NAME field of document or None."""
+    for field in document.fields:
+        if field.name == _FIELD_NAME:
+            return field.value
+    return None
+
+def _iter_documents(search_index, start_id=None, ids_only=False,
+                    raise_errors=False):
+    """Yield every document of the index in identifier order.
+
+    The documents are read range by range, so only one range is held in
+    memory at a time. A failed Search API call ends the documents early.
+
+    Args:
+        search_index: search.Index object to the index to read.
+        start_id: Optional string document identifier to start after.
+            Defaults to the first document.
+        ids_only: Optional boolean to only read the document identifiers.
+        raise_errors: Optional boolean to raise the error of a failed
+            Search API call instead of ending the documents.
+    Yields:
+        search.Document objects.
+    """
+    while True:
+        start = time.time()
+        try:
+            documents = list(search_index.get_range(
+                start_id=start_id, include_start_object=False,
+                limit=search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH,
+                ids_only=ids_only))
+        except (search.Error, apiproxy_errors.Error) as e:
+            _record_call('get_range', 0, start, e)
+            logging.error('Unable to make Search API get_range call.')
+            if raise_errors:
+                raise
+            return
+        _record_call('get_range', len(documents), start)
+        for document in documents:
+            yield document
+        if len(documents) < search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH:
+            return
+        start_id = documents[-1].doc_id
+
+def _reindex(source, target, start_id=None, limit=_REINDEX_LIMIT):
+    """Copy up to limit documents from the source index to the target index.
+
+    Documents are read in identifier order and rebuilt with the current
+    field layout from their text before they are put, batches being put
+    concurrently within the write budget. Call repeatedly with the returned
+    checkpoint until it is None.
+
+    Args:
+        source: search.Index object to the index to copy from.
+        target: search.Index object to the index to copy to.
+        start_id: Optional string document identifier checkpoint returned
+            by the previous call. Defaults to the first document.
+        limit: Optional integer maximum number of documents to copy.
+    Returns:
+        Tuple of the integer number of documents copied, the integer number
+        of documents that failed to be copied and the string document
+        identifier to resume from. The checkpoint is None once every
+        document was read. If a batch failed, the checkpoint is before its
+        first document so that it is copied again on the next call.
+    Raises:
+        _BudgetExceededError if the write budget did not become available
+            in time to copy the documents.
+        search.Error or apiproxy_errors.Error if reading the source index
+            failed, rather than copy part of the documents as if it were
+            all of them.
+    """
+    documents = []
+    for document in itertools.islice(
+        _iter_documents(source, start_id, raise_errors=True), limit):
+        copy = None
+        text = _document_text(document)
+        if text is not None:
+            copy = _make_document(document.doc_id, text)
+        documents.append(copy or document)
+    if not documents:
+        return 0, 0, None
+
+    copied = set()
+    _put(target, documents, lambda batch: copied.update(
+        document.doc_id for document in batch))
+    failed = len(documents) - len(copied)
+    checkpoint = start_id
+    for document in documents:
+        if document.doc_id not in copied:
+            return len(copied), failed, checkpoint
+        checkpoint = document.doc_id
+    if len(documents) < limit:
+        checkpoint = None
+    return len(copied), failed, checkpoint
+
+### Local search backend
+
+_TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+"""Compiled regular expression of the terms in full text."""
+
+def _tokenize(text):
+    """Return the list of lowercase terms in text.
+
+    Args:
+        text: String full text to tokenize.
+    Returns:
+        List of unicode lowercase terms in text in order of appearance.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return _TOKEN_PATTERN.findall(text.lower())
+
+_SNIPPET_LENGTH = 160
+"""Integer number of characters of text in a snippet of the local index."""
+
+def _snippet(text, terms):
+    """Return an HTML snippet of text around the first of terms in it.
+
+    The snippet is about _SNIPPET_LENGTH characters of text, escaped, with
+    the terms in bold and an ellipsis where text was cut like the snippets
+    of the Search API.
+
+    Args:
+        text: Unicode full text to snippet.
+        terms: Collection of unicode lowercase terms to highlight.
+    Returns:
+        Unicode HTML snippet.
+    """
+    matches = [match for match in _TOKEN_PATTERN.finditer(text)
+               if match.group().lower() in terms]
+    start = 0
+    if matches:
+        start = max(matches[0].start() - _SNIPPET_LENGTH // 4, 0)
+    end = min(start + _SNIPPET_LENGTH, len(text))
+    parts = [u'...'] if start > 0 else []
+    position = start
+    for match in matches:
+        if match.end() > end:
+            break
+        parts.append(cgi.escape(text[position:match.start()]))
+        parts.append(u'<b>{0}</b>'.format(cgi.escape(match.group())))
+        position = match.end()
+    parts.append(cgi.escape(text[position:end]))
+    if end < len(text):
+        parts.append(u'...')
+    return u''.join(parts)
+
+class _CompletedFuture(object):
+
+    """Future of a local search backend call that is already complete."""
+
+    def __init__(self, result=None, error=None):
+        """Initialize the future with its result or the error to raise."""
+        self._result = result
+        self._error = error
+
+    def get_result(self):
+        """Return the result of the call or raise its error."""
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class _LocalIndex(object):
+
+    """In-memory inverted index that stands in for search.Index.
+
+    It implements the put, delete, search and get_range methods used by
+    this module with the same semantics as the Search API for global
+    searches of plain terms: the terms of every field are matched case
+    insensitively and all terms of the query must match. Results are
+    ordered from the most recently put document like the default rank.
+
+    Documents are numbered in the order they are put. The posting list of
+    a term is a compact array of the sorted numbers of the documents that
+    contain it. Documents that are replaced or deleted are dropped from the
+    posting lists lazily as they are compacted.
+    """
+
+    def __init__(self, name):
+        """Initialize an empty index.
+
+        Args:
+            name: String name of the index.
+        """
+        self.name = name
+        self._lock = threading.Lock()
+        self._next_number = 0
+        self._documents = {}
+        """Dictionary mapping doc_id to (number, search.Document)."""
+        self._ids = {}
+        """Dictionary mapping live document numbers to doc_id."""
+        self._postings = {}
+        """Dictionary mapping terms to array of sorted document numbers."""
+        self._dead = 0
+
+    def __len__(self):
+        """Return the number of documents in the index."""
+        return len(self._documents)
+
+    def _remove(self, doc_id):
+        """Remove doc_id from the index. The caller holds the lock."""
+        entry = self._documents.pop(doc_id, None)
+        if entry is not None:
+            del self._ids[entry[0]]
+            self._dead += 1
+
+    def _compact(self):
+        """Drop removed documents from the posting lists if worthwhile."""
+        if self._dead <= len(self._ids):
+            return
+        for term in self._postings.keys():
+            numbers = array.array('l', (
+                number for number in self._postings[term]
+                if number in self._ids))
+            if numbers:
+                self._postings[term] = numbers
+            else:
+                del self._postings[term]
+        self._dead = 0
+
+    def put_async(self, documents):
+        """Index documents, replacing those with the same identifiers."""
+        with self._lock:
+            for document in documents:
+                self._remove(document.doc_id)
+                number = self._next_number
+                self._next_number += 1
+                self._documents[document.doc_id] = (number, document)
+                self._ids[number] = document.doc_id
+                terms = set()
+                for field in document.fields:
+                    if isinstance(field.value, basestring):
+                        terms.update(_tokenize(field.value))
+                for term in terms:
+                    numbers = self._postings.get(term)
+                    if numbers is None:
+                        numbers = self._postings[term] = array.array('l')
+                    numbers.append(number)
+            self._compact()
+        return _CompletedFuture([])
+
+    def put(self, documents):
+        """Index documents and return the results."""
+        return self.put_async(documents).get_result()
+
+    def delete_async(self, document_ids):
+        """Remove the documents with identifiers in document_ids."""
+        with self._lock:
+            for doc_id in document_ids:
+                self._remove(doc_id)
+            self._compact()
+        return _CompletedFuture([])
+
+    def delete(self, document_ids):
+        """Remove the documents with identifiers in document_ids."""
+        return self.delete_async(document_ids).get_result()
+
+    def _match(self, query_string):
+        """Return the sorted document numbers that match query_string.
+
+        Raises:
+            search.QueryError if query_string is not made of plain terms.
+        """
+        terms = []
+        for word in query_string.split():
+            if word == 'AND':
+                continue
+            if ((word in ('OR', 'NOT')) or (word[0] in '-~') or
+                any(c in word for c in '"()')):
+                raise search.QueryError(
+                    'Only plain terms are supported by the local index.')
+            terms.extend(_tokenize(word))
+        if not terms:
+            return []
+        postings = []
+        for term in set(terms):
+            numbers = self._postings.get(term)
+            if numbers is None:
+                return []
+            postings.append(numbers)
+        postings.sort(key=len)
+        matches = []
+        for number in postings[0]:
+            if number not in self._ids:
+                continue
+            for numbers in postings[1:]:
+                i = bisect.bisect_left(numbers, number)
+                if (i == len(numbers)) or (numbers[i] != number):
+                    break
+            else:
+                matches.append(number)
+        return matches
+
+    def search_async(self, query):
+        """Search the index for the search.Query query."""
+        if isinstance(query, basestring):
+            query = search.Query(query)
+        options = query.options or search.QueryOptions()
+        try:
+            with self._lock:
+                matches = self._match(query.query_string)
+                # Newest documents first, resuming after the cursor
+                matches.reverse()
+                if (options.cursor is not None) and (
+                    options.cursor.web_safe_string):
+                    last = int(options.cursor.web_safe_string.split(':')[1])
+                    matches = [number for number in matches if number < last]
+                elif options.offset:
+                    matches = matches[options.offset:]
+                page = matches[:options.limit]
+                per_result = (options.cursor is not None) and (
+                    options.cursor.per_result)
+                terms = None
+                if options.snippeted_fields:
+                    terms = set(_tokenize(query.query_string))
+                results = []
+                for number in page:
+                    doc_id = self._ids[number]
+                    fields = None
+                    expressions = None
+                    if not options.ids_only:
+                        fields = self._documents[doc_id][1].fields
+                        if terms is not None:
+                            expressions = [
+                                search.HtmlField(
+                                    name=field.name,
+                                    value=_snippet(field.value, terms))
+                                for field in fields
+                                if field.name in options.snippeted_fields]
+                        if options.returned_fields:
+                            fields = [
+                                field for field in fields
+                                if field.name in options.returned_fields]
+                    cursor = None
+                    if per_result:
+                        cursor = search.Cursor(
+                            web_safe_string='True:{0}'.format(number))
+                    results.append(search.ScoredDocument(
+                        doc_id=doc_id, fields=fields, expressions=expressions,
+                        cursor=cursor))
+        except search.Error as e:
+            return _CompletedFuture(error=e)
+        cursor = None
+        if ((options.cursor is not None) and (not per_result) and
+            (len(matches) > len(page))):
+            cursor = search.Cursor(
+                web_safe_string='False:{0}'.format(page[-1]))
+        return _CompletedFuture(search.SearchResults(
+            number_found=len(matches), results=results, cursor=cursor))
+
+    def search(self, query):
+        """Search the index for the search.Query query."""
+        return self.search_async(query).get_result()
+
+    def get_range(self, start_id=None, include_start_object=True,
+                  limit=100, ids_only=False):
+        """Return the documents in identifier order from start_id."""
+        with self._lock:
+            ids = sorted(self._documents)
+            if start_id is not None:
+                if include_start_object:
+                    i = bisect.bisect_left(ids, start_id)
+                else:
+                    i = bisect.bisect_right(ids, start_id)
+                ids = ids[i:]
+            results = []
+            for doc_id in ids[:limit]:
+                if ids_only:
+                    results.append(search.Document(doc_id=doc_id))
+                else:
+                    results.append(self._documents[doc_id][1])
+        return search.GetResponse(results=results)
+
+_local_indexes = {}
+"""Dictionary mapping index names to their _LocalIndex."""
+
+_local_indexes_lock = threading.Lock()
+"""threading.Lock guarding _local_indexes."""
+
+def _get_backend_index(name):
+    """Return the index named name in the configured search backend.
+
+    Args:
+        name: String name of the index.
+    Returns:
+        search.Index object if the backend is the Search API. _LocalIndex
+        object if the backend is the local in-memory engine.
+    """
+    if _BACKEND == 'local':
+        with _local_indexes_lock:
+            index = _local_indexes.get(name)
+            if index is None:
+                index = _local_indexes[name] = _LocalIndex(name)
+            return index
+    return search.Index(name=name)
+
+### Sharded indexes
+
+def _shard_names(name, shards):
+    """Return the list of the names of the shard indexes of name.
+
+    Args:
+        name: String name of the sharded index.
+        shards: Integer number of shards.
+    Returns:
+        List of string index names. A single shard is the index name itself
+        so that unsharded indexes keep their name.
+    """
+    if shards <= 1:
+        return [name]
+    return ['{0}-shard-{1}-of-{2}'.format(name, i, shards)
+            for i in xrange(0, shards)]
+
+def _shard_of(doc_id, shards):
+    """Return the integer shard of the document identifier doc_id."""
+    return (zlib.crc32(doc_id) & 0xffffffff) % shards
+
+class _FanOutFuture(object):
+
+    """Future combining the futures of calls made to several shards."""
+
+    def __init__(self, futures, combine=None):
+        """Initialize the future.
+
+        Args:
+            futures: List of futures of the calls to the shards.
+            combine: Optional function that takes the list of results of
+                futures and returns the combined result. Defaults to
+                concatenating the lists of results.
+        """
+        self._futures = futures
+        self._combine = combine
+
+    def get_result(self):
+        """Return the combined result or raise the first error.
+
+        A first search.PutError or search.DeleteError is raised with the
+        per-document results of every call, so that the documents of the
+        shards that succeeded are not retried.
+        """
+        results = []
+        errors = []
+        for future in self._futures:
+            try:
+                results.append(future.get_result())
+            except (search.Error, apiproxy_errors.Error) as e:
+                # Wait for every call before raising
+                errors.append(e)
+        if errors:
+            error = errors[0]
+            if isinstance(error, (search.DeleteError, search.PutError)):
+                raise type(error)(str(error), [
+                    result for result in itertools.chain(
+                        itertools.chain.from_iterable(results),
+                        itertools.chain.from_iterable(
+                            getattr(e, 'results', []) for e in errors))
+                    if isinstance(result, search.OperationResult)])
+            raise error
+        if self._combine is not None:
+            return self._combine(results)
+        return sum((list(result) for result in results), [])
+
+class _ShardedIndex(object):
+
+    """Index spreading documents over shard indexes by a hash of doc_id.
+
+    It implements the same subset of search.Index as _LocalIndex. Puts and
+    deletes are split per shard and made concurrently. Searches are made
+    concurrently on every shard and their results merged by taking them
+    from each shard in turn. The web safe cursor of a sharded search
+    combines the cursors of every shard.
+
+    While resharding from previous shards, documents are put in their new
+    shard and deleted from their previous shard, deletes are made on both
+    and searches are made on both and deduplicated.
+    """
+
+    def __init__(self, name, shards, previous=None):
+        """Initialize the index.
+
+        Args:
+            name: String name of the sharded index.
+            shards: Integer number of shards.
+            previous: Optional integer number of shards the documents are
+                being moved from.
+        """
+        self.name = name
+        self.shards = shards
+        self.previous = previous
+        self._indexes = [_get_backend_index(shard_name)
+                         for shard_name in _shard_names(name, shards)]
+        self._previous_indexes = []
+        if previous and (previous != shards):
+            self._previous_indexes = [
+                _get_backend_index(shard_name)
+                for shard_name in _shard_names(name, previous)]
+
+    @staticmethod
+    def _split(items, indexes, key):
+        """Return a dictionary of index position to items in that shard."""
+        shards = collections.defaultdict(list)
+        for item in items:
+            shards[_shard_of(key(item), len(indexes))].append(item)
+        return shards
+
+    def put_async(self, documents):
+        """Put documents in their shards."""
+        documents = list(documents)
+        futures = [self._indexes[i].put_async(shard_documents)
+                   for i, shard_documents in self._split(
+                       documents, self._indexes,
+                       lambda document: document.doc_id).iteritems()]
+        if self._previous_indexes:
+            # Delete the copies that were not moved to the new shards yet
+            ids = [document.doc_id for document in documents]
+            futures.extend(
+                self._previous_indexes[i].delete_async(shard_ids)
+                for i, shard_ids in self._split(
+                    ids, self._previous_indexes,
+                    lambda doc_id: doc_id).iteritems())
+        return _FanOutFuture(futures)
+
+    def delete_async(self, document_ids):
+        """Delete the documents with identifiers in document_ids."""
+        document_ids = list(document_ids)
+        futures = []
+        for indexes in (self._indexes, self._previous_indexes):
+            if indexes:
+                futures.extend(
+                    indexes[i].delete_async(shard_ids)
+                    for i, shard_ids in self._split(
+                        document_ids, indexes,
+                        lambda doc_id: doc_id).iteritems())
+        return _FanOutFuture(futures)
+
+    def search_async(self, query):
+        """Search every shard concurrently and merge the results."""
+        if isinstance(query, basestring):
+            query = search.Query(query)
+        options = query.options or search.QueryOptions()
+        indexes = self._indexes + self._previous_indexes
+        cursors = None
+        if options.cursor is not None:
+            cursors = [''] * len(indexes)
+            if options.cursor.web_safe_string:
+                try:
+                    cursors = json.loads(base64.urlsafe_b64decode(
+                        options.cursor.web_safe_string.split(':', 1)[1]
+                        .encode('ascii')))
+                except (TypeError, ValueError):
+                    raise ValueError('invalid format for web_safe_string')
+                if len(cursors) != len(indexes):
+                    raise ValueError('cursor is for another shard layout')
+
+        futures = []
+        for i, index in enumerate(indexes):
+            shard_options = options
+            if cursors is not None:
+                if cursors[i] is None:
+                    futures.append(None)
+                    continue
+                shard_options = search.QueryOptions(
+                    limit=options.limit,
+                    cursor=search.Cursor(web_safe_string=cursors[i] or None,
+                                         per_result=True),
+                    ids_only=options.ids_only,
+                    returned_fields=options.returned_fields,
+                    snippeted_fields=options.snippeted_fields,
+                    returned_expressions=options.returned_expressions)
+            futures.append(index.search_async(
+                search.Query(query.query_string, options=shard_options)))
+
+        def combine(results):
+            return self._merge(results, options.limit, cursors)
+        return _FanOutFuture(
+            [future for future in futures if future is not None],
+            lambda results: combine(self._align(futures, results)))
+
+    @staticmethod
+    def _align(futures, results):
+        """Return results with None for the shards that were not searched."""
+        results = iter(results)
+        return [None if future is None else next(results)
+                for future in futures]
+
+    def _merge(self, results, limit, cursors):
+        """Merge the search results of the shards up to limit.
+
+        Args:
+            results: List of search.SearchResults object per shard or None
+                if the shard was exhausted.
+            limit: Integer maximum number of results.
+            cursors: List of string web safe cursors per shard or None if
+                no cursor was requested.
+        Returns:
+            search.SearchResults object of the merged results.
+        """
+        merged = []
+        seen = set()
+        consumed = [0] * len(results)
+        pending = [list(result.results) if result is not None else []
+                   for result in results]
+        while len(merged) < limit and any(pending):
+            for i, shard_results in enumerate(pending):
+                if shard_results and (len(merged) < limit):
+                    document = shard_results.pop(0)
+                    consumed[i] += 1
+                    if document.doc_id not in seen:
+                        seen.add(document.doc_id)
+                        merged.append(document)
+
+        cursor = None
+        if cursors is not None:
+            next_cursors = []
+            for i, result in enumerate(results):
+                if result is None:
+                    next_cursors.append(None)
+                elif pending[i]:
+                    next_cursors.append(
+                        result.results[consumed[i] - 1].cursor.web_safe_string
+                        if consumed[i] else cursors[i])
+                elif len(result.results) < limit:
+                    next_cursors.append(None)
+                else:
+                    next_cursors.append(
+                        result.results[-1].cursor.web_safe_string)
+            if any(value is not None for value in next_cursors):
+                cursor = search.Cursor(web_safe_string='False:' +
+                                       base64.urlsafe_b64encode(
+                                           json.dumps(next_cursors)))
+        return search.SearchResults(
+            number_found=sum(result.number_found for result in results
+                             if result is not None),
+            results=merged, cursor=cursor)
+
+    def search(self, query):
+        """Search every shard and merge the results."""
+        return self.search_async(query).get_result()
+
+    def get_range(self, start_id=None, include_start_object=True,
+                  limit=100, ids_only=False):
+        """Return the documents of every shard in identifier order."""
+        responses = [index.get_range(
+            start_id=start_id, include_start_object=include_start_object,
+            limit=limit, ids_only=ids_only)
+                     for index in self._indexes + self._previous_indexes]
+        documents = {}
+        for response in responses:
+            for document in response:
+                documents.setdefault(document.doc_id, document)
+        return search.GetResponse(results=[
+            documents[doc_id] for doc_id in sorted(documents)[:limit]])
+
+def _get_index(name):
+    """Return the index named name with the configured shards.
+
+    Args:
+        name: String name of the index.
+    Returns:
+        _ShardedIndex object if there is more than one shard or documents
+        are being resharded. The index from _get_backend_index otherwise.
+    """
+    if (_SHARDS <= 1) and (not _PREVIOUS_SHARDS):
+        return _get_backend_index(name)
+    return _ShardedIndex(name, _SHARDS, _PREVIOUS_SHARDS)
+
+def _reshard(name, previous, shards, start_id=None, limit=_BATCH_SIZE):
+    """Move up to limit documents from previous shards to shards.
+
+    Documents are read in identifier order from the previous shards, put in
+    their new shard and then deleted from their previous shard, so they can
+    be searched throughout. Documents that failed to be put stay in their
+    previous shard, and documents that failed to be deleted from it are
+    not moved yet either. Call repeatedly with the returned checkpoint
+    until it is None.
+
+    Args:
+        name: String name of the sharded index.
+        previous: Integer number of shards to move the documents from.
+        shards: Integer number of shards to move the documents to.
+        start_id: Optional string document identifier checkpoint returned
+            by the previous call. Defaults to the first document.
+        limit: Optional integer maximum number of documents to move.
+    Returns:
+        Tuple of the integer number of documents moved, the integer number
+        of documents that failed to be moved and the string document
+        identifier to resume from. The checkpoint is None once every
+        document was read. If a document failed, the checkpoint is before
+        it so that it is moved on the next call.
+    Raises:
+        _BudgetExceededError if the write budget did not become available
+            in time to move the documents.
+    """
+    if previous == shards:
+        return 0, 0, None
+    source = _ShardedIndex(name, previous)
+    target = _ShardedIndex(name, shards)
+    documents = list(source.get_range(
+        start_id=start_id, include_start_object=False, limit=limit))
+    if not documents:
+        return 0, 0, None
+    moved = set()
+    _put(target, documents, lambda batch: moved.update(
+        document.doc_id for document in batch))
+    ids = [document.doc_id for document in documents
+           if document.doc_id in moved]
+    deleted = set()
+    if ids:
+        # Delete from the previous shards without forgetting the digests
+        _dispatch('delete', source.delete_async, ids, deleted.update,
+                  _tenants.budget(name))
+    checkpoint = start_id
+    for document in documents:
+        if document.doc_id not in deleted:
+            break
+        checkpoint = document.doc_id
+    return len(deleted), len(documents) - len(deleted), checkpoint
+
+### Typeahead prefix index
+
+_PREFIX_INDEX_SIZE = 100000
+"""Integer maximum number of documents per prefix index."""
+
+_PREFIX_MEMO_SIZE = 10000
+"""Integer maximum number of prefix query results to keep per index."""
+
+_SUGGEST_LIMIT = 10
+"""Integer default number of document identifiers per suggestion."""
+
+_MAX_SUGGEST_LIMIT = 100
+"""Integer maximum number of document identifiers per suggestion."""
+
+class _PrefixIndex(object):
+
+    """In-memory index of the terms of documents for prefix queries.
+
+    The terms of the full text field of every document put through this
+    instance are kept in a sorted array, so that the terms starting with a
+    prefix are a contiguous range found by bisection. Each term maps to the
+    documents that contain it and their write sequence number, so that the
+    most recently written documents come first.
+
+    The top documents of every prefix that was queried are precomputed and
+    kept up to date as documents are put, so that successive keystrokes are
+    answered without scanning the terms. Removing a document drops the top
+    documents of its prefixes, which are computed again when next queried.
+
+    The index only knows about the writes made by this instance and
+    forgets the oldest documents beyond size.
+    """
+
+    def __init__(self, size=_PREFIX_INDEX_SIZE, memo_size=_PREFIX_MEMO_SIZE):
+        """Initialize an empty index.
+
+        Args:
+            size: Optional integer maximum number of documents.
+            memo_size: Optional integer maximum number of prefixes and
+                queries to keep the top documents of.
+        """
+        self._size = size
+        self._memo_size = memo_size
+        self._lock = threading.Lock()
+        self._sequence = 0
+        # Document identifier to its sequence number and terms, oldest first
+        self._documents = collections.OrderedDict()
+        self._terms = []
+        self._postings = {}
+        # Prefix to its top document identifiers, least recently used first
+        self._top = collections.OrderedDict()
+        # Queries of several words to their top document identifiers
+        self._memo = collections.OrderedDict()
+
+    def __len__(self):
+        """Return the integer number of documents in the index."""
+        return len(self._documents)
+
+    def _remove(self, doc_id):
+        """Remove the document doc_id with the lock held."""
+        entry = self._documents.pop(doc_id, None)
+        if entry is None:
+            return
+        for term in entry[1]:
+            for length in xrange(1, len(term) + 1):
+                self._top.pop(term[:length], None)
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+
+    def update(self, documents):
+        """Add the full text field of documents to the index.
+
+        Args:
+            documents: List of search.Document objects that were put.
+        """
+        with self._lock:
+            self._memo.clear()
+            for document in documents:
+                doc_id = document.doc_id
+                self._remove(doc_id)
+                terms = set()
+                for field in document.fields:
+                    if field.name == _FIELD_NAME:
+                        terms.update(_tokenize(field.value or u''))
+                self._sequence += 1
+                self._documents[doc_id] = (self._sequence, tuple(terms))
+                for term in terms:
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = {}
+                        bisect.insort(self._terms, term)
+                    postings[doc_id] = self._sequence
+                    # The newest document comes first in every prefix
+                    for length in xrange(1, len(term) + 1):
+                        top = self._top.get(term[:length])
+                        if (top is not None) and (
+                            (not top) or (top[0] != doc_id)):
+                            top.insert(0, doc_id)
+                            del top[_MAX_SUGGEST_LIMIT:]
+            while len(self._documents) > self._size:
+                self._remove(next(iter(self._documents)))
+
+    def remove(self, ids):
+        """Remove the documents with identifiers in ids from the index."""
+        with self._lock:
+            self._memo.clear()
+            for doc_id in ids:
+                self._remove(doc_id)
+
+    def _match(self, prefix):
+        """Return a dictionary of the documents with a term with prefix."""
+        start = bisect.bisect_left(self._terms, prefix)
+        end = bisect.bisect_left(self._terms, prefix + u'\uffff', start)
+        if end - start == 1:
+            return self._postings[self._terms[start]]
+        matches = {}
+        for term in self._terms[start:end]:
+            matches.update(self._postings[term])
+        return matches
+
+    @staticmethod
+    def _newest(matches):
+        """Return the list of the newest document identifiers in matches."""
+        return [doc_id for _, doc_id in heapq.nlargest(
+            _MAX_SUGGEST_LIMIT, ((sequence, doc_id) for doc_id, sequence
+                                 in matches.iteritems()))]
+
+    @staticmethod
+    def _lookup(memo, key, size, compute):
+        """Return the value of key in the LRU dictionary memo."""
+        value = memo.pop(key, None)
+        if value is None:
+            value = compute()
+        memo[key] = value
+        while len(memo) > size:
+            memo.popitem(last=False)
+        return value
+
+    def suggest(self, query, limit=_SUGGEST_LIMIT):
+        """Return the documents with a term starting with each word of query.
+
+        Args:
+            query: String partial search query. Every word is a prefix.
+            limit: Optional integer maximum number of document identifiers
+                up to _MAX_SUGGEST_LIMIT.
+        Returns:
+            List of up to limit string document identifiers, most recently
+            written first.
+        """
+        prefixes = tuple(sorted(set(_tokenize(query)), key=len,
+                                reverse=True))
+        if not prefixes:
+            return []
+        with self._lock:
+            if len(prefixes) == 1:
+                top = self._lookup(
+                    self._top, prefixes[0], self._memo_size,
+                    lambda: self._newest(self._match(prefixes[0])))
+                return top[:limit]
+
+            def intersect():
+                # Start from the longest prefix, likely the rarest
+                matches = self._match(prefixes[0])
+                for prefix in prefixes[1:]:
+                    if not matches:
+                        break
+                    documents = self._match(prefix)
+                    matches = dict(
+                        (doc_id, sequence)
+                        for doc_id, sequence in matches.iteritems()
+                        if doc_id in documents)
+                return self._newest(matches)
+            top = self._lookup(self._memo, prefixes, self._memo_size,
+                               intersect)
+            return top[:limit]
+
+_prefix_indexes = {}
+"""Dictionary mapping index names to their _PrefixIndex."""
+
+_prefix_indexes_lock = threading.Lock()
+"""threading.Lock guarding _prefix_indexes."""
+
+def _get_prefix_index(name):
+    """Return the _PrefixIndex of the index named name."""
+    with _prefix_indexes_lock:
+        index = _prefix_indexes.get(name)
+        if index is None:
+            index = _prefix_indexes[name] = _PrefixIndex()
+        return index
+
+### Write-behind queue
+
+_WRITE_DELAY = 1
+"""Integer number of seconds a write waits to be flushed with others."""
+
+_WRITE_QUEUE = 'write-behind'
+"""String name of the push queue the write-behind tasks run in."""
+
+_WRITE_TASK_SIZE = _MAX_IN_FLIGHT * _BATCH_SIZE
+"""Integer maximum number of writes flushed by one write-behind task."""
+
+_WRITE_MAX_CHECKS = 10
+"""Integer maximum number of tasks added for writes no query sees yet."""
+
+class _PendingWrite(ndb.Model):
+
+    """Put or delete of a document waiting in the write-behind queue.
+
+    The key identifier is the index name and the document identifier
+    separated by a space, which neither may contain, so a later write of a
+    document replaces its pending write.
+
+    Attributes:
+        index: String name of the index to write to.
+        doc_id: String document identifier.
+        job: String identifier of the job of the write.
+        text: String text of the document to put or None to delete it.
+        enqueued: Float time at which the write was enqueued.
+    """
+
+    index = ndb.StringProperty(required=True)
+    doc_id = ndb.StringProperty(required=True, indexed=False)
+    job = ndb.StringProperty(required=True, indexed=False)
+    text = ndb.TextProperty()
+    enqueued = ndb.FloatProperty(required=True)
+
+    @classmethod
+    def key_for(cls, index_name, doc_id):
+        """Return the ndb.Key of the pending write of doc_id."""
+        return ndb.Key(cls, '{0} {1}'.format(index_name, doc_id))
+
+class _WriteJob(ndb.Model):
+
+    """Progress of a job of the write-behind queue.
+
+    Attributes:
+        index: String name of the index the job writes to.
+        total: Integer number of writes of the job.
+        written: Integer number of writes that succeeded.
+        failed: Integer number of writes that failed.
+        superseded: Integer number of writes replaced by a later write of
+            the same document before they were flushed.
+    """
+
+    index = ndb.StringProperty(required=True, indexed=False)
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    written = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    superseded = ndb.IntegerProperty(default=0, indexed=False)
+
+    @property
+    def pending(self):
+        """Integer number of writes of the job that are still pending."""
+        return self.total - self.written - self.failed - self.superseded
+
+@ndb.transactional
+def _count_writes(job_id, outcomes):
+    """Add the number of writes of job_id per outcome to its progress.
+
+    Args:
+        job_id: String job identifier.
+        outcomes: Dictionary mapping 'written', 'failed' or 'superseded' to
+            the integer number of writes with that outcome.
+    """
+    job = _WriteJob.get_by_id(job_id)
+    if job is not None:
+        for outcome, count in outcomes.iteritems():
+            setattr(job, outcome, getattr(job, outcome) + count)
+        job.put()
+
+@ndb.transactional_tasklet
+def _remove_write(key, job_id):
+    """Delete the pending write key if it is still the write of job_id.
+
+    Returns:
+        ndb.Future of True if the write was deleted. False if it was
+        replaced by a later write or deleted already.
+    """
+    write = yield key.get_async()
+    if (write is None) or (write.job != job_id):
+        raise ndb.Return(False)
+    yield key.delete_async()
+    raise ndb.Return(True)
+
+@ndb.transactional_tasklet
+def _replace_write(write):
+    """Put write in place of the pending write of the same document.
+
+    Returns:
+        ndb.Future of the string identifier of the job of the replaced
+        write or None if the document had no pending write.
+    """
+    previous = yield write.key.get_async()
+    yield write.put_async()
+    raise ndb.Return(None if previous is None else previous.job)
+
+def _schedule_flush(index_name, job_id, countdown=_WRITE_DELAY, checks=0):
+    """Add a task flushing the pending writes of index_name for job_id.
+
+    Args:
+        index_name: String name of the index.
+        job_id: String identifier of the job whose writes to flush.
+        countdown: Optional number of seconds to wait before running the
+            task. Defaults to _WRITE_DELAY.
+        checks: Optional number of tasks added before for writes of the
+            job the query did not see. Defaults to 0.
+    """
+    deferred.defer(_flush_writes, index_name, job_id, checks,
+                   _countdown=countdown, _queue=_WRITE_QUEUE)
+
+def _flush_writes(index_name, job_id, checks=0):
+    """Write the oldest pending writes of index_name until job_id is done.
+
+    This runs in a task of the write-behind queue. Up to _WRITE_TASK_SIZE
+    writes of any job are flushed with _put and _delete, so the writes
+    enqueued together are flushed together and the task of a job whose
+    writes were flushed by another task has nothing left to do. Writes
+    deferred by the write budget stay pending until the budget becomes
+    available. A write flushed by overlapping tasks is only counted once.
+
+    The pending writes are found with a query, which may not see the most
+    recent writes yet, so the progress of the job is read by key and
+    another task is added while the job has pending writes, up to
+    _WRITE_MAX_CHECKS times in a row.
+
+    Args:
+        index_name: String name of the index.
+        job_id: String identifier of the job whose writes to flush.
+        checks: Optional number of tasks added before for writes of the
+            job the query did not see. Defaults to 0.
+    """
+    job = _WriteJob.get_by_id(job_id)
+    if (job is None) or (job.pending <= 0):
+        return
+    writes = _PendingWrite.query(_PendingWrite.index == index_name).order(
+        _PendingWrite.enqueued).fetch(_WRITE_TASK_SIZE)
+
+    search_index = _get_index(index_name)
+    done = set()
+
+    def on_success(batch):
+        done.update(getattr(item, 'doc_id', item) for item in batch)
+
+    retry_after = None
+    try:
+        documents = [_make_document(write.doc_id, write.text)
+                     for write in writes if write.text is not None]
+        if documents:
+            _put(search_index, documents, on_success)
+        ids = [write.doc_id for write in writes if write.text is None]
+        if ids:
+            _delete(search_index, ids, on_success)
+    except _BudgetExceededError as e:
+        retry_after = e.retry_after
+
+    finished = [write for write in writes
+                if (write.doc_id in done) or (retry_after is None)]
+    futures = [_remove_write(write.key, write.job) for write in finished]
+    outcomes = collections.defaultdict(collections.Counter)
+    for write, future in zip(finished, futures):
+        if future.get_result():
+            outcome = 'written' if write.doc_id in done else 'failed'
+            outcomes[write.job][outcome] += 1
+    for counted_job_id, counts in outcomes.iteritems():
+        _count_writes(counted_job_id, counts)
+
+    if retry_after is not None:
+        _schedule_flush(index_name, job_id, retry_after)
+    elif len(writes) >= _WRITE_TASK_SIZE:
+        _schedule_flush(index_name, job_id, 0)
+    elif _WriteJob.get_by_id(job_id, use_cache=False).pending > 0:
+        # The query did not see every write of the job yet
+        if checks < _WRITE_MAX_CHECKS:
+            _schedule_flush(index_name, job_id, checks=checks + 1)
+        else:
+            logging.error('Job %s has writes no query returns.', job_id)
+
+class _TaskWriteQueue(object):
+
+    """Durable write-behind queue of puts and deletes.
+
+    Pending writes are _PendingWrite entities in the datastore, kept per
+    index in the order they were enqueued. A write replaces any pending
+    write of the same document in a transaction, so the last put wins, a
+    delete cancels the puts before it and every replaced write is counted
+    as superseded exactly once. Every enqueue is a job whose progress is reported
+    by status and whose writes are flushed by _flush_writes in tasks of the
+    _WRITE_QUEUE push queue. Writes therefore survive the instance that
+    accepted them and are retried with the task if the instance flushing
+    them fails.
+    """
+
+    def enqueue(self, index_name, documents=(), ids=()):
+        """Add a job writing documents and deleting ids to the queue.
+
+        Args:
+            index_name: String name of the index to write to.
+            documents: Optional iterable of search.Document objects to put.
+            ids: Optional iterable of string document identifiers to delete.
+        Returns:
+            String identifier of the job or None if the writes could not be
+            persisted.
+        """
+        writes = collections.OrderedDict()
+        total = 0
+        for document in documents:
+            writes.pop(document.doc_id, None)
+            writes[document.doc_id] = _document_text(document)
+            total += 1
+        for doc_id in ids:
+            writes.pop(doc_id, None)
+            writes[doc_id] = None
+            total += 1
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        try:
+            # The job exists before its writes can be superseded, and writes
+            # of the same document within the job supersede each other
+            _WriteJob(id=job_id, index=index_name, total=total,
+                      superseded=total - len(writes)).put()
+        except (apiproxy_errors.Error, datastore_errors.Error):
+            logging.exception('Unable to enqueue the writes.')
+            return None
+        futures = [_replace_write(_PendingWrite(
+            key=_PendingWrite.key_for(index_name, doc_id), index=index_name,
+            doc_id=doc_id, job=job_id, text=text, enqueued=now))
+                   for doc_id, text in writes.iteritems()]
+        superseded = collections.Counter()
+        failed = 0
+        for future in futures:
+            try:
+                previous_job = future.get_result()
+            except (apiproxy_errors.Error, datastore_errors.Error):
+                failed += 1
+                continue
+            if previous_job is not None:
+                superseded[previous_job] += 1
+        try:
+            for previous_job, count in superseded.iteritems():
+                _count_writes(previous_job, {'superseded': count})
+            # The writes that were persisted are flushed in any case
+            _schedule_flush(index_name, job_id)
+            if failed:
+                _count_writes(job_id, {'failed': failed})
+        except (apiproxy_errors.Error, datastore_errors.Error,
+                taskqueue.Error):
+            logging.exception('Unable to enqueue the writes.')
+            return None
+        if failed:
+            logging.error('Unable to enqueue %d writes of job %s.', failed,
+                          job_id)
+            return None
+        return job_id
+
+    def status(self, job_id):
+        """Return a dictionary of the progress of job_id or None."""
+        job = _WriteJob.get_by_id(job_id)
+        if job is None:
+            return None
+        status = job.to_dict()
+        status['pending'] = job.pending
+        status['state'] = 'done' if status['pending'] <= 0 else 'pending'
+        return status
+
+_write_queue = _TaskWriteQueue()
+"""_TaskWriteQueue of the writes accepted asynchronously."""
+
+### Tenants
+
+class _Tenant(object):
+
+    """Credentials, search index and write budget of a tenant.
+
+    Attributes:
+        name: String username of the tenant.
+        password: String expected password of the tenant.
+        index_name: String name of the search index of the tenant.
+        budget: _WriteBudget of the documents the tenant puts/deletes.
+    """
+
+    def __init__(self, name, password, index_name, budget):
+        self.name = name
+        self.password = password
+        self.index_name = index_name
+        self.budget = budget
+        self._index = None
+
+    @property
+    def index(self):
+        """Return the search index of the tenant, created once."""
+        # Creating the index twice when racing is harmless
+        if self._index is None:
+            self._index = _get_index(self.index_name)
+        return self._index
+
+def _parse_tenants(config):
+    """Return the tenants configured in config.
+
+    Args:
+        config: String JSON object mapping usernames to objects with their
+            'password' and optionally their 'index' name and their write
+            budget 'limit'.
+    Returns:
+        Dictionary mapping string usernames to their _Tenant.
+    Raises:
+        ValueError if config is not a valid tenant configuration.
+    """
+    entries = json.loads(config)
+    if not isinstance(entries, dict):
+        raise ValueError('tenants must be a JSON object.')
+    tenants = {}
+    index_names = set()
+    for name, entry in entries.iteritems():
+        if not isinstance(entry, dict):
+            raise ValueError('tenant {0} must be a JSON object.'.format(name))
+        password = entry.get('password')
+        index_name = entry.get('index', name)
+        limit = entry.get('limit', _SAFETY_LIMIT)
+        if not (isinstance(password, basestring) and password):
+            raise ValueError('tenant {0} has no password.'.format(name))
+        try:
+            index_name = index_name.encode('ascii')
+        except (AttributeError, UnicodeError):
+            raise ValueError('tenant {0} has an invalid index.'.format(name))
+        # Index names follow the rules of document identifiers
+        if ((not _is_valid_doc_id(index_name)) or
+            (len(index_name) > search.MAXIMUM_INDEX_NAME_LENGTH) or
+            (index_name in index_names)):
+            raise ValueError('tenant {0} has an invalid index.'.format(name))
+        if ((not isinstance(limit, int)) or isinstance(limit, bool) or
+            (not (0 < limit <= _SAFETY_LIMIT))):
+            raise ValueError('tenant {0} has an invalid limit.'.format(name))
+        index_names.add(index_name)
+        name = name.encode('utf-8')
+        tenants[name] = _Tenant(name, password.encode('utf-8'), index_name,
+                                _WriteBudget(limit, shared=_write_budget))
+    return tenants
+
+class _TenantRegistry(object):
+
+    """Tenants that may authenticate, loaded once from the configuration.
+
+    Without BASIC_AUTH_TENANTS the only tenant is BASIC_AUTH_USERNAME with
+    BASIC_AUTH_PASSWORD, whose index is named after the username and which
+    uses the shared _write_budget. An invalid configuration is logged and
+    no tenant may authenticate.
+    """
+
+    def __init__(self):
+        """Initialize without loading the tenants."""
+        self._lock = threading.Lock()
+        self._tenants = None
+        self._indexes = None
+
+    def clear(self):
+        """Forget the tenants so that they are loaded again when needed."""
+        with self._lock:
+            self._tenants = None
+            self._indexes = None
+
+    def _load(self):
+        """Return the tenants and their index names, loading them once."""
+        with self._lock:
+            if self._tenants is None:
+                tenants = {}
+                if _TENANTS:
+                    try:
+                        tenants = _parse_tenants(_TENANTS)
+                    except ValueError:
+                        logging.exception(
+                            'Invalid BASIC_AUTH_TENANTS configuration.')
+                elif (isinstance(_USERNAME, basestring) and
+                      isinstance(_PASSWORD, basestring)):
+                    tenants[_USERNAME] = _Tenant(_USERNAME, _PASSWORD,
+                                                 _USERNAME, _write_budget)
+                self._tenants = tenants
+                self._indexes = dict((tenant.index_name, tenant)
+                                     for tenant in tenants.itervalues())
+            return self._tenants, self._indexes
+
+    def authenticate(self, username, password):
+        """Return the tenant with the credentials or None.
+
+        Passwords are compared in constant time, and so are those of
+        unknown usernames, so that response times do not reveal them.
+
+        Args:
+            username: String username.
+            password: String password.
+        Returns:
+            _Tenant object if the password of username is password. None
+            otherwise.
+        """
+        if not (isinstance(username, basestring) and
+                isinstance(password, basestring)):
+            return None
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        tenant = self._load()[0].get(username)
+        expected = password if tenant is None else tenant.password
+        if hmac.compare_digest(expected, password) and (tenant is not None):
+            return tenant
+        return None
+
+    def tenants(self):
+        """Return the list of every tenant."""
+        return self._load()[0].values()
+
+    def for_index(self, index_name):
+        """Return the tenant of the index named index_name or None."""
+        return self._load()[1].get(index_name)
+
+    def budget(self, index_name):
+        """Return the _WriteBudget of the index named index_name.
+
+        Indexes of no tenant, like reindex targets, use _write_budget.
+        """
+        tenant = self.for_index(index_name)
+        return _write_budget if tenant is None else tenant.budget
+
+_tenants = _TenantRegistry()
+"""_TenantRegistry of the tenants served by this instance."""
+
+### Warmup
+
+def _warmup_queries():
+    """Return the list of the queries to prime the cache with.
+
+    Invalid SEARCH_WARMUP_QUERIES configurations are logged and ignored.
+    """
+    if not _WARMUP_QUERIES:
+        return []
+    try:
+        queries = json.loads(_WARMUP_QUERIES)
+    except ValueError:
+        queries = None
+    if (not isinstance(queries, list)) or (
+        not all(isinstance(query, basestring) for query in queries)):
+        logging.error('Invalid SEARCH_WARMUP_QUERIES configuration.')
+        return []
+    return queries
+
+def _warmup():
+    """Prepare this instance to serve its first requests quickly.
+
+    The validators and the Search API query parser are run once, the index
+    of every tenant is created and a first Search API call is made to each,
+    either by searching for the warmup queries to prime the search result
+    cache or by reading a single document identifier.
+
+    Returns:
+        collections.OrderedDict mapping the string name of every warmup
+        stage to the float number of seconds it took.
+    """
+    stages = collections.OrderedDict()
+    start = time.time()
+    _is_valid_doc_id('warmup')
+    _make_document('warmup', u'warmup')
+    search.Query(query_string=_normalize_query(u'warmup'))
+    stages['validators'] = time.time() - start
+
+    start = time.time()
+    indexes = [tenant.index for tenant in _tenants.tenants()]
+    stages['indexes'] = time.time() - start
+
+    start = time.time()
+    queries = _warmup_queries()
+    for search_index in indexes:
+        try:
+            if queries:
+                for query in queries:
+                    _search(search_index, query)
+            else:
+                search_index.get_range(limit=1, ids_only=True)
+        except (search.Error, apiproxy_errors.Error,
+                _BudgetExceededError, _FlightTimeoutError):
+            logging.exception('Unable to warm up search index.')
+    stages['queries' if queries else 'connect'] = time.time() - start
+    return stages
+
+class _Startup(object):
+
+    """Cost of starting this instance and of its first request.
+
+    Warming up runs at most once per instance, normally from the App
+    Engine warmup request that is sent before the instance gets traffic.
+    """
+
+    def __init__(self):
+        """Initialize before the module finished loading."""
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self.initialization = None
+        """Float number of seconds loading the module took after imports."""
+        self.warmup = None
+        """collections.OrderedDict of the seconds of the warmup stages."""
+        self.first_request = None
+        """Float number of seconds the first request took to be served."""
+
+    def initialized(self):
+        """Record that the module finished loading and log the cost."""
+        self.initialization = time.time() - _IMPORT_START - _IMPORT_SECONDS
+        logging.info('Imported packages in {0:.3f}s and initialized in '
+                     '{1:.3f}s.'.format(_IMPORT_SECONDS, self.initialization))
+
+    def warm(self):
+        """Warm up this instance unless it already was.
+
+        Returns:
+            Dictionary of the startup report as returned by report.
+        """
+        with self._warm_lock:
+            if self.warmup is None:
+                self.warmup = _warmup()
+                logging.info('Warmed up in {0:.3f}s.'.format(
+                    sum(self.warmup.itervalues())))
+        return self.report()
+
+    def record_request(self, seconds):
+        """Record seconds as the latency of the first request if it is."""
+        with self._lock:
+            if self.first_request is None:
+                self.first_request = seconds
+
+    def report(self):
+        """Return a dictionary of the seconds spent starting this instance.
+
+        The seconds spent importing the third party packages are 'imports',
+        loading the rest of the module 'initialization', in each warmup
+        stage 'warmup' and serving the first request 'first_request'. The
+        latter two are None until they happened.
+        """
+        with self._lock:
+            return {
+                'first_request': self.first_request,
+                'imports': _IMPORT_SECONDS,
+                'initialization': self.initialization,
+                'warmup': self.warmup and dict(self.warmup)
+            }
+
+_startup = _Startup()
+"""_Startup of this instance."""
+
+### Profiling
+
+_PROFILE_HEADER = 'X-Profile'
+"""String name of the request header asking for the request profile."""
+
+_PROFILE_RING_SIZE = 20
+"""Integer maximum number of recent profiles kept by this instance."""
+
+_PROFILE_FORMATS = frozenset(['collapsed', 'pstats'])
+"""Frozen set of the string names of the formats profiles are served in."""
+
+def _function_name(function):
+    """Return the string name of the pstats function key function."""
+    filename, line, name = function
+    if filename == '~':
+        # Built-in functions have no source
+        return name
+    return '{0}:{1}({2})'.format(os.path.basename(filename), line, name)
+
+def _collapse_stats(stats):
+    """Return profile statistics as collapsed stacks one caller deep.
+
+    cProfile records the time spent in every function per caller rather
+    than whole stacks, so every line is the caller and the function
+    separated by ';' and then the microseconds spent in the function
+    itself when called from there. Functions without a caller are on
+    their own. Flame graph tools read this format.
+
+    Args:
+        stats: Dictionary of the statistics of a cProfile.Profile object.
+    Returns:
+        String collapsed stacks, one per line.
+    """
+    lines = []
+    for function, (_, _, tottime, _, callers) in sorted(stats.iteritems()):
+        name = _function_name(function)
+        if not callers:
+            callers = {None: (0, 0, tottime, 0)}
+        for caller, (_, _, caller_tottime, _) in sorted(callers.iteritems()):
+            microseconds = int(round(caller_tottime * 1000000))
+            if microseconds <= 0:
+                continue
+            stack = name
+            if caller is not None:
+                stack = '{0};{1}'.format(_function_name(caller), name)
+            lines.append('{0} {1}\n'.format(stack, microseconds))
+    return ''.join(lines)
+
+class _ProfileRing(object):
+
+    """Bounded ring of the profiles of recent requests.
+
+    The oldest profile is dropped once the ring is full. Profiles are only
+    listed and served to the tenant whose request was profiled.
+    """
+
+    def __init__(self, size=_PROFILE_RING_SIZE):
+        """Initialize an empty ring.
+
+        Args:
+            size: Optional integer maximum number of profiles kept.
+        """
+        self._lock = threading.Lock()
+        self._profiles = collections.deque(maxlen=size)
+
+    def clear(self):
+        """Drop every profile."""
+        with self._lock:
+            self._profiles.clear()
+
+    def add(self, profile_id, tenant, request, seconds, stats):
+        """Keep the profile of a request, dropping the oldest if full.
+
+        Args:
+            profile_id: String identifier of the profile.
+            tenant: String name of the tenant that made the request.
+            request: flask.Request object of the profiled request.
+            seconds: Float number of seconds the request took.
+            stats: Dictionary of the statistics of the cProfile.Profile
+                object that profiled the request.
+        """
+        summary = {
+            'endpoint': request.endpoint,
+            'id': profile_id,
+            'method': request.method,
+            'path': request.path,
+            'seconds': seconds,
+            'time': time.time()
+        }
+        with self._lock:
+            self._profiles.append((tenant, summary, stats))
+
+    def summaries(self, tenant):
+        """Return the list of the summaries of the profiles of tenant.
+
+        Every summary is a dictionary of the profile identifier as 'id',
+        the endpoint, method and path of the request, the seconds it took
+        and the time it finished. The newest profile comes first.
+        """
+        with self._lock:
+            return [dict(summary)
+                    for profile_tenant, summary, _ in reversed(self._profiles)
+                    if profile_tenant == tenant]
+
+    def stats(self, tenant, profile_id):
+        """Return the statistics of a profile of tenant or None."""
+        with self._lock:
+            for profile_tenant, summary, stats in self._profiles:
+                if (profile_tenant == tenant) and (
+                    summary['id'] == profile_id):
+                    return stats
+        return None
+
+_profiles = _ProfileRing()
+"""_ProfileRing of the profiles of this instance."""
+
+### WSGI application
 
-_BATCH_SIZE = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
-"""Integer maximum number of documents the index can handle per request."""
+_NDJSON_MIMETYPE = 'application/x-ndjson'
+"""String MIME type of newline delimited JSON request bodies."""
 
-# Search API imposes this limit to ensure the reliability of the service
-_SAFETY_LIMIT = 15000
-"""Integer maximum number of documents that can be put/deleted per minute."""
+_MAX_QUERIES = 100
+"""Integer maximum number of search queries in a batch search request."""
 
-_VISIBLE_PRINTABLE_ASCII = frozenset(
-    set(string.printable) - set(string.whitespace))
-"""frozenset of valid ASCII characters for the document identifier."""
+_COMPRESS_THRESHOLD = 1024
+"""Integer minimum number of bytes of a response body to compress."""
 
-# Field names are case sensitive and can only contain ASCII characters.
-# They must start with a letter and can contain letters, digits, or
-# underscores. A field name cannot be longer than 500 characters.
-_FIELD_NAME = 't'
-"""String default field name for the text in a document."""
+_COMPRESS_LEVEL = 6
+"""Integer zlib compression level of compressed response bodies."""
 
-def _is_valid_doc_id(doc_id):
-    """Return True if doc_id is a valid ASCII document identifier.
+def get_search_index():
+    """Return the search index of the authenticated tenant or None.
 
-    A doc_id must contain only visible, printable ASCII characters (ASCII
-    codes 33 through 126 inclusive) and be no longer than 500 characters.
-    A document identifier cannot begin with an exclamation point ('!'), and
-    it can't begin and end with double underscores ("__").
+    The tenant is remembered as flask.g.tenant for the request metrics.
+    """
+    # HTTP basic authentication
+    if flask.request.authorization is None:
+        return None
+    tenant = _tenants.authenticate(flask.request.authorization.username,
+                                   flask.request.authorization.password)
+    if tenant is None:
+        return None
+    flask.g.tenant = tenant
+    return tenant.index
+
+def _iter_json_array(values):
+    """Yield the chunks of a JSON array of values.
 
     Args:
-        doc_id: String ASCII document identifier to test.
+        values: Iterable of JSON serializable values.
+    Yields:
+        String chunks that together form the JSON array of values.
+    """
+    yield '['
+    separator = ''
+    for value in values:
+        yield separator + json.dumps(value)
+        separator = ','
+    yield ']'
+
+def encode_response(*args, **kwargs):
+    """Return the arguments as a JSON response.
+
+    The arguments are the same as for flask.jsonify.
+
     Returns:
-        True if doc_id is a valid ASCII document identifier. False otherwise.
+        flask.Response object.
     """
-    if isinstance(doc_id, str):
-        length = len(doc_id)
-        if (length <= 0) or (search.MAXIMUM_DOCUMENT_ID_LENGTH < length):
-            return False
-        if doc_id.startswith('!'):
-            return False
-        if doc_id.startswith('__') and doc_id.endswith('__'):
-            return False
-        for c in doc_id:
-            if c not in _VISIBLE_PRINTABLE_ASCII:
-                return False
-        return True
-    return False
+    response = flask.jsonify(*args, **kwargs)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
 
-def _strip_operators(query, replacement=' '):
-    """Return query without the relational operators (:=<>).
+def error_response(code, retry_after=None, **kwargs):
+    """Return an error response as JSON.
 
     Args:
-        query: String search query.
-        replacement: Optional string replacement string for the relational
-            operators. Defaults to space.
+        code: Integer HTTP status code of the error.
+        retry_after: Optional integer number of seconds after which the
+            client may retry the request. It is sent as the Retry-After
+            header.
+        kwargs: Additional values to return with the error, like the
+            counts of the documents written before the error.
     Returns:
-        String query without the relational operators (:=<>).
+        flask.Response object of the object with the error as 'error'.
     """
-    if not isinstance(query, basestring):
-        raise TypeError('query must be a string.')
-    if not isinstance(replacement, basestring):
-        raise TypeError('replacement must be a string.')
-    return re.sub('[:=<>]', replacement, query)
+    response = encode_response(error={
+        'code': code,
+        'message': 'Oops! This is embarrassing. An error occurred.'},
+        **kwargs)
+    response.status_code = code
+    if retry_after is not None:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
 
-def _delete(search_index, ids):
-    """Delete documents with document identifiers in ids.
+def abort_unavailable(retry_after):
+    """Abort the request with 503 Service Unavailable.
 
     Args:
-        search_index: search.Index object to the index from which to delete.
-        ids: List of string document identifiers to delete.
-    Raises:
-        ValueError if ids is longer than the Search API safety limit.
+        retry_after: Integer number of seconds after which the client may
+            retry the request. It is sent as the Retry-After header.
     """
-    length = len(ids)
-    if length > _SAFETY_LIMIT:
-        raise ValueError('ids exceeds the Search API safety limit.')
+    error = werkzeug.exceptions.ServiceUnavailable()
+    error.retry_after = retry_after
+    raise error
 
-    futures = []
-    for i in xrange(0, length, _BATCH_SIZE):
-        futures.append(search_index.delete_async(ids[i:i+_BATCH_SIZE]))
+def _until_limit(documents, exceeded):
+    """Yield documents up to the Search API safety limit.
 
-    # Wait for the futures to complete
-    for future in futures:
-        try:
-            future.get_result()
-        except search.DeleteError:
-            logging.error('Unable to delete documents from search index.')
-            continue
-        except apiproxy_errors.DeadlineExceededError:
-            logging.error('Deadline exceeded for Search API delete call.')
-        except apiproxy_errors.OverQuotaError:
-            logging.error(
-                'Quota exceeded for Search API {0} delete calls.'.format(
-                    length))
+    Args:
+        documents: Iterator of search.Document objects.
+        exceeded: List to which the first document over the safety limit
+            is appended, if any.
+    Yields:
+        search.Document objects.
+    """
+    count = 0
+    for document in documents:
+        count += 1
+        if count > _SAFETY_LIMIT:
+            exceeded.append(document)
             return
+        yield document
 
-def _put(search_index, documents):
-    """Put documents in the search index.
+def _failed_ids(summary):
+    """Return the sorted identifiers that failed in the calls of summary."""
+    return sorted(doc_id for entry in summary for doc_id in entry['failed'])
 
-    If a document with the same document identifier already exists in the
-    search index, then that document is replaced.
+def enqueue_response(search_index, documents=(), ids=(), **kwargs):
+    """Enqueue the writes and return 202 Accepted with the job identifier.
 
     Args:
-        search_index: search.Index object to the index to which to put.
-        documents: List of search.Document objects to put.
-    Raises:
-        ValueError if documents is longer than the Search API safety limit.
+        search_index: search.Index object to the index to write to.
+        documents: Optional list of search.Document objects to put.
+        ids: Optional list of string document identifiers to delete.
+        kwargs: Additional values to return with the job identifier.
+    Returns:
+        flask.Response object of the JSON object with the job identifier as
+        'job' and the number of writes queued as 'queued'.
     """
-    documents = [document for document in documents
-                 if isinstance(document, search.Document)]
-    length = len(documents)
-    if length > _SAFETY_LIMIT:
-        raise ValueError('documents exceeds the Search API safety limit.')
+    job_id = _write_queue.enqueue(search_index.name, documents, ids)
+    if job_id is None:
+        return abort_unavailable(_WRITE_DELAY)
+    response = flask.jsonify(
+        job=job_id, queued=len(documents) + len(ids), **kwargs)
+    response.content_type = 'application/json; charset=utf-8'
+    response.status_code = 202
+    response.headers['Location'] = flask.url_for('JOB', job_id=job_id)
+    return response
 
-    futures = []
-    for i in xrange(0, length, _BATCH_SIZE):
-        futures.append(search_index.put_async(documents[i:i+_BATCH_SIZE]))
+def _compress(body, encoding):
+    """Return body compressed with the HTTP content coding encoding.
 
-    # Wait for the futures to complete
-    for future in futures:
-        try:
-            future.get_result()
-        except search.PutError:
-            logging.error('Unable to put documents in search index.')
-            continue
-        except apiproxy_errors.DeadlineExceededError:
-            logging.error('Deadline exceeded for Search API put call.')
-        except apiproxy_errors.OverQuotaError:
-            logging.error(
-                'Quota exceeded for Search API {0} put calls.'.format(
-                    length))
-            return
+    Args:
+        body: String to compress.
+        encoding: String 'gzip' or 'deflate'.
+    Returns:
+        String compressed body.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(_COMPRESS_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(_COMPRESS_LEVEL)
+    return compressor.compress(body) + compressor.flush()
 
-def _search(search_index, query):
-    """Return document IDs matching a global search of the index for query.
+def conditional_response(response, generation):
+    """Make response conditional on its ETag and compress it if accepted.
+
+    The strong ETag is derived from the body and the write generation of
+    the index it was read from, and from the content coding. The response
+    is replaced with 304 Not Modified if the request has a matching
+    If-None-Match header. Otherwise the body is compressed if the client
+    accepts gzip or deflate and it is at least _COMPRESS_THRESHOLD long.
 
     Args:
-        search_index: search.Index object to the index to search.
-        query: String search query.
+        response: flask.Response object of a complete response.
+        generation: Integer write generation of the index read before the
+            body was computed.
     Returns:
-        List of string document identifiers whose full text match a global
-        search of the index for query.
+        flask.Response object to return.
     """
-    if not isinstance(query, basestring):
-        raise TypeError('query must be a non-empty string.')
-    query = query.strip()
-    length = len(query)
-    if (length <= 0) or (search.MAXIMUM_QUERY_LENGTH < length):
-        return []
-
-    query = _strip_operators(query)
-    options_arguments = {
-        'limit': search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH,
-        'ids_only': True
-    }
-    options = search.QueryOptions(**options_arguments)
-    try:
-        # Create search.Query in try-catch to catch QueryError
-        # if the search query is not parseable
-        query_object = search.Query(query, options=options)
-        result = search_index.search(query_object)
-    except search.Error:
-        return []
-    except apiproxy_errors.DeadlineExceededError:
-        logging.error('Deadline exceeded for Search API search call.')
-        return []
-    except apiproxy_errors.OverQuotaError:
-        logging.error('Quota exceeded for Search API search call.')
-        return []
-    else:
-        return [doc.doc_id for doc in result.results]
+    body = response.get_data()
+    etag = hashlib.sha1('{0}:{1}'.format(generation, body)).hexdigest()
+    encoding = None
+    if len(body) >= _COMPRESS_THRESHOLD:
+        encoding = flask.request.accept_encodings.best_match(
+            ['gzip', 'deflate'])
+        if encoding is not None:
+            # Each content coding is a different representation
+            etag = '{0}-{1}'.format(etag, encoding)
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    elif encoding is not None:
+        response.set_data(_compress(body, encoding))
+        response.content_encoding = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
 
-### WSGI application
+def budget_view():
+    """Return the current usage of the write budget."""
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
 
-def get_search_index():
-    """Return the search index if authenticated or None."""
-    if isinstance(_USERNAME, basestring) and isinstance(_PASSWORD, basestring):
-        # HTTP basic authentication
-        if flask.request.authorization is None:
-            return None
-        if ((flask.request.authorization.username == _USERNAME) and
-            (flask.request.authorization.password == _PASSWORD)):
-            return search.Index(name=_USERNAME)
-    return None
+    response = flask.jsonify(_tenants.budget(search_index.name).usage())
+    response.content_type = 'application/json; charset=utf-8'
+    return response
 
 def delete_view():
-    """Delete the indicated documents from the search index."""
+    """Delete the indicated documents from the search index.
+
+    The payload is a JSON array of document identifiers. The result is a
+    JSON object with the number of identifiers deleted as 'deleted' and the
+    array of the identifiers that failed to be deleted, even after retrying
+    them, as 'failed'. Identifiers that were never indexed are deleted all
+    the same. The number of invalid identifiers that were rejected is
+    'rejected', by reason. If the write budget runs out, the response is
+    503 Service Unavailable with these counts and the array of the
+    identifiers that were not tried as 'deferred', which are the only ones
+    to delete again besides the failed ones.
+    """
     search_index = get_search_index()
     if search_index is None:
         return flask.abort(401)
+    rejected = collections.Counter()
+    counts = {'deleted': 0, 'failed': []}
+    start = time.time()
     request_json = flask.request.get_json(silent=True)
     if isinstance(request_json, list):
-        ids = []
-        for entry in request_json:
-            try:
-                doc_id = entry.encode('ascii')
-            except UnicodeEncodeError:
-                continue
-            else:
-                if _is_valid_doc_id(doc_id):
-                    ids.append(doc_id)
+        ids = _validate_doc_ids(request_json, rejected)
+        _record_timing('parse', start)
+        if flask.request.values.get('async'):
+            if len(ids) > _SAFETY_LIMIT:
+                return flask.abort(413)
+            return enqueue_response(search_index, ids=ids)
+
+        def on_success(batch):
+            counts['deleted'] += len(batch)
+
         try:
-            _delete(search_index, ids)
+            summary = _delete(search_index, ids, on_success)
         except ValueError:
             return flask.abort(413)
-    return ''
+        except _BudgetExceededError as e:
+            counts['failed'] = _failed_ids(e.summary)
+            counts['rejected'] = dict(rejected)
+            return error_response(503, e.retry_after,
+                                  deferred=sorted(e.deferred), **counts)
+        counts['failed'] = _failed_ids(summary)
+    counts['rejected'] = dict(rejected)
+    return encode_response(counts)
 
 def get_view():
-    """Run the specified search query and return the result."""
+    """Run the specified search query and return the result.
+
+    By default the result is the JSON array of the first matching document
+    identifiers. With a 'limit' or 'cursor' parameter the result is a page
+    of at most limit identifiers as 'ids' and the cursor to pass to get the
+    next page as 'cursor', which is null after the last page. With a
+    'stream' parameter every matching identifier is streamed as a JSON
+    array.
+
+    Only identifiers are returned unless the 'fields' parameter is 'text'
+    or 'snippet'. Every document is then a JSON object with its identifier
+    as 'id', its stored text or an HTML snippet of it as fields and whether
+    that was cut short as 'truncated', and pages have them as 'documents'
+    instead of 'ids'. Texts are cut to the 'length' parameter if given and
+    all the texts or snippets of the response to the 'size' parameter
+    characters, at most and by default _RESPONSE_TEXT_LIMIT. Streams are of
+    identifiers only.
+
+    Except for streams, the response has an ETag to make conditional
+    requests with and is compressed if the client accepts it.
+    """
     search_index = get_search_index()
     if search_index is None:
         return flask.abort(401)
 
     query = flask.request.values.get('q')
+    fields = flask.request.values.get('fields')
+    length = flask.request.values.get('length')
+    size = flask.request.values.get('size')
+    if fields is not None:
+        if fields not in _PROJECTIONS:
+            return flask.abort(400)
+        try:
+            if length is not None:
+                length = int(length)
+            size = _RESPONSE_TEXT_LIMIT if size is None else min(
+                int(size), _RESPONSE_TEXT_LIMIT)
+        except ValueError:
+            return flask.abort(400)
+        if (size < 0) or ((length is not None) and (length < 0)):
+            return flask.abort(400)
+    if flask.request.values.get('stream'):
+        if fields is not None:
+            return flask.abort(400)
+        if not (isinstance(query, basestring) and (len(query) > 0)):
+            query = ''
+        breaker = _breakers['search']
+        if breaker.shedding():
+            # Shed before the response starts rather than truncate it
+            return abort_unavailable(breaker.retry_after())
+        return flask.Response(_iter_json_array(
+            _iter_search(search_index, query)),
+                              content_type='application/json; charset=utf-8')
+
+    generation = _search_cache.generation(search_index.name)
+    cursor = flask.request.values.get('cursor')
+    limit = flask.request.values.get('limit')
+    if (cursor is not None) or (limit is not None):
+        if not (isinstance(query, basestring) and (len(query) > 0)):
+            query = ''
+        try:
+            if limit is None:
+                limit = search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH
+            ids, cursor = _search_page(search_index, query, int(limit),
+                                       cursor or None, fields)
+        except ValueError:
+            return flask.abort(400)
+        except _CircuitOpenError as e:
+            return abort_unavailable(e.retry_after)
+        if fields is not None:
+            response = encode_response(
+                cursor=cursor,
+                documents=_project(ids, fields, length, size))
+        else:
+            response = encode_response(cursor=cursor, ids=ids)
+        return conditional_response(response, generation)
+
     result = []
     if isinstance(query, basestring) and (len(query) > 0):
-        result = _search(search_index, query)
+        try:
+            if fields is not None:
+                # Texts are not cached, the search result cache holds ids
+                documents, _ = _search_page(
+                    search_index, query,
+                    search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH,
+                    fields=fields)
+                result = _project(documents, fields, length, size)
+            else:
+                result = _search(search_index, query)
+        except _CircuitOpenError as e:
+            return abort_unavailable(e.retry_after)
 
-    response = flask.jsonify(result)
+    response = encode_response(result)
+    return conditional_response(response, generation)
+
+def job_view(job_id):
+    """Return the progress of the write-behind job job_id."""
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    status = _write_queue.status(job_id)
+    if (status is None) or (status.pop('index') != search_index.name):
+        return flask.abort(404)
+    status['job'] = job_id
+    response = flask.jsonify(status)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
+
+def metrics_view():
+    """Return the metrics of this instance in the Prometheus text format."""
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    usage = _tenants.budget(search_index.name).usage()
+    gauges = dict(
+        ('circuit_breaker_open_{0}'.format(operation),
+         int(breaker.state != breaker.CLOSED))
+        for operation, breaker in _breakers.iteritems())
+    gauges.update({
+        'search_cache_evictions': _search_cache.evictions,
+        'search_cache_hits': _search_cache.hits,
+        'search_cache_misses': _search_cache.misses,
+        'search_cache_stale_hits': _search_cache.stale_hits,
+        'search_flight_leaders': _search_flights.leaders,
+        'search_flight_followers': _search_flights.followers,
+        'search_flight_timeouts': _search_flights.timeouts,
+        'write_budget_limit': usage['limit'],
+        'write_budget_used': usage['used']
+    })
+    report = _startup.report()
+    gauges.update({
+        'startup_imports_seconds': report['imports'],
+        'startup_initialization_seconds': report['initialization'],
+        'startup_warmup_seconds': sum((report['warmup'] or {}).values())
+    })
+    if report['first_request'] is not None:
+        gauges['startup_first_request_seconds'] = report['first_request']
+    response = flask.make_response(
+        _metrics.render(gauges, flask.g.tenant.name))
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+def profiles_view():
+    """Return the summaries of the recent profiles of requests.
+
+    Only the profiles of the authenticated tenant are listed. The result is
+    a JSON object with the list returned by _ProfileRing.summaries as
+    'profiles'.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    response = flask.jsonify(profiles=_profiles.summaries(flask.g.tenant.name))
     response.content_type = 'application/json; charset=utf-8'
     return response
 
+def profile_view(profile_id):
+    """Download the profile profile_id of a request.
+
+    With the 'format' parameter 'pstats', the default, the profile is the
+    file pstats.Stats loads and with 'collapsed' the collapsed stacks
+    returned by _collapse_stats.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    profile_format = flask.request.values.get('format', 'pstats')
+    if profile_format not in _PROFILE_FORMATS:
+        return flask.abort(400)
+    stats = _profiles.stats(flask.g.tenant.name, profile_id)
+    if stats is None:
+        return flask.abort(404)
+    if profile_format == 'collapsed':
+        response = flask.make_response(_collapse_stats(stats))
+        response.content_type = 'text/plain; charset=utf-8'
+    else:
+        response = flask.make_response(marshal.dumps(stats))
+        response.content_type = 'application/octet-stream'
+    response.headers['Content-Disposition'] = (
+        'attachment; filename={0}.{1}'.format(profile_id, profile_format))
+    return response
+
 def put_view():
-    """Convert JSON payload to documents and put them in the search index."""
+    """Convert JSON payload to documents and put them in the search index.
+
+    The payload is either a JSON object mapping document identifiers to
+    their text or, with the application/x-ndjson content type, one JSON
+    object per line with the document identifier as 'id' and its text as
+    'text'. Newline delimited JSON is streamed from the request body and
+    put batch by batch so the whole payload is never held in memory.
+
+    Documents whose content is unchanged since they were last put are
+    skipped unless the 'force' parameter is given. The result is a JSON
+    object with the number of documents written as 'written', the number
+    of unchanged documents skipped as 'skipped' and the array of the
+    identifiers of the documents that failed to be put, even after
+    retrying them, as 'failed'. Only those documents need to be put again.
+    The number of invalid entries that were rejected is 'rejected', by
+    reason. If the write budget runs out, the response is 503 Service
+    Unavailable with these counts and the array of the identifiers of the
+    documents that were not tried as 'deferred', which need to be put again
+    as well. A streamed
+    payload with more changed documents than the safety limit is only found
+    out once the documents up to the limit were put, so the response is 413
+    Request Entity Too Large with these counts.
+    """
     search_index = get_search_index()
     if search_index is None:
         return flask.abort(401)
-    request_json = flask.request.get_json(silent=True)
-    if isinstance(request_json, dict):
-        documents = []
-        for k, v in request_json.iteritems():
-            try:
-                doc_id = k.encode('ascii')
-            except UnicodeEncodeError:
-                continue
-            if (_is_valid_doc_id(doc_id) and
-                isinstance(v, basestring) and (len(v) > 0)):
-                documents.append(search.Document(
-                    doc_id=doc_id, fields=[search.TextField(
-                        name=_FIELD_NAME,
-                        value=v[:search.MAXIMUM_FIELD_VALUE_LENGTH])]))
+    rejected = collections.Counter()
+    counts = {'failed': [], 'skipped': 0, 'written': 0}
+    documents = None
+    exceeded = []
+    if flask.request.mimetype == _NDJSON_MIMETYPE:
+        documents = _read_ndjson_documents(flask.request.stream, rejected)
+    else:
+        start = time.time()
+        request_json = flask.request.get_json(silent=True)
+        if isinstance(request_json, dict):
+            documents = _make_documents(request_json.iteritems(), rejected)
+        _record_timing('parse', start)
+    if documents is not None:
+        if not flask.request.values.get('force'):
+            changed = _digest_store.iter_changed(
+                search_index.name, documents, counts)
+            documents = (changed if isinstance(
+                documents, collections.Iterator) else list(changed))
+        if isinstance(documents, collections.Iterator):
+            # Unchanged documents do not count against the safety limit
+            documents = _until_limit(documents, exceeded)
+        if flask.request.values.get('async'):
+            documents = list(documents)
+            if exceeded or (len(documents) > _SAFETY_LIMIT):
+                return flask.abort(413)
+            return enqueue_response(search_index, documents=documents,
+                                    skipped=counts['skipped'])
+
+        def on_success(batch):
+            counts['written'] += len(batch)
+
         try:
-            _put(search_index, documents)
+            summary = _put(search_index, documents, on_success)
         except ValueError:
             return flask.abort(413)
-    return ''
+        except _BudgetExceededError as e:
+            counts['failed'] = _failed_ids(e.summary)
+            counts['rejected'] = dict(rejected)
+            return error_response(503, e.retry_after,
+                                  deferred=sorted(e.deferred), **counts)
+        counts['failed'] = _failed_ids(summary)
+
+    counts['rejected'] = dict(rejected)
+    if exceeded:
+        return error_response(413, **counts)
+    return encode_response(counts)
+
+def export_view():
+    """Stream every document of the search index as newline delimited JSON.
+
+    Every line is a JSON object with the document identifier as 'id' and,
+    with the 'text' parameter, its text as 'text', in the format put_view
+    accepts. With the 'cursor' parameter the export starts after that
+    document identifier. A failed Search API call aborts the response
+    rather than end it as if it were complete, so the client can resume
+    after the last identifier it received.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    with_text = bool(flask.request.values.get('text'))
+    start_id = flask.request.values.get('cursor') or None
+    if start_id is not None:
+        try:
+            start_id = start_id.encode('ascii')
+        except UnicodeError:
+            return flask.abort(400)
+
+    def iter_lines():
+        for document in _iter_documents(search_index, start_id,
+                                        ids_only=not with_text,
+                                        raise_errors=True):
+            entry = {'id': document.doc_id}
+            if with_text:
+                entry['text'] = _document_text(document)
+            yield json.dumps(entry) + '\n'
+    return flask.Response(iter_lines(), mimetype=_NDJSON_MIMETYPE)
+
+def reindex_view():
+    """Copy a batch of documents of the search index into another index.
+
+    The payload is a JSON object with the name of the index to copy to as
+    'to', the 'cursor' returned by the previous call, if any, and the
+    optional maximum number of documents to copy as 'limit'. The result is
+    a JSON object with the number of documents 'copied', the number of
+    documents that 'failed' to be copied and the 'cursor' to resume from.
+    Every document was copied once the cursor is null and none failed. The
+    result is 503 Service Unavailable if reading the index failed.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+    request_json = flask.request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return flask.abort(400)
+    name = request_json.get('to')
+    cursor = request_json.get('cursor')
+    limit = request_json.get('limit', _REINDEX_LIMIT)
+    if ((not isinstance(name, basestring)) or
+        ((cursor is not None) and (not isinstance(cursor, basestring))) or
+        (not isinstance(limit, int)) or
+        (not (0 < limit <= _SAFETY_LIMIT))):
+        return flask.abort(400)
+    try:
+        target = _get_index(name.encode('ascii'))
+        cursor = cursor and cursor.encode('ascii')
+    except (UnicodeError, ValueError):
+        return flask.abort(400)
+    if target.name == search_index.name:
+        return flask.abort(400)
+    # The indexes of other tenants are theirs alone
+    if _tenants.for_index(target.name) is not None:
+        return flask.abort(403)
+
+    try:
+        copied, failed, cursor = _reindex(search_index, target, cursor,
+                                          limit)
+    except _BudgetExceededError as e:
+        return abort_unavailable(e.retry_after)
+    except (search.Error, apiproxy_errors.Error):
+        return abort_unavailable(_WRITE_DELAY)
+    response = flask.jsonify(copied=copied, cursor=cursor, failed=failed)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
+
+def reshard_view():
+    """Move a batch of documents between shard layouts.
+
+    The payload is a JSON object with the integer number of shards to move
+    the documents 'from' and 'to' and the 'cursor' returned by the previous
+    call, if any. The result is a JSON object with the number of documents
+    'moved', the number of documents that 'failed' to be moved and the
+    'cursor' to resume from. Every document was moved once the cursor is
+    null and none failed. The numbers of shards must be the configured
+    SEARCH_PREVIOUS_SHARDS and SEARCH_SHARDS, which the searches read.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+    request_json = flask.request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return flask.abort(400)
+    previous = request_json.get('from', _PREVIOUS_SHARDS or 1)
+    shards = request_json.get('to', _SHARDS)
+    cursor = request_json.get('cursor')
+    if ((not isinstance(previous, int)) or (not isinstance(shards, int)) or
+        (previous < 1) or (shards < 1) or
+        ((cursor is not None) and (not isinstance(cursor, basestring)))):
+        return flask.abort(400)
+    # Documents moved to another layout would no longer be searched
+    if (previous != (_PREVIOUS_SHARDS or 1)) or (shards != _SHARDS):
+        return flask.abort(400)
+
+    try:
+        moved, failed, cursor = _reshard(search_index.name, previous,
+                                         shards,
+                                         cursor and cursor.encode('ascii'))
+    except UnicodeEncodeError:
+        return flask.abort(400)
+    except _BudgetExceededError as e:
+        return abort_unavailable(e.retry_after)
+    response = flask.jsonify(cursor=cursor, failed=failed, moved=moved)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
+
+def search_view():
+    """Run every search query in the JSON payload and return the results.
+
+    The payload is a JSON array of search queries. The result is a JSON
+    object with the matching document identifiers for each query under
+    'results' and the errors for the queries that could not be searched
+    under 'errors'.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+    request_json = flask.request.get_json(silent=True)
+    if not isinstance(request_json, list):
+        request_json = []
+    if len(request_json) > _MAX_QUERIES:
+        return flask.abort(413)
+
+    results, errors = _search_many(search_index, request_json)
+    response = flask.jsonify(errors=errors, results=results)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
+
+def suggest_view():
+    """Return the documents matching the partial search query as typed.
+
+    Every word of the 'q' parameter is a term prefix. The result is the
+    JSON array of at most 'limit' matching document identifiers, most
+    recently written first, answered from the prefix index of the documents
+    put through this instance without calling the Search API.
+    """
+    search_index = get_search_index()
+    if search_index is None:
+        return flask.abort(401)
+
+    query = flask.request.values.get('q')
+    try:
+        limit = int(flask.request.values.get('limit', _SUGGEST_LIMIT))
+    except ValueError:
+        return flask.abort(400)
+    if not (0 < limit <= _MAX_SUGGEST_LIMIT):
+        return flask.abort(400)
+
+    result = []
+    if isinstance(query, basestring) and (len(query) > 0):
+        result = _get_prefix_index(search_index.name).suggest(query, limit)
+
+    response = flask.jsonify(result)
+    response.content_type = 'application/json; charset=utf-8'
+    return response
+
+def warmup_view():
+    """Warm up this instance and return the report of its startup cost.
+
+    App Engine sends the warmup request without credentials before it
+    routes traffic to a new instance. The result is the JSON object
+    returned by _Startup.report.
+    """
+    response = flask.jsonify(_startup.warm())
+    response.content_type = 'application/json; charset=utf-8'
+    return response
 
 app = flask.Flask(__name__)
 """Flask application."""
@@ -269,16 +4128,92 @@ app = flask.Flask(__name__)
 app.add_url_rule('/', 'DELETE', delete_view, methods=['DELETE'])
 app.add_url_rule('/', 'GET', get_view, methods=['GET'])
 app.add_url_rule('/', 'PUT', put_view, methods=['POST', 'PUT'])
+app.add_url_rule('/_ah/warmup', 'WARMUP', warmup_view, methods=['GET'])
+app.add_url_rule('/budget', 'BUDGET', budget_view, methods=['GET'])
+app.add_url_rule('/export', 'EXPORT', export_view, methods=['GET'])
+app.add_url_rule('/jobs/<job_id>', 'JOB', job_view, methods=['GET'])
+app.add_url_rule('/metrics', 'METRICS', metrics_view, methods=['GET'])
+app.add_url_rule('/profiles', 'PROFILES', profiles_view, methods=['GET'])
+app.add_url_rule('/profiles/<profile_id>', 'PROFILE', profile_view,
+                 methods=['GET'])
+app.add_url_rule('/reindex', 'REINDEX', reindex_view, methods=['POST'])
+app.add_url_rule('/reshard', 'RESHARD', reshard_view, methods=['POST'])
+app.add_url_rule('/search', 'SEARCH', search_view, methods=['POST'])
+app.add_url_rule('/suggest', 'SUGGEST', suggest_view, methods=['GET'])
+
+def start_timer():
+    """Remember when the request started."""
+    flask.g.start = time.time()
+
+def record_request(response):
+    """Record the request in the metrics and send its Server-Timing."""
+    seconds = time.time() - flask.g.get('start', time.time())
+    labels = {'view': flask.request.endpoint or 'NONE'}
+    _metrics.observe('request_latency_seconds', seconds, labels)
+    labels['status'] = response.status_code
+    _metrics.increment('requests_total', labels)
+    if flask.request.endpoint != 'WARMUP':
+        _startup.record_request(seconds)
+    tenant = flask.g.get('tenant')
+    if tenant is not None:
+        _metrics.increment('tenant_requests_total', {
+            'status': response.status_code, 'tenant': tenant.name})
+
+    timings = [(stage, _covered_seconds(intervals)) for stage, intervals in
+               flask.g.get('timings', {}).iteritems()] + [('total', seconds)]
+    response.headers['Server-Timing'] = ', '.join(
+        '{0};dur={1:.1f}'.format(stage, stage_seconds * 1000)
+        for stage, stage_seconds in timings)
+    return response
+
+def start_profile():
+    """Profile the request if it is sampled or asks to be profiled.
+
+    Only requests that authenticate are profiled, so the header cannot be
+    used to slow the instance down anonymously.
+    """
+    if not (flask.request.headers.get(_PROFILE_HEADER) or (
+        (_PROFILE_RATE > 0) and (random.random() < _PROFILE_RATE))):
+        return
+    if get_search_index() is None:
+        return
+    flask.g.profile_id = uuid.uuid4().hex
+    flask.g.profiler = cProfile.Profile()
+    flask.g.profiler.enable()
+
+def identify_profile(response):
+    """Send the identifier of the profile of the request if it has one."""
+    profile_id = flask.g.get('profile_id')
+    if profile_id is not None:
+        response.headers['{0}-Id'.format(_PROFILE_HEADER)] = profile_id
+    return response
+
+def stop_profile(error=None):
+    """Stop profiling the request and keep its profile.
+
+    This runs even if the request failed so that the profiler is always
+    disabled. The body of streamed responses is not profiled.
+    """
+    profiler = flask.g.get('profiler')
+    if profiler is None:
+        return
+    profiler.disable()
+    profiler.create_stats()
+    _profiles.add(flask.g.profile_id, flask.g.tenant.name, flask.request,
+                  time.time() - flask.g.start, profiler.stats)
+
+app.before_request(start_timer)
+app.before_request(start_profile)
+app.after_request(record_request)
+app.after_request(identify_profile)
+app.teardown_request(stop_profile)
 
 def json_error_handler(error):
     """Return the error as a JSON response."""
-    response = flask.jsonify(error={
-        'code': error.code,
-        'message': 'Oops! This is embarrassing. An error occurred.'})
-    response.content_type = 'application/json; charset=utf-8'
-    response.status_code = error.code
-    return response
+    return error_response(error.code, getattr(error, 'retry_after', None))
 
 # Register json_error_handler for all possible exceptions
 for code in werkzeug.exceptions.default_exceptions.iterkeys():
     app.register_error_handler(code, json_error_handler)
+
+_startup.initialized()
@@ -1,17 +1,31 @@
 """Test the Flask application."""
 
+import base64
+import collections
+import json
+import marshal
+import os
+import pstats
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 from google.appengine.api import search
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
+from google.appengine.runtime import apiproxy_errors
 
+import flask
 import webtest
 
 import main
 
 main._USERNAME = 'username'
 main._PASSWORD = 'password'
-
 DATA = {
     'Doraemon': 'Robotic cat from the future.',
     'Garfield': 'Loves lasagna. Hates Mondays.',
@@ -21,6 +35,21 @@ DATA = {
 }
 """Dictionary of test data to use."""
 
+class FakeFuture(object):
+
+    """Future that is complete from the start.
+
+    It raises error from get_result if error is not None.
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def get_result(self):
+        if self.error is not None:
+            raise self.error
+        return []
+
 class BaseTestCase(unittest.TestCase):
 
     """Base TestCase for tests that require the App Engine testbed.
@@ -34,6 +63,31 @@ class BaseTestCase(unittest.TestCase):
         self.testbed = testbed.Testbed()
         self.testbed.activate()
         self.testbed.init_search_stub()
+        self.testbed.init_memcache_stub()
+
+        self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        """Consistency policy of the queries of the datastore stub."""
+        self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(main.__file__)))
+        ndb.get_context().clear_cache()
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        """Task queue stub holding the tasks added in the tests."""
+
+        # The search stub is reset for every test so reset the cache as well
+        main._search_cache.clear()
+        main._search_flights.clear()
+        main._tenants.clear()
+        main._prefix_indexes.clear()
+        main._profiles.clear()
+        main._metrics.clear()
+        main._write_budget.reset()
+        for sizer in main._batch_sizers.itervalues():
+            sizer.reset()
+        for breaker in main._breakers.itervalues():
+            breaker.reset()
 
         self.search_index = None
 
@@ -41,6 +95,15 @@ class BaseTestCase(unittest.TestCase):
         """Deactivate the testbed."""
         self.testbed.deactivate()
 
+    def run_tasks(self):
+        """Run the tasks of the write-behind queue and return their number."""
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            queue_names=main._WRITE_QUEUE)
+        self.taskqueue_stub.FlushQueue(main._WRITE_QUEUE)
+        for task in tasks:
+            deferred.run(task.payload)
+        return len(tasks)
+
     def assertSearchIndexSize(self, size):
         """Test self.search_index has size documents."""
         if isinstance(self.search_index, search.Index):
@@ -117,6 +180,86 @@ class SearchTest(BaseTestCase):
             ('foo := bar', 'foo __ bar')]:
             self.assertEqual(main._strip_operators(value, '_'), expected)
 
+    def test_read_ndjson_documents(self):
+        """Test reading documents from newline delimited JSON."""
+        lines = [json.dumps({'id': k, 'text': v}) for k, v in DATA.items()]
+        documents = list(main._read_ndjson_documents(lines + [
+            '', 'foobar', '[]', '{}', json.dumps({'id': 42, 'text': 'foo'}),
+            json.dumps({'id': '!foobar', 'text': 'foo'}),
+            json.dumps({'id': u'fo\u00f6b\u00e4r', 'text': 'foo'}),
+            json.dumps({'id': 'foobar', 'text': ''})]))
+        self.assertEqual(sorted(document.doc_id for document in documents),
+                         sorted(DATA))
+        for document in documents:
+            self.assertEqual(document.field(main._FIELD_NAME).value,
+                             DATA[document.doc_id])
+
+        limit = main._SAFETY_LIMIT
+        main._SAFETY_LIMIT = 2
+        try:
+            exceeded = []
+            documents = list(main._until_limit(
+                main._read_ndjson_documents(lines), exceeded))
+            self.assertEqual(len(documents), 2)
+            self.assertEqual(len(exceeded), 1)
+        finally:
+            main._SAFETY_LIMIT = limit
+
+    def test_digest_store(self):
+        """Test remembering the digests of the documents put."""
+        documents = [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()]
+        store = main._DigestStore()
+        counts = {'skipped': 0}
+        self.assertEqual(len(list(store.iter_changed(
+            'TestIndex', documents, counts))), len(DATA))
+        self.assertEqual(counts['skipped'], 0)
+        store.update('TestIndex', documents)
+        self.assertEqual(list(store.iter_changed(
+            'TestIndex', documents, counts)), [])
+        self.assertEqual(counts['skipped'], len(DATA))
+        self.assertEqual(len(list(store.iter_changed(
+            'OtherIndex', documents, counts))), len(DATA))
+        store.forget('TestIndex', ['Garfield'])
+        self.assertEqual([document.doc_id for document in store.iter_changed(
+            'TestIndex', documents, counts)], ['Garfield'])
+
+        # The digests are shared with the other instances
+        garfield = search.Document(doc_id='Garfield', fields=[
+            search.TextField(name=main._FIELD_NAME, value='Lasagna')])
+        main._DigestStore().update('TestIndex', [garfield])
+        self.assertEqual([document.doc_id for document in store.iter_changed(
+            'TestIndex', documents, counts)], ['Garfield'])
+        # The previous digest of a changed document is forgotten
+        self.assertEqual(len(list(store.iter_changed(
+            'TestIndex', [garfield], counts))), 1)
+
+    def test_validate_doc_ids(self):
+        """Test validating document identifiers in bulk."""
+        rejected = collections.Counter()
+        values = [None, 42, '', u'', 'i' * 501, u'fo\u00f6b\u00e4r',
+                  'foo bar', '!foobar', '__foobar__', '__', '___', 'foo',
+                  u'bar', '__foobar', ''.join(main._VISIBLE_PRINTABLE_ASCII)]
+        self.assertEqual(main._validate_doc_ids(values, rejected), [
+            'foo', 'bar', '__foobar',
+            ''.join(main._VISIBLE_PRINTABLE_ASCII)])
+        self.assertEqual(rejected, {
+            'empty_id': 2, 'id_too_long': 1, 'invalid_id_type': 2,
+            'invisible_character': 1, 'non_ascii_id': 1, 'reserved_id': 4})
+        for value in values:
+            self.assertEqual(main._ascii_doc_id(value) is not None,
+                             main._rejection_reason(value) is None)
+
+        rejected = collections.Counter()
+        documents = main._make_documents(
+            DATA.items() + [('!foo', 'bar'), ('foo', ''), ('bar', None)],
+            rejected)
+        self.assertEqual(sorted(document.doc_id for document in documents),
+                         sorted(DATA))
+        self.assertEqual(rejected, {'invalid_text': 2, 'reserved_id': 1})
+
     def test_delete(self):
         """Test deleting documents from the search index."""
         self.assertRaises(ValueError, main._delete,
@@ -150,6 +293,323 @@ class SearchTest(BaseTestCase):
         main._delete(self.search_index, DATA.keys())
         self.assertSearchIndexSize(0)
 
+    def test_write_budget(self):
+        """Test metering documents with the write budget."""
+        budget = main._WriteBudget(limit=5, window=0.1)
+        self.assertRaises(ValueError, budget.acquire, 6)
+        self.assertTrue(budget.acquire(3))
+        self.assertEqual(budget.usage(), {
+            'limit': 5, 'remaining': 2, 'used': 3, 'window': 0.1})
+        self.assertFalse(budget.acquire(3))
+        self.assertEqual(budget.retry_after(3), 1)
+        self.assertTrue(budget.acquire(2))
+        # Wait for the earlier reservations to leave the window
+        self.assertTrue(budget.acquire(5, timeout=1))
+        self.assertEqual(budget.usage()['remaining'], 0)
+        budget.reset()
+        self.assertEqual(budget.usage()['remaining'], 5)
+
+        # Budgets with a shared budget reserve from both
+        shared = main._WriteBudget(limit=5)
+        first = main._WriteBudget(limit=4, shared=shared)
+        second = main._WriteBudget(limit=4, shared=shared)
+        self.assertTrue(first.acquire(3))
+        self.assertFalse(second.acquire(3))
+        self.assertEqual(second.usage()['used'], 0)
+        self.assertGreater(second.retry_after(3), 0)
+        self.assertTrue(second.acquire(2))
+        self.assertEqual(shared.usage()['remaining'], 0)
+
+    def test_write_budget_exceeded(self):
+        """Test deferring documents that exceed the write budget."""
+        timeout = main._BUDGET_TIMEOUT
+        main._BUDGET_TIMEOUT = 0
+        try:
+            main._write_budget.acquire(main._SAFETY_LIMIT - 1)
+            with self.assertRaises(main._BudgetExceededError) as context:
+                main._put(self.search_index, [
+                    search.Document(doc_id=k, fields=[
+                        search.TextField(name=main._FIELD_NAME, value=v)])
+                    for k, v in DATA.items()])
+            self.assertEqual(sorted(context.exception.deferred),
+                             sorted(DATA))
+            self.assertGreater(context.exception.retry_after, 0)
+            self.assertEqual(context.exception.summary, [])
+            self.assertRaises(main._BudgetExceededError, main._delete,
+                              self.search_index, DATA.keys())
+            main._delete(self.search_index, ['Doraemon'])
+        finally:
+            main._BUDGET_TIMEOUT = timeout
+        self.assertSearchIndexSize(0)
+
+    def test_batch_sizer(self):
+        """Test adapting the batch size to latency and errors."""
+        sizer = main._BatchSizer(minimum=10, maximum=100, target=1)
+        self.assertEqual(sizer.size, 100)
+        sizer.success(0.5)
+        self.assertEqual(sizer.size, 100)
+        sizer.failure()
+        self.assertEqual(sizer.size, 50)
+        sizer.success(2)
+        self.assertEqual(sizer.size, 25)
+        sizer.success(0.5)
+        self.assertEqual(sizer.size, 35)
+        for _ in xrange(0, 10):
+            sizer.failure()
+        self.assertEqual(sizer.size, 10)
+        sizer.reset()
+        self.assertEqual(sizer.size, 100)
+
+    def test_circuit_breaker(self):
+        """Test opening, probing and closing a circuit breaker."""
+        breaker = main._CircuitBreaker('put', threshold=2, cooldown=60,
+                                       window=4)
+        breaker.record(apiproxy_errors.OverQuotaError())
+        # Answers of the Search API are not overload errors
+        for _ in xrange(0, 3):
+            breaker.record(search.PutError('foo', []))
+        # Only the errors of the latest window calls count
+        breaker.record(apiproxy_errors.DeadlineExceededError())
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record(apiproxy_errors.OverQuotaError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertTrue(0 < breaker.retry_after() <= 60)
+        # Calls that were in flight when the breaker opened are ignored
+        breaker.record()
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # A single probe is let through after the cooldown
+        breaker._opened -= 60
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record(None, breaker._probe - 1)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        breaker.record(apiproxy_errors.OverQuotaError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertFalse(breaker.allow())
+        breaker._opened -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(main._metrics.get(
+            'circuit_breaker_transitions_total',
+            {'operation': 'put', 'state': 'open'}), 2)
+
+        # Errors interleaved with successes open the breaker as well
+        breaker = main._CircuitBreaker('delete')
+        for _ in xrange(0, main._BREAKER_THRESHOLD):
+            breaker.record()
+            self.assertEqual(breaker.state, breaker.CLOSED)
+            breaker.record(apiproxy_errors.OverQuotaError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_circuit_breaker_shedding(self):
+        """Test writes are shed first and searches fall back on the cache."""
+        main._put(self.search_index, [
+            main._make_document(k, v) for k, v in DATA.items()])
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Doraemon', 'Heathcliff'])
+
+        calls = []
+        def call(batch):
+            calls.append(batch)
+            return FakeFuture(apiproxy_errors.DeadlineExceededError())
+        delay = main._RETRY_DELAY
+        main._RETRY_DELAY = 0
+        try:
+            with self.assertRaises(main._CircuitOpenError) as context:
+                main._dispatch('delete', call, range(400))
+        finally:
+            main._RETRY_DELAY = delay
+        self.assertGreaterEqual(len(calls), main._BREAKER_THRESHOLD)
+        self.assertGreater(len(context.exception.deferred), 0)
+        self.assertGreater(context.exception.retry_after, 0)
+        self.assertEqual(main._breakers['delete'].state, 'open')
+        # Shed writes are deferred like writes over the write budget
+        self.assertIsInstance(context.exception, main._BudgetExceededError)
+
+        # Every write is shed while searches still go through
+        with self.assertRaises(main._CircuitOpenError):
+            main._put(self.search_index, [
+                main._make_document('Felix', 'Cat')])
+        self.assertEqual(main._search(self.search_index, 'Fancy'),
+                         ['Top_Cat'])
+        main._breakers['delete']._opened -= main._BREAKER_COOLDOWN
+        main._put(self.search_index, [main._make_document('Felix', 'Cat')])
+        self.assertEqual(main._breakers['delete'].state, 'open')
+        main._delete(self.search_index, ['Felix'])
+        self.assertEqual(main._breakers['delete'].state, 'closed')
+
+        # Searches fall back on stale results
+        for _ in xrange(0, main._BREAKER_THRESHOLD):
+            main._breakers['search'].record(
+                apiproxy_errors.OverQuotaError())
+        main._search_cache.invalidate(self.search_index.name)
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Doraemon', 'Heathcliff'])
+        self.assertEqual(main._search_cache.stale_hits, 1)
+        with self.assertRaises(main._CircuitOpenError):
+            main._search(self.search_index, 'lasagna')
+        with self.assertRaises(main._CircuitOpenError):
+            main._search_page(self.search_index, 'cat', 1)
+        results, errors = main._search_many(self.search_index,
+                                            ['cat', 'lasagna'])
+        self.assertEqual(results, {'cat': ['Doraemon', 'Heathcliff']})
+        self.assertEqual(errors, {'lasagna': '_CircuitOpenError'})
+        with self.assertRaises(main._CircuitOpenError):
+            main._put(self.search_index, [
+                main._make_document('Tom', 'Cat')])
+
+        # A successful probe restores the searches and then the writes
+        main._breakers['search']._opened -= main._BREAKER_COOLDOWN
+        self.assertEqual(main._search(self.search_index, 'lasagna'),
+                         ['Garfield'])
+        self.assertEqual(main._breakers['search'].state, 'closed')
+        main._put(self.search_index, [main._make_document('Tom', 'Cat')])
+        self.assertEqual(len(main._search(self.search_index, 'cat')), 3)
+
+    def test_dispatch(self):
+        """Test dispatching batches with a bounded number in flight."""
+        delay = main._RETRY_DELAY
+        main._RETRY_DELAY = 0
+        try:
+            calls = []
+            def call(batch):
+                calls.append(batch)
+                if len(calls) == 1:
+                    return FakeFuture(apiproxy_errors.DeadlineExceededError())
+                return FakeFuture()
+            summary = main._dispatch('put', call, range(450))
+            self.assertEqual(sorted(sum(calls[1:], [])), range(450))
+            self.assertEqual(sum(entry['size'] for entry in summary), 450)
+            self.assertEqual(sorted(entry['attempts'] for entry in summary),
+                             [1, 1, 2, 2])
+            for entry in summary:
+                self.assertIsNone(entry['error'])
+                self.assertGreaterEqual(entry['latency'], 0)
+
+            # Batches are retried up to _MAX_RETRIES times
+            main._batch_sizers['delete'].reset()
+            summary = main._dispatch('delete', lambda batch: FakeFuture(
+                apiproxy_errors.DeadlineExceededError()), range(10))
+            self.assertEqual(len(summary), 1)
+            self.assertEqual(summary[0]['attempts'], main._MAX_RETRIES + 1)
+            self.assertEqual(summary[0]['error'], 'DeadlineExceededError')
+            self.assertEqual(main._batch_sizers['delete'].size,
+                             main._BATCH_SIZE // 2 ** (main._MAX_RETRIES + 1))
+
+            # Calls stop after the quota is exceeded
+            main._batch_sizers['delete'].reset()
+            over_quota = lambda batch: FakeFuture(
+                apiproxy_errors.OverQuotaError())
+            with self.assertRaises(main._BudgetExceededError) as context:
+                main._dispatch('delete', over_quota, range(main._SAFETY_LIMIT))
+            summary = context.exception.summary
+            self.assertEqual(len(summary), main._MAX_IN_FLIGHT)
+            for entry in summary:
+                self.assertEqual(entry['error'], 'OverQuotaError')
+            self.assertEqual(context.exception.deferred, range(
+                main._MAX_IN_FLIGHT * main._BATCH_SIZE, main._SAFETY_LIMIT))
+        finally:
+            main._RETRY_DELAY = delay
+
+    def test_dispatch_small_budget(self):
+        """Test dispatching batches within a budget smaller than a batch."""
+        calls = []
+        def call(batch):
+            calls.append(batch)
+            return FakeFuture()
+        budget = main._WriteBudget(limit=10)
+        timeout = main._BUDGET_TIMEOUT
+        main._BUDGET_TIMEOUT = 0
+        try:
+            with self.assertRaises(main._BudgetExceededError) as context:
+                main._dispatch('put', call, range(25), budget=budget)
+        finally:
+            main._BUDGET_TIMEOUT = timeout
+        self.assertEqual(calls, [range(10)])
+        self.assertEqual(context.exception.deferred, range(10, 25))
+        self.assertEqual(budget.usage()['used'], 10)
+
+    def test_dispatch_over_quota(self):
+        """Test deferring the batches after a call exceeded the quota."""
+        calls = []
+        def call(batch):
+            calls.append(batch)
+            future = FakeFuture(apiproxy_errors.OverQuotaError()
+                                if len(calls) == 1 else None)
+            future.sequence = len(calls)
+            return future
+        wait_any = main._wait_any
+        # Complete the calls in the order they were made
+        main._wait_any = lambda futures: min(
+            futures, key=lambda future: future.sequence)
+        total = (main._MAX_IN_FLIGHT + 2) * main._BATCH_SIZE
+        try:
+            with self.assertRaises(main._BudgetExceededError) as context:
+                main._dispatch('put', call, range(total))
+        finally:
+            main._wait_any = wait_any
+        # The calls in flight complete and the unread items are deferred
+        self.assertEqual(len(calls), main._MAX_IN_FLIGHT)
+        self.assertEqual(context.exception.deferred, range(
+            main._MAX_IN_FLIGHT * main._BATCH_SIZE, total))
+        self.assertEqual(context.exception.retry_after, main._BUDGET_WINDOW)
+        summary = context.exception.summary
+        self.assertEqual(len(summary), main._MAX_IN_FLIGHT)
+        self.assertEqual(summary[0]['error'], 'OverQuotaError')
+        self.assertEqual(summary[0]['failed'], range(main._BATCH_SIZE))
+        for entry in summary[1:]:
+            self.assertIsNone(entry['error'])
+
+    def test_dispatch_partial_failure(self):
+        """Test retrying only the documents that failed transiently."""
+        def put_error(batch, codes):
+            return search.PutError('Unable to put documents.', [
+                search.PutResult(code=codes.get(
+                    item, search.OperationResult.OK), id=item)
+                for item in batch])
+
+        calls = []
+        def call(batch):
+            calls.append(batch)
+            if len(calls) <= 2:
+                return FakeFuture(put_error(batch, dict(
+                    [(item, search.OperationResult.TRANSIENT_ERROR)
+                     for item in batch if int(item) % 2] +
+                    [(item, search.OperationResult.INVALID_REQUEST)
+                     for item in batch if int(item) % 50 == 0])))
+            return FakeFuture()
+        delay = main._RETRY_DELAY
+        main._RETRY_DELAY = 0.01
+        try:
+            succeeded = []
+            summary = main._dispatch('put', call, [
+                str(i) for i in xrange(0, 250)], succeeded.extend)
+        finally:
+            main._RETRY_DELAY = delay
+        # The transient failures of both batches are retried together
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sorted(calls[2], key=int),
+                         [str(i) for i in xrange(1, 250, 2)])
+        self.assertEqual([entry['error'] for entry in summary],
+                         ['PutError', 'PutError', None])
+        self.assertEqual(sorted(sum((entry['failed'] for entry in summary),
+                                    []), key=int),
+                         [str(i) for i in xrange(0, 250, 50)])
+        self.assertEqual(len(succeeded), 245)
+
+        # Documents without a result are retried and any failure counts
+        self.assertEqual(main._partition_results(['a', 'b', 'c'], [
+            search.DeleteResult(code=search.OperationResult.OK, id='a'),
+            search.DeleteResult(code=search.OperationResult.OK, id='b'),
+            search.DeleteResult(code=search.OperationResult.INTERNAL_ERROR,
+                                id='b')]), (['a'], ['c'], ['b']))
+
     def test_search(self):
         """Test searching documents in the search index."""
         for value in [None, 42, []]:
@@ -197,6 +657,771 @@ class SearchTest(BaseTestCase):
             self.assertEqual(main._search(self.search_index, value), expected)
             self.assertSearchIndexSize(len(DATA) - 1)
 
+    def test_search_many(self):
+        """Test searching the index for many queries at once."""
+        self.assertEqual(main._search_many(self.search_index, []), ({}, {}))
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        results, errors = main._search_many(self.search_index, [
+            'cat', ' cat ', 'cat', 'Fancy', 'foobar', '', 42, None, '(',
+            'q' * (search.MAXIMUM_QUERY_LENGTH + 1)])
+        self.assertEqual(results, {
+            'cat': ['Doraemon', 'Heathcliff'],
+            ' cat ': ['Doraemon', 'Heathcliff'],
+            'Fancy': ['Top_Cat'],
+            'foobar': [],
+            '': [],
+            'q' * (search.MAXIMUM_QUERY_LENGTH + 1): []})
+        self.assertEqual(errors, {'(': 'QueryError'})
+        # Identical normalized queries are searched once
+        self.assertEqual(main._search_cache.misses, 4)
+
+        # Cached results are reused
+        self.assertEqual(main._search_many(self.search_index, ['cat']),
+                         ({'cat': ['Doraemon', 'Heathcliff']}, {}))
+        self.assertEqual(main._search_cache.hits, 1)
+        self.assertEqual(main._search(self.search_index, 'fancy'),
+                         ['Top_Cat'])
+
+    def test_search_page(self):
+        """Test paging through the search results with cursors."""
+        for value in [0, -1, search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH + 1]:
+            self.assertRaises(ValueError, main._search_page,
+                              self.search_index, 'cat', value)
+        self.assertRaises(ValueError, main._search_page,
+                          self.search_index, 'cat', 1, 'foobar')
+        self.assertEqual(main._search_page(self.search_index, 'cat', 1),
+                         ([], None))
+
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        ids, cursor = main._search_page(self.search_index, 'cat', 1)
+        self.assertEqual(ids, ['Doraemon'])
+        self.assertIsNotNone(cursor)
+        ids, cursor = main._search_page(self.search_index, 'cat', 1, cursor)
+        self.assertEqual(ids, ['Heathcliff'])
+        if cursor is not None:
+            self.assertEqual(main._search_page(
+                self.search_index, 'cat', 1, cursor), ([], None))
+        self.assertEqual(main._search_page(self.search_index, 'cat', 10),
+                         (['Doraemon', 'Heathcliff'], None))
+
+    def test_iter_search(self):
+        """Test iterating over every search result."""
+        self.assertEqual(list(main._iter_search(self.search_index, 'cat')),
+                         [])
+        length = search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH + 10
+        main._put(self.search_index, [
+            search.Document(doc_id=str(i), fields=[
+                search.TextField(name=main._FIELD_NAME, value='cat')])
+            for i in xrange(0, length)])
+        self.assertEqual(len(main._search(self.search_index, 'cat')),
+                         search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH)
+        self.assertEqual(
+            sorted(main._iter_search(self.search_index, 'cat')),
+            sorted(str(i) for i in xrange(0, length)))
+
+        # A failed page raises instead of ending the results early
+        search_index = self.search_index
+        class FailingIndex(object):
+            name = search_index.name
+            calls = []
+            def search(self, query):
+                self.calls.append(query)
+                if len(self.calls) > 1:
+                    raise apiproxy_errors.DeadlineExceededError()
+                return search_index.search(query)
+        ids = main._iter_search(FailingIndex(), 'cat')
+        for _ in xrange(0, search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH):
+            ids.next()
+        self.assertRaises(apiproxy_errors.DeadlineExceededError, ids.next)
+
+    def test_metrics(self):
+        """Test rendering counters and histograms."""
+        metrics = main._Metrics()
+        self.assertEqual(metrics.render(), '\n')
+        metrics.increment('calls_total', {'operation': 'put'})
+        metrics.increment('calls_total', {'operation': 'put'}, 2)
+        metrics.increment('calls_total')
+        self.assertEqual(metrics.get('calls_total', {'operation': 'put'}), 3)
+        self.assertEqual(metrics.get('calls_total', {'operation': 'get'}), 0)
+        metrics.observe('size', 3, buckets=(1, 5))
+        metrics.observe('size', 9, buckets=(1, 5))
+        self.assertEqual(metrics.render({'used': 7}).splitlines(), [
+            '# TYPE recap_used gauge',
+            'recap_used 7',
+            '# TYPE recap_calls_total counter',
+            'recap_calls_total 1',
+            'recap_calls_total{operation="put"} 3',
+            '# TYPE recap_size histogram',
+            'recap_size_bucket{le="1"} 0',
+            'recap_size_bucket{le="5"} 1',
+            'recap_size_bucket{le="+Inf"} 2',
+            'recap_size_sum 12',
+            'recap_size_count 2'])
+
+    def test_record_calls(self):
+        """Test recording the Search API calls in the metrics."""
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        main._delete(self.search_index, ['Doraemon'])
+        main._search(self.search_index, 'cat')
+        main._search_many(self.search_index, ['fancy'])
+        for operation, calls in [('put', 1), ('delete', 1), ('search', 2)]:
+            self.assertEqual(main._metrics.get(
+                'search_api_calls_total', {'operation': operation}), calls)
+        self.assertEqual(main._metrics.get(
+            'documents_total', {'operation': 'put'}), len(DATA))
+        self.assertEqual(main._metrics.get(
+            'documents_total', {'operation': 'delete'}), 1)
+
+        main._dispatch('delete', lambda batch: FakeFuture(
+            apiproxy_errors.OverQuotaError()), ['Garfield'])
+        self.assertEqual(main._metrics.get('search_api_errors_total', {
+            'error': 'OverQuotaError', 'operation': 'delete'}), 1)
+
+    def test_reindex(self):
+        """Test copying the documents of an index in steps."""
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v),
+                search.AtomField(name='legacy', value='foo')])
+            for k, v in DATA.items()])
+        self.assertEqual(
+            [document.doc_id for document in main._iter_documents(
+                self.search_index, 'Garfield', ids_only=True)],
+            ['Heathcliff', 'Hello_Kitty', 'Top_Cat'])
+
+        target = search.Index(name='OtherIndex')
+        copied, failed, cursor = main._reindex(self.search_index, target,
+                                               limit=3)
+        self.assertEqual((copied, failed, cursor), (3, 0, 'Heathcliff'))
+        copied, failed, cursor = main._reindex(self.search_index, target,
+                                               cursor, limit=3)
+        self.assertEqual((copied, failed, cursor), (2, 0, None))
+        documents = list(target.get_range())
+        self.assertEqual([document.doc_id for document in documents],
+                         sorted(DATA))
+        # Documents are rebuilt with the current field layout
+        for document in documents:
+            self.assertEqual([field.name for field in document.fields],
+                             [main._FIELD_NAME])
+        self.assertEqual(main._search(target, 'cat'),
+                         ['Doraemon', 'Heathcliff'])
+
+        # Failed batches are copied again from the checkpoint
+        class FailingIndex(object):
+            name = 'FailingIndex'
+            def put_async(self, documents):
+                return FakeFuture(apiproxy_errors.OverQuotaError())
+        copied, failed, cursor = main._reindex(
+            self.search_index, FailingIndex(), 'Garfield')
+        self.assertEqual((copied, failed, cursor), (0, 3, 'Garfield'))
+
+        # Failed reads are raised rather than end the copy early
+        class UnreadableIndex(object):
+            name = 'UnreadableIndex'
+            def get_range(self, **kwargs):
+                raise search.InternalError()
+        with self.assertRaises(search.InternalError):
+            main._reindex(UnreadableIndex(), target)
+
+    def test_search_cache(self):
+        """Test caching search results."""
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Doraemon', 'Heathcliff'])
+        self.assertEqual(main._search_cache.misses, 1)
+        self.assertEqual(main._search_cache.hits, 0)
+        # The normalized query is the cache key
+        for value in ['cat', ' cat ', 'cat:']:
+            self.assertEqual(main._search(self.search_index, value),
+                             ['Doraemon', 'Heathcliff'])
+        self.assertEqual(main._search_cache.misses, 2)
+        self.assertEqual(main._search_cache.hits, 2)
+
+        # Writes to the index invalidate the cached results
+        main._delete(self.search_index, ['Doraemon'])
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Heathcliff'])
+        self.assertEqual(main._search_cache.misses, 3)
+        main._put(self.search_index, [
+            search.Document(doc_id='Doraemon', fields=[
+                search.TextField(name=main._FIELD_NAME,
+                                 value=DATA['Doraemon'])])])
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Doraemon', 'Heathcliff'])
+        self.assertEqual(main._search_cache.misses, 4)
+
+        # Results cached before a write are discarded
+        generation = main._search_cache.generation(self.search_index.name)
+        main._search_cache.invalidate(self.search_index.name)
+        main._search_cache.set(self.search_index.name, 'foobar', generation,
+                               ['Garfield'])
+        self.assertIsNone(main._search_cache.get(self.search_index.name,
+                                                 'foobar'))
+
+    def test_search_cache_eviction(self):
+        """Test the search result cache size and time to live."""
+        cache = main._SearchCache(size=2, ttl=60)
+        for value in ['foo', 'bar', 'baz']:
+            cache.set('TestIndex', value, 0, [value])
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get('TestIndex', 'foo'))
+        self.assertEqual(cache.get('TestIndex', 'bar'), ['bar'])
+        self.assertEqual(cache.get('TestIndex', 'baz'), ['baz'])
+        self.assertIsNone(cache.get('OtherIndex', 'baz'))
+
+        cache = main._SearchCache(size=2, ttl=0)
+        cache.set('TestIndex', 'foo', 0, ['foo'])
+        self.assertIsNone(cache.get('TestIndex', 'foo'))
+
+    def test_prefix_index(self):
+        """Test suggesting documents from term prefixes."""
+        main._put(self.search_index, [
+            main._make_document(k, v) for k, v in sorted(DATA.items())])
+        prefix_index = main._get_prefix_index(self.search_index.name)
+        self.assertEqual(len(prefix_index), len(DATA))
+        for value, expected in [
+            ('', []),
+            ('...', []),
+            ('c', ['Heathcliff', 'Doraemon']),
+            ('CA', ['Heathcliff', 'Doraemon']),
+            ('cat', ['Heathcliff', 'Doraemon']),
+            ('cats', []),
+            ('l', ['Top_Cat', 'Garfield']),
+            ('lo las', ['Garfield']),
+            ('ha m', ['Garfield']),
+            ('ha', ['Heathcliff', 'Garfield'])]:
+            self.assertEqual(prefix_index.suggest(value), expected)
+        self.assertEqual(prefix_index.suggest('c', 1), ['Heathcliff'])
+
+        # Writes replace the memoized results
+        main._put(self.search_index, [
+            main._make_document('Doraemon', 'Blue cat')])
+        self.assertEqual(prefix_index.suggest('c'),
+                         ['Doraemon', 'Heathcliff'])
+        self.assertEqual(prefix_index.suggest('robot'), [])
+        main._delete(self.search_index, ['Doraemon', 'Heathcliff'])
+        self.assertEqual(prefix_index.suggest('c'), [])
+        self.assertEqual(prefix_index.suggest('bl'), [])
+
+        # The oldest documents are forgotten beyond the size
+        prefix_index = main._PrefixIndex(size=2)
+        prefix_index.update([main._make_document(k, DATA[k])
+                             for k in ['Doraemon', 'Garfield', 'Heathcliff']])
+        self.assertEqual(len(prefix_index), 2)
+        self.assertEqual(prefix_index.suggest('c'), ['Heathcliff'])
+        self.assertEqual(prefix_index._terms, sorted(prefix_index._postings))
+
+    def test_profile_ring(self):
+        """Test keeping the profiles of recent requests."""
+        profiles = main._ProfileRing(size=2)
+        stats = {('main.py', 1, 'view'): (1, 1, 0.25, 0.5, {})}
+        with main.app.test_request_context('/', method='GET'):
+            for profile_id, tenant in [('a', 'alice'), ('b', 'bob'),
+                                       ('c', 'alice')]:
+                profiles.add(profile_id, tenant, flask.request, 0.5, stats)
+        self.assertEqual(
+            [summary['id'] for summary in profiles.summaries('alice')], ['c'])
+        self.assertEqual(profiles.summaries('bob')[0]['path'], '/')
+        self.assertEqual(profiles.stats('bob', 'b'), stats)
+        self.assertIsNone(profiles.stats('alice', 'b'))
+        self.assertIsNone(profiles.stats('alice', 'a'))
+        profiles.clear()
+        self.assertEqual(profiles.summaries('bob'), [])
+
+    def test_collapse_stats(self):
+        """Test converting profile statistics to collapsed stacks."""
+        view = ('/srv/main.py', 10, 'view')
+        append = ('~', 0, "<method 'append' of 'list' objects>")
+        stats = {
+            view: (1, 1, 0.002, 0.003, {}),
+            append: (2, 2, 0.001, 0.001, {view: (2, 2, 0.001, 0.001)}),
+            ('/srv/main.py', 20, 'idle'): (1, 1, 0, 0, {})
+        }
+        self.assertEqual(main._collapse_stats(stats).splitlines(), [
+            "main.py:10(view) 2000",
+            "main.py:10(view);<method 'append' of 'list' objects> 1000"])
+
+    def test_single_flight(self):
+        """Test concurrent identical searches share one Search API call."""
+        release = threading.Event()
+        calls = []
+
+        class BlockingIndex(main._LocalIndex):
+            def search(self, query):
+                calls.append(query.query_string)
+                release.wait(5)
+                return super(BlockingIndex, self).search(query)
+
+        search_index = BlockingIndex('TestIndex')
+        main._put(search_index, [
+            main._make_document(k, v) for k, v in DATA.items()])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            sorted(main._search(search_index, value))))
+                   for value in ['cat', ' cat', 'cat ', 'cat']]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 5
+        while (main._search_flights.followers < len(threads) - 1 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(calls, ['cat'])
+        self.assertEqual(results, [['Doraemon', 'Heathcliff']] * len(threads))
+        self.assertEqual(main._search_flights.leaders, 1)
+        self.assertEqual(main._search_flights.followers, len(threads) - 1)
+        self.assertEqual(main._search_flights.in_flight(), 0)
+
+    def test_single_flight_errors(self):
+        """Test followers share the error of the leader or time out."""
+        flights = main._SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('foo')
+
+        errors = []
+
+        def leader():
+            try:
+                flights.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait(5)
+        with self.assertRaises(main._FlightTimeoutError):
+            flights.do('key', fail, timeout=0)
+        self.assertEqual(flights.timeouts, 1)
+
+        follower = threading.Thread(target=leader)
+        follower.start()
+        deadline = time.time() + 5
+        while flights.followers < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        release.set()
+        thread.join()
+        follower.join()
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+        self.assertEqual(flights.leaders, 1)
+        # Later calls are not coalesced with completed calls
+        self.assertEqual(flights.do('key', lambda: 'bar'), 'bar')
+        self.assertEqual(flights.leaders, 2)
+
+class TaskWriteQueueTest(BaseTestCase):
+    def setUp(self):
+        super(TaskWriteQueueTest, self).setUp()
+
+        self.search_index = search.Index(name='TestIndex')
+        """search.Index object to the search index to use in the tests."""
+
+        self.queue = main._TaskWriteQueue()
+        """main._TaskWriteQueue object to use in the tests."""
+
+    def test_coalesce(self):
+        """Test coalescing the pending writes per document."""
+        documents = [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()]
+        first = self.queue.enqueue('TestIndex', documents)
+        second = self.queue.enqueue('TestIndex', [
+            search.Document(doc_id='Garfield', fields=[
+                search.TextField(name=main._FIELD_NAME, value='Lasagna')])])
+        third = self.queue.enqueue('TestIndex',
+                                   ids=['Doraemon', 'Meowth', 'Meowth'])
+        self.assertEqual(self.queue.status(first), {
+            'failed': 0, 'index': 'TestIndex', 'pending': len(DATA) - 2,
+            'state': 'pending', 'superseded': 2, 'total': len(DATA),
+            'written': 0})
+        self.assertEqual(self.queue.status(third)['superseded'], 1)
+        self.assertSearchIndexSize(0)
+
+        # The writes are flushed by the tasks of the write-behind queue
+        self.assertGreater(self.run_tasks(), 0)
+        self.assertSearchIndexSize(len(DATA) - 1)
+        self.assertEqual(main._search(self.search_index, 'lasagna'),
+                         ['Garfield'])
+        self.assertEqual(main._search(self.search_index, 'mondays'), [])
+        for job_id, written, superseded in [
+            (first, len(DATA) - 2, 2), (second, 1, 0), (third, 2, 1)]:
+            status = self.queue.status(job_id)
+            self.assertEqual(status['state'], 'done')
+            self.assertEqual(status['failed'], 0)
+            self.assertEqual(status['written'], written)
+            self.assertEqual(status['superseded'], superseded)
+        self.assertIsNone(self.queue.status('foobar'))
+        self.assertEqual(main._PendingWrite.query().count(), 0)
+
+    def test_budget(self):
+        """Test retrying the writes deferred by the write budget."""
+        timeout = main._BUDGET_TIMEOUT
+        main._BUDGET_TIMEOUT = 0
+        try:
+            main._write_budget.acquire(main._SAFETY_LIMIT)
+            job_id = self.queue.enqueue('TestIndex', ids=['Doraemon'])
+            self.assertEqual(self.run_tasks(), 1)
+            self.assertEqual(self.queue.status(job_id)['pending'], 1)
+            main._write_budget.reset()
+            # The task retries once the write budget is available
+            self.assertEqual(self.run_tasks(), 1)
+            self.assertEqual(self.queue.status(job_id)['written'], 1)
+            self.assertEqual(self.run_tasks(), 0)
+        finally:
+            main._BUDGET_TIMEOUT = timeout
+
+    def test_eventual_consistency(self):
+        """Test flushing the writes the query did not see at first."""
+        self.policy.SetProbability(0)
+        job_id = self.queue.enqueue('TestIndex', ids=['Doraemon'])
+        # The task is added again while the job has pending writes
+        self.assertEqual(self.run_tasks(), 1)
+        self.assertEqual(self.queue.status(job_id)['pending'], 1)
+        self.policy.SetProbability(1)
+        self.assertEqual(self.run_tasks(), 1)
+        self.assertEqual(self.queue.status(job_id)['written'], 1)
+        self.assertEqual(self.run_tasks(), 0)
+
+        # Tasks stop being added for writes no query returns
+        self.policy.SetProbability(0)
+        job_id = self.queue.enqueue('TestIndex', ids=['Garfield'])
+        for _ in xrange(0, main._WRITE_MAX_CHECKS + 1):
+            self.assertEqual(self.run_tasks(), 1)
+        self.assertEqual(self.run_tasks(), 0)
+        self.assertEqual(self.queue.status(job_id)['pending'], 1)
+
+    def test_superseded_once(self):
+        """Test counting a write replaced before it is flushed once."""
+        first = self.queue.enqueue('TestIndex', ids=['Doraemon'])
+        key = main._PendingWrite.key_for('TestIndex', 'Doraemon')
+        second = self.queue.enqueue('TestIndex', ids=['Doraemon'])
+        # The write of the first job was replaced, so it is not removed
+        self.assertFalse(main._remove_write(key, first).get_result())
+        self.assertEqual(self.queue.status(first)['superseded'], 1)
+        self.assertEqual(self.queue.status(first)['state'], 'done')
+        self.assertEqual(self.queue.status(second)['pending'], 1)
+        self.assertGreater(self.run_tasks(), 0)
+        self.assertEqual(self.queue.status(second)['written'], 1)
+
+class LocalIndexTest(BaseTestCase):
+    def setUp(self):
+        super(LocalIndexTest, self).setUp()
+
+        self.search_index = main._LocalIndex('TestIndex')
+        """main._LocalIndex object to use in the tests."""
+
+        self.assertEqual(len(self.search_index), 0)
+
+    def test_tokenize(self):
+        """Test tokenizing full text."""
+        for value, expected in [
+            ('', []),
+            ('Loves lasagna. Hates Mondays.',
+             ['loves', 'lasagna', 'hates', 'mondays']),
+            (u'Fo\u00f6 B\u00e4r', [u'fo\u00f6', u'b\u00e4r']),
+            ('fo\xc3\xb6-bar', [u'fo\u00f6', u'bar'])]:
+            self.assertEqual(main._tokenize(value), expected)
+
+    def test_put_delete(self):
+        """Test putting and deleting documents in the local index."""
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        self.assertEqual(len(self.search_index), len(DATA))
+        self.assertEqual(
+            [document.doc_id for document in self.search_index.get_range(
+                ids_only=True)], sorted(DATA))
+        self.assertEqual(
+            [document.doc_id for document in self.search_index.get_range(
+                start_id='Garfield', include_start_object=False, limit=2)],
+            ['Heathcliff', 'Hello_Kitty'])
+
+        # Replacing a document drops its old terms
+        main._put(self.search_index, [
+            search.Document(doc_id='Doraemon', fields=[
+                search.TextField(name=main._FIELD_NAME, value='Blue')])])
+        self.assertEqual(len(self.search_index), len(DATA))
+        self.assertEqual(main._search(self.search_index, 'cat'),
+                         ['Heathcliff'])
+        self.assertEqual(main._search(self.search_index, 'blue'),
+                         ['Doraemon'])
+
+        main._delete(self.search_index, ['Doraemon', 'Meowth'])
+        self.assertEqual(len(self.search_index), len(DATA) - 1)
+        self.assertEqual(main._search(self.search_index, 'blue'), [])
+        main._delete(self.search_index, DATA.keys())
+        self.assertEqual(len(self.search_index), 0)
+        # Posting lists are compacted once most documents are removed
+        self.assertEqual(self.search_index._postings, {})
+
+    def test_search(self):
+        """Test searching documents in the local index."""
+        self.assertEqual(main._search(self.search_index, 'cat'), [])
+        main._put(self.search_index, [
+            search.Document(doc_id=k, fields=[
+                search.TextField(name=main._FIELD_NAME, value=v)])
+            for k, v in DATA.items()])
+        for value, expected in [
+            ('Robotic', ['Doraemon']),
+            ('future', ['Doraemon']),
+            ('CAT', ['Doraemon', 'Heathcliff']),
+            ('Loves lasagna', ['Garfield']),
+            ('Loves AND lasagna', ['Garfield']),
+            ('Hates Mondays.', ['Garfield']),
+            ('lasagna cat', []),
+            ('...', []),
+            ('fancy', ['Top_Cat'])]:
+            self.assertEqual(sorted(main._search(self.search_index, value)),
+                             expected)
+        results, errors = main._search_many(self.search_index, [
+            'cat', 'cat OR fancy', '-cat'])
+        self.assertEqual(sorted(results['cat']), ['Doraemon', 'Heathcliff'])
+        self.assertEqual(errors, {'cat OR fancy': 'QueryError',
+                                  '-cat': 'QueryError'})
+
+        # Newest documents come first
+        main._put(self.search_index, [
+            search.Document(doc_id='Felix', fields=[
+                search.TextField(name=main._FIELD_NAME, value='Cat')])])
+        self.assertEqual(main._search(self.search_index, 'cat')[0], 'Felix')
+
+    def test_search_page(self):
+        """Test paging through the local index with cursors."""
+        length = search.MAXIMUM_DOCUMENTS_RETURNED_PER_SEARCH + 10
+        main._put(self.search_index, [
+            search.Document(doc_id=str(i), fields=[
+                search.TextField(name=main._FIELD_NAME, value='cat')])
+            for i in xrange(0, length)])
+        ids, cursor = main._search_page(self.search_index, 'cat', 3)
+        self.assertEqual(ids, [str(length - 1), str(length - 2),
+                               str(length - 3)])
+        ids, cursor = main._search_page(self.search_index, 'cat', 3, cursor)
+        self.assertEqual(ids, [str(length - 4), str(length - 5),
+                               str(length - 6)])
+        self.assertEqual(
+            sorted(main._iter_search(self.search_index, 'cat')),
+            sorted(str(i) for i in xrange(0, length)))
+
+    def test_search_fields(self):
+        """Test returning the text and snippets of the local index."""
+        main._put(self.search_index, [
+            main._make_document(k, v) for k, v in DATA.items()])
+        documents, _ = main._search_page(
+            self.search_index, 'lasagna', 10, fields='text')
+        self.assertEqual([document.doc_id for document in documents],
+                         ['Garfield'])
+        self.assertEqual(main._document_text(documents[0]), DATA['Garfield'])
+        self.assertEqual(documents[0].expressions, [])
+        documents, _ = main._search_page(
+            self.search_index, 'lasagna', 10, fields='snippet')
+        self.assertEqual(
+            documents[0].expressions[0].value,
+            u'Loves <b>lasagna</b>. Hates Mondays.')
+
+        text = u'a<b> ' * 50 + u'happy Cat ' + u'z' * 200
+        snippet = main._snippet(text, set([u'cat', u'happy']))
+        self.assertTrue(snippet.startswith(u'...'))
+        self.assertTrue(snippet.endswith(u'...'))
+        self.assertIn(u'a&lt;b&gt; <b>happy</b> <b>Cat</b> zzz', snippet)
+        self.assertEqual(main._snippet(u'no match', set([u'cat'])),
+                         u'no match')
+
+class ShardedIndexTest(BaseTestCase):
+    def setUp(self):
+        super(ShardedIndexTest, self).setUp()
+
+        self.search_index = main._ShardedIndex('TestIndex', 3)
+        """main._ShardedIndex object to use in the tests."""
+
+    def put_data(self):
+        """Put the test data in self.search_index."""
+        main._put(self.search_index, [
+            main._make_document(k, v) for k, v in DATA.items()])
+
+    def shard_ids(self, shards):
+        """Return the document identifiers in each of shards shards."""
+        return [
+            sorted(document.doc_id for document in search.Index(
+                name=name).get_range(ids_only=True))
+            for name in main._shard_names('TestIndex', shards)]
+
+    def test_shard_names(self):
+        """Test the names of the shard indexes."""
+        self.assertEqual(main._shard_names('TestIndex', 1), ['TestIndex'])
+        self.assertEqual(main._shard_names('TestIndex', 2),
+                         ['TestIndex-shard-0-of-2', 'TestIndex-shard-1-of-2'])
+
+    def test_fan_out_errors(self):
+        """Test raising the per-document results of every shard."""
+        ok = search.PutResult(code=search.OperationResult.OK, id='a')
+        failed = search.PutResult(
+            code=search.OperationResult.TRANSIENT_ERROR, id='b')
+
+        class ResultFuture(object):
+            def get_result(self):
+                return [ok]
+        future = main._FanOutFuture([ResultFuture(), FakeFuture(
+            search.PutError('Unable to put documents.', [failed]))])
+        with self.assertRaises(search.PutError) as context:
+            future.get_result()
+        self.assertEqual(context.exception.results, [ok, failed])
+        future = main._FanOutFuture([ResultFuture(), FakeFuture(
+            apiproxy_errors.DeadlineExceededError())])
+        self.assertRaises(apiproxy_errors.DeadlineExceededError,
+                          future.get_result)
+
+    def test_put_delete(self):
+        """Test documents are put in and deleted from their shard."""
+        self.put_data()
+        shard_ids = self.shard_ids(3)
+        self.assertEqual(sorted(sum(shard_ids, [])), sorted(DATA))
+        for i, ids in enumerate(shard_ids):
+            for doc_id in ids:
+                self.assertEqual(main._shard_of(doc_id, 3), i)
+        self.assertEqual(
+            [document.doc_id for document in self.search_index.get_range(
+                ids_only=True)], sorted(DATA))
+
+        main._delete(self.search_index, ['Doraemon', 'Garfield'])
+        self.assertEqual(sorted(sum(self.shard_ids(3), [])),
+                         ['Heathcliff', 'Hello_Kitty', 'Top_Cat'])
+
+    def test_search(self):
+        """Test searching every shard and paging with cursors."""
+        self.put_data()
+        self.assertEqual(sorted(main._search(self.search_index, 'cat')),
+                         ['Doraemon', 'Heathcliff'])
+        results, errors = main._search_many(self.search_index, ['cat', '('])
+        self.assertEqual(sorted(results['cat']), ['Doraemon', 'Heathcliff'])
+        self.assertEqual(errors, {'(': 'QueryError'})
+
+        ids = [str(i) for i in xrange(0, 10)]
+        main._put(self.search_index, [
+            main._make_document(doc_id, 'cat') for doc_id in ids])
+        seen = []
+        page, cursor = main._search_page(self.search_index, 'cat', 3)
+        seen.extend(page)
+        while cursor is not None:
+            self.assertEqual(len(page), 3)
+            page, cursor = main._search_page(self.search_index, 'cat', 3,
+                                             cursor)
+            seen.extend(page)
+        self.assertEqual(sorted(seen),
+                         sorted(ids + ['Doraemon', 'Heathcliff']))
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(sorted(main._iter_search(self.search_index, 'cat')),
+                         sorted(seen))
+        with self.assertRaises(ValueError):
+            main._search_page(self.search_index, 'cat', 3, 'False:invalid')
+
+    def test_local_backend(self):
+        """Test sharding the local in-memory backend."""
+        self.addCleanup(setattr, main, '_BACKEND', main._BACKEND)
+        self.addCleanup(main._local_indexes.clear)
+        main._BACKEND = 'local'
+        self.search_index = main._ShardedIndex('TestIndex', 2)
+        self.put_data()
+        self.assertEqual(sum(len(main._local_indexes[name])
+                             for name in main._shard_names('TestIndex', 2)),
+                         len(DATA))
+        self.assertEqual(
+            sorted(main._iter_search(self.search_index, 'cat')),
+            ['Doraemon', 'Heathcliff'])
+
+    def test_reshard(self):
+        """Test moving documents to another number of shards."""
+        self.put_data()
+        # Documents stay searchable while they are moved
+        self.search_index = main._ShardedIndex('TestIndex', 2, 3)
+        moved, failed, cursor = main._reshard('TestIndex', 3, 2, limit=3)
+        self.assertEqual((moved, failed), (3, 0))
+        self.assertEqual(cursor, sorted(DATA)[2])
+        self.assertEqual(sorted(main._search(self.search_index, 'cat')),
+                         ['Doraemon', 'Heathcliff'])
+        # Putting and deleting during the move leaves no stale copies
+        main._put(self.search_index, [main._make_document('Top_Cat', 'Cat')])
+        main._delete(self.search_index, ['Doraemon'])
+
+        moved, failed, cursor = main._reshard('TestIndex', 3, 2, cursor,
+                                              limit=3)
+        self.assertEqual(moved, 1)
+        moved, failed, cursor = main._reshard('TestIndex', 3, 2, cursor,
+                                              limit=3)
+        self.assertEqual((moved, failed, cursor), (0, 0, None))
+        self.assertEqual(sum(self.shard_ids(3), []), [])
+        self.assertEqual(sorted(sum(self.shard_ids(2), [])),
+                         ['Garfield', 'Heathcliff', 'Hello_Kitty', 'Top_Cat'])
+        self.assertEqual(
+            sorted(main._search(main._ShardedIndex('TestIndex', 2), 'cat')),
+            ['Heathcliff', 'Top_Cat'])
+
+    def test_reshard_failure(self):
+        """Test keeping the documents that failed to move in their shard."""
+        self.put_data()
+        put = main._put
+        def put_but_garfield(search_index, documents, callback=None):
+            return put(search_index, [document for document in documents
+                                      if document.doc_id != 'Garfield'],
+                       callback)
+        main._put = put_but_garfield
+        try:
+            moved, failed, cursor = main._reshard('TestIndex', 3, 2, limit=3)
+        finally:
+            main._put = put
+        # The checkpoint is before the document that failed
+        self.assertEqual((moved, failed, cursor), (2, 1, 'Doraemon'))
+        self.assertEqual(sorted(sum(self.shard_ids(3), [])),
+                         ['Garfield', 'Hello_Kitty', 'Top_Cat'])
+
+        moved, failed, cursor = main._reshard('TestIndex', 3, 2, cursor)
+        self.assertEqual((moved, failed, cursor), (3, 0, 'Top_Cat'))
+        self.assertEqual(main._reshard('TestIndex', 3, 2, cursor),
+                         (0, 0, None))
+        self.assertEqual(sorted(sum(self.shard_ids(2), [])), sorted(DATA))
+
+    def test_reshard_delete_failure(self):
+        """Test not moving past the documents that failed to be deleted."""
+        self.put_data()
+        dispatch = main._dispatch
+        def dispatch_but_heathcliff(operation, call, items, *args):
+            if operation == 'delete':
+                items = [item for item in items if item != 'Heathcliff']
+            return dispatch(operation, call, items, *args)
+        main._dispatch = dispatch_but_heathcliff
+        try:
+            moved, failed, cursor = main._reshard('TestIndex', 3, 2)
+        finally:
+            main._dispatch = dispatch
+        # The checkpoint is before the document that is still in its shard
+        self.assertEqual((moved, failed, cursor), (4, 1, 'Garfield'))
+        self.assertEqual(sum(self.shard_ids(3), []), ['Heathcliff'])
+
+        moved, failed, cursor = main._reshard('TestIndex', 3, 2, cursor)
+        self.assertEqual((moved, failed, cursor), (1, 0, 'Heathcliff'))
+        self.assertEqual(main._reshard('TestIndex', 3, 2, cursor),
+                         (0, 0, None))
+        self.assertEqual(sorted(sum(self.shard_ids(2), [])), sorted(DATA))
+
 class WSGITest(BaseTestCase):
     def setUp(self):
         super(WSGITest, self).setUp()
@@ -230,6 +1455,182 @@ class WSGITest(BaseTestCase):
             self.assertEqual(response.status_int, 401)
             response = self.app.put(self.url, status=401)
             self.assertEqual(response.status_int, 401)
+            response = self.app.get('/budget', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.post('/search', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.get('/metrics', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.get('/jobs/foobar', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.post('/reshard', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.get('/export', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.post('/reindex', status=401)
+            self.assertEqual(response.status_int, 401)
+            response = self.app.get('/suggest', status=401)
+            self.assertEqual(response.status_int, 401)
+
+    def test_tenants(self):
+        """Test serving several tenants from their own indexes."""
+        self.addCleanup(main._tenants.clear)
+        self.addCleanup(setattr, main, '_TENANTS', main._TENANTS)
+        main._TENANTS = json.dumps({
+            'alice': {'password': 'secret'},
+            'bob': {'password': 'hunter2', 'index': 'BobIndex',
+                    'limit': 10}})
+        main._tenants.clear()
+        self.app.get(self.url, params={'q': 'cat'}, status=401)
+        self.app.authorization = ('Basic', ('alice', 'hunter2'))
+        self.app.get(self.url, params={'q': 'cat'}, status=401)
+
+        self.app.authorization = ('Basic', ('alice', 'secret'))
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {}, 'skipped': 0, 'written': len(DATA)})
+        self.assertIs(main._tenants.for_index('alice').index,
+                      main._tenants.for_index('alice').index)
+        response = self.app.post_json('/reindex', {'to': 'BobIndex'},
+                                      status=403)
+        self.assertEqual(response.status_int, 403)
+
+        self.app.authorization = ('Basic', ('bob', 'hunter2'))
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(response.json, [])
+        response = self.app.get('/budget')
+        self.assertEqual(response.json['limit'], 10)
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {}, 'skipped': 0, 'written': len(DATA)})
+        response = self.app.get('/budget')
+        self.assertEqual(response.json['used'], len(DATA))
+        # Every tenant draws from the budget of the instance as well
+        self.assertEqual(main._write_budget.usage()['used'], 2 * len(DATA))
+        self.assertEqual(
+            len(search.Index(name='BobIndex').get_range(ids_only=True)),
+            len(DATA))
+        # Puts larger than the budget are deferred rather than rejected
+        timeout = main._BUDGET_TIMEOUT
+        main._BUDGET_TIMEOUT = 0
+        try:
+            response = self.app.put_json(self.url, dict(
+                ('Cat{0}'.format(i), 'cat') for i in xrange(0, 20)),
+                                         status=503)
+        finally:
+            main._BUDGET_TIMEOUT = timeout
+        self.assertEqual(response.json['deferred'], sorted(
+            'Cat{0}'.format(i) for i in xrange(0, 20)))
+        self.assertEqual(response.json['written'], 0)
+
+        response = self.app.get('/metrics')
+        lines = response.body.splitlines()
+        for line in [
+            'recap_tenant_documents_total{operation="put",tenant="bob"} 5',
+            'recap_write_budget_limit 10']:
+            self.assertIn(line, lines)
+        self.assertFalse([line for line in lines if 'alice' in line])
+
+        for config in ['[]', '{"alice": "secret"}', '{"alice": {}}',
+                       '{"alice": {"password": "secret", "index": "!a"}}',
+                       '{"alice": {"password": "secret", "limit": 0}}',
+                       '{"alice": {"password": "a"}, '
+                       '"bob": {"password": "b", "index": "alice"}}']:
+            self.assertRaises(ValueError, main._parse_tenants, config)
+        # Nobody can authenticate with an invalid configuration
+        main._TENANTS = '{"bob": {"password": "hunter2", "limit": 0}}'
+        main._tenants.clear()
+        self.app.get(self.url, params={'q': 'cat'}, status=401)
+
+    def test_warmup(self):
+        """Test warming up an instance and reporting its startup cost."""
+        self.addCleanup(setattr, main, '_startup', main._startup)
+        self.addCleanup(setattr, main, '_WARMUP_QUERIES',
+                        main._WARMUP_QUERIES)
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        main._search_cache.clear()
+
+        main._startup = main._Startup()
+        main._WARMUP_QUERIES = '["cat", "lasagna"]'
+        self.app.authorization = None
+        response = self.app.get('/_ah/warmup')
+        self.assertEqual(response.status_int, 200)
+        self.assertGreater(response.json['imports'], 0)
+        self.assertIsNone(response.json['first_request'])
+        self.assertEqual(sorted(response.json['warmup']),
+                         ['indexes', 'queries', 'validators'])
+        # Warming up again returns the report of the first warmup
+        self.assertEqual(self.app.get('/_ah/warmup').json['warmup'],
+                         response.json['warmup'])
+
+        self.app.authorization = ('Basic', (main._USERNAME, main._PASSWORD))
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(response.json, ['Doraemon', 'Heathcliff'])
+        self.assertEqual(main._search_cache.hits, 1)
+        self.assertEqual(main._search_cache.misses, 2)
+        lines = self.app.get('/metrics').body.splitlines()
+        self.assertIn('# TYPE recap_startup_first_request_seconds gauge',
+                      lines)
+        self.assertGreater(main._startup.report()['first_request'], 0)
+
+        main._startup = main._Startup()
+        for queries in [None, '"cat"', '[1]']:
+            main._WARMUP_QUERIES = queries
+            self.assertEqual(main._warmup().keys(),
+                             ['validators', 'indexes', 'connect'])
+
+    def test_profile(self):
+        """Test profiling requests and downloading their profiles."""
+        self.addCleanup(setattr, main, '_PROFILE_RATE', main._PROFILE_RATE)
+        response = self.app.get('/profiles')
+        self.assertEqual(response.json, {'profiles': []})
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.app.authorization = None
+        response = self.app.get(self.url, params={'q': 'cat'},
+                                headers={'X-Profile': '1'}, status=401)
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+        self.app.authorization = ('Basic', (main._USERNAME, main._PASSWORD))
+        response = self.app.get(self.url, params={'q': 'cat'},
+                                headers={'X-Profile': '1'})
+        self.assertEqual(response.status_int, 200)
+        profile_id = response.headers['X-Profile-Id']
+        profiles = self.app.get('/profiles').json['profiles']
+        self.assertEqual([profile['id'] for profile in profiles],
+                         [profile_id])
+        self.assertEqual(profiles[0]['endpoint'], 'GET')
+        self.assertEqual(profiles[0]['path'], '/')
+
+        url = '/profiles/{0}'.format(profile_id)
+        response = self.app.get(url)
+        self.assertEqual(response.content_type, 'application/octet-stream')
+        self.assertIn('{0}.pstats'.format(profile_id),
+                      response.headers['Content-Disposition'])
+        handle, filename = tempfile.mkstemp()
+        self.addCleanup(os.remove, filename)
+        os.write(handle, response.body)
+        os.close(handle)
+        self.assertIn('get_view', [function[2] for function in
+                                   pstats.Stats(filename).stats])
+        self.assertEqual(marshal.loads(response.body),
+                         main._profiles.stats(main._USERNAME, profile_id))
+        response = self.app.get(url, params={'format': 'collapsed'})
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertIn('get_view', response.body)
+        for line in response.body.splitlines():
+            self.assertTrue(line.rsplit(' ', 1)[1].isdigit())
+        response = self.app.get(url, params={'format': 'foobar'}, status=400)
+        self.assertEqual(response.status_int, 400)
+        response = self.app.get('/profiles/foobar', status=404)
+        self.assertEqual(response.status_int, 404)
+
+        # Every authenticated request is profiled at a sample rate of 1
+        main._PROFILE_RATE = 1
+        response = self.app.get(self.url, params={'q': 'dog'})
+        self.assertIn('X-Profile-Id', response.headers)
+        self.assertEqual(len(self.app.get('/profiles').json['profiles']), 2)
 
     def test_empty(self):
         """Test empty input."""
@@ -268,14 +1669,22 @@ class WSGITest(BaseTestCase):
         response = self.app.post_json(self.url, dict([
             ('!' + k, v) for k, v in DATA.items()]))
         self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['rejected'], {'reserved_id': 5})
         self.assertSearchIndexSize(0)
         response = self.app.post_json(self.url, dict([
             (u'{0}_c\u00e4t'.format(k), v) for k, v in DATA.items()]))
         self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['rejected'], {'non_ascii_id': 5})
         self.assertSearchIndexSize(0)
         response = self.app.put_json(self.url, dict([
             ('__' + k + '__', v) for k, v in DATA.items()]))
         self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['rejected'], {'reserved_id': 5})
+        self.assertSearchIndexSize(0)
+        response = self.app.put_json(self.url, {
+            'a b': 'c', 'i' * 501: 'c', 'Garfield': '', 'Nermal': 42})
+        self.assertEqual(response.json['rejected'], {
+            'id_too_long': 1, 'invalid_text': 2, 'invisible_character': 1})
         self.assertSearchIndexSize(0)
 
         response = self.app.post_json(self.url, DATA)
@@ -288,9 +1697,12 @@ class WSGITest(BaseTestCase):
             response = self.app.delete_json(self.url, value)
             self.assertEqual(response.status_int, 200)
             self.assertSearchIndexSize(len(DATA))
-
+        response = self.app.delete_json(self.url, [42, None, '', 'a b'])
+        self.assertEqual(response.json['rejected'], {
+            'empty_id': 1, 'invalid_id_type': 2, 'invisible_character': 1})
         response = self.app.delete_json(self.url, DATA.keys()[:2])
-        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json, {
+            'deleted': 2, 'failed': [], 'rejected': {}})
         self.assertSearchIndexSize(len(DATA) - 2)
         response = self.app.put_json(self.url, DATA)
         self.assertEqual(response.status_int, 200)
@@ -299,6 +1711,234 @@ class WSGITest(BaseTestCase):
         self.assertEqual(response.status_int, 200)
         self.assertSearchIndexSize(0)
 
+    def test_delete_written_elsewhere(self):
+        """Test deleting documents this instance never put."""
+        response = self.app.put_json(self.url, {'a': 'cat'})
+        self.assertEqual(response.status_int, 200)
+        response = self.app.delete_json(self.url, ['zzz'])
+        self.assertEqual(response.status_int, 200)
+        # Another instance puts a document in the same index
+        self.search_index.put(main._make_document('b', u'dog'))
+        response = self.app.delete_json(self.url, ['b'])
+        self.assertEqual(response.json['deleted'], 1)
+        self.assertEqual(
+            [document.doc_id
+             for document in self.search_index.get_range(ids_only=True)],
+            ['a'])
+
+    def test_add_ndjson(self):
+        """Test adding newline delimited JSON to the search index."""
+        body = '\n'.join(
+            [json.dumps({'id': k, 'text': v}) for k, v in DATA.items()] +
+            [json.dumps({'id': '!' + k, 'text': v}) for k, v in DATA.items()])
+        response = self.app.put(self.url, body,
+                                content_type='application/x-ndjson')
+        self.assertEqual(response.status_int, 200)
+        self.assertSearchIndexSize(len(DATA))
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(response.json, ['Doraemon', 'Heathcliff'])
+        response = self.app.delete_json(self.url, DATA.keys())
+        self.assertSearchIndexSize(0)
+
+        limit = main._SAFETY_LIMIT
+        main._SAFETY_LIMIT = len(DATA) - 1
+        try:
+            response = self.app.post(self.url, body, status=413,
+                                     content_type='application/x-ndjson')
+            self.assertEqual(response.status_int, 413)
+            self.assertEqual(response.json['error']['code'], 413)
+            # The documents up to the safety limit were put all the same
+            self.assertEqual(response.json['written'], len(DATA) - 1)
+            self.assertEqual(response.json['failed'], [])
+        finally:
+            main._SAFETY_LIMIT = limit
+        self.assertSearchIndexSize(len(DATA) - 1)
+
+    def test_skip_unchanged(self):
+        """Test skipping documents that did not change."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {}, 'skipped': 0, 'written': len(DATA)})
+        self.assertSearchIndexSize(len(DATA))
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {}, 'skipped': len(DATA), 'written': 0})
+        response = self.app.put_json(self.url + '?force=1', DATA)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {}, 'skipped': 0, 'written': len(DATA)})
+
+        data = dict(DATA)
+        data['Garfield'] = 'Loves lasagna. Hates Mondays and Nermal.'
+        response = self.app.put(self.url, '\n'.join([
+            json.dumps({'id': k, 'text': v}) for k, v in data.items()]),
+                                content_type='application/x-ndjson')
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {},
+            'skipped': len(DATA) - 1, 'written': 1})
+        response = self.app.get(self.url, params={'q': 'Nermal'})
+        self.assertEqual(response.json, ['Garfield'])
+
+        # Deleted documents are put again
+        response = self.app.delete_json(self.url, ['Doraemon'])
+        self.assertSearchIndexSize(len(DATA) - 1)
+        response = self.app.put_json(self.url, data)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {},
+            'skipped': len(DATA) - 1, 'written': 1})
+        self.assertSearchIndexSize(len(DATA))
+
+        # Documents put with other content by another instance are put again
+        document = main._make_document('Garfield', u'Lasagna')
+        self.search_index.put(document)
+        main._DigestStore().update(self.search_index.name, [document])
+        response = self.app.put_json(self.url, data)
+        self.assertEqual(response.json, {
+            'failed': [], 'rejected': {},
+            'skipped': len(DATA) - 1, 'written': 1})
+        response = self.app.get(self.url, params={'q': 'Nermal'})
+        self.assertEqual(response.json, ['Garfield'])
+
+        # Unchanged documents do not count against the safety limit
+        limit = main._SAFETY_LIMIT
+        main._SAFETY_LIMIT = 1
+        try:
+            data['Top_Cat'] = 'Fancy. Lives in a trash can.'
+            response = self.app.put_json(self.url, data)
+            self.assertEqual(response.json, {
+                'failed': [], 'rejected': {},
+                'skipped': len(DATA) - 1, 'written': 1})
+            data['Top_Cat'] = 'Fancy. Lives in an alley again.'
+            response = self.app.put(self.url, '\n'.join([
+                json.dumps({'id': k, 'text': v}) for k, v in data.items()]),
+                                    content_type='application/x-ndjson')
+            self.assertEqual(response.json, {
+                'failed': [], 'rejected': {},
+                'skipped': len(DATA) - 1, 'written': 1})
+            data['Doraemon'] = 'Robotic cat from the past.'
+            data['Top_Cat'] = 'Fancy. Lives in a trash can.'
+            response = self.app.put(self.url, '\n'.join([
+                json.dumps({'id': k, 'text': v}) for k, v in data.items()]),
+                                    content_type='application/x-ndjson',
+                                    status=413)
+            self.assertEqual(response.json['written'], 1)
+        finally:
+            main._SAFETY_LIMIT = limit
+
+    def test_local_backend(self):
+        """Test serving requests from the local search backend."""
+        backend = main._BACKEND
+        main._BACKEND = 'local'
+        try:
+            response = self.app.put_json(self.url, DATA)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(len(main._get_index(main._USERNAME)), len(DATA))
+            response = self.app.get(self.url, params={'q': 'cat'})
+            self.assertEqual(sorted(response.json),
+                             ['Doraemon', 'Heathcliff'])
+            response = self.app.delete_json(self.url, ['Doraemon'])
+            response = self.app.get(self.url, params={'q': 'cat'})
+            self.assertEqual(response.json, ['Heathcliff'])
+        finally:
+            main._BACKEND = backend
+            main._local_indexes.clear()
+        # Nothing was put in the Search API index
+        self.assertSearchIndexSize(0)
+
+    def test_partial_failure(self):
+        """Test reporting the documents that failed to be put or deleted."""
+        class RejectingIndex(main._LocalIndex):
+            def put_async(self, documents):
+                accepted = [document for document in documents
+                            if document.doc_id != 'Garfield']
+                super(RejectingIndex, self).put_async(accepted)
+                results = [search.PutResult(
+                    code=search.OperationResult.OK, id=document.doc_id)
+                           for document in accepted]
+                results.append(search.PutResult(
+                    code=search.OperationResult.INVALID_REQUEST,
+                    id='Garfield'))
+                return FakeFuture(search.PutError('Rejected.', results))
+
+        self.addCleanup(setattr, main, '_BACKEND', main._BACKEND)
+        self.addCleanup(main._local_indexes.clear)
+        main._BACKEND = 'local'
+        main._local_indexes[main._USERNAME] = RejectingIndex(main._USERNAME)
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.json, {
+            'failed': ['Garfield'], 'rejected': {},
+            'skipped': 0, 'written': len(DATA) - 1})
+        self.assertEqual(len(main._local_indexes[main._USERNAME]),
+                         len(DATA) - 1)
+        # Only the failed documents need to be put again
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.json, {
+            'failed': ['Garfield'], 'rejected': {},
+            'skipped': len(DATA) - 1, 'written': 0})
+
+    def test_metrics(self):
+        """Test exporting the metrics and the Server-Timing header."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        stages = [value.split(';')[0] for value in
+                  response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['parse', 'put', 'total'])
+        response = self.app.get(self.url, params={'q': 'cat'})
+        stages = [value.split(';')[0] for value in
+                  response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['search', 'total'])
+        # Concurrent calls count once in the time of their stage
+        with main.app.test_request_context():
+            main._record_timing('put', 10, 11)
+            main._record_timing('put', 12, 13)
+            main._record_timing('put', 10.5, 11.5)
+            self.assertEqual(
+                main._covered_seconds(flask.g.timings['put']), 2.5)
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'text/plain')
+        lines = response.body.splitlines()
+        for line in [
+            'recap_search_api_calls_total{operation="put"} 1',
+            'recap_search_api_calls_total{operation="search"} 1',
+            'recap_documents_total{operation="put"} 5',
+            'recap_requests_total{status="200",view="GET"} 1',
+            'recap_requests_total{status="200",view="PUT"} 1',
+            'recap_request_latency_seconds_count{view="GET"} 1',
+            'recap_search_cache_misses 1',
+            'recap_write_budget_used 5']:
+            self.assertIn(line, lines)
+
+    def test_async(self):
+        """Test accepting writes asynchronously."""
+        response = self.app.put_json(self.url + '?async=1', DATA)
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(response.json['queued'], len(DATA))
+        self.assertEqual(response.json['skipped'], 0)
+        self.assertSearchIndexSize(0)
+        put_url = response.headers['Location']
+        response = self.app.get(put_url)
+        self.assertEqual(response.json['state'], 'pending')
+        self.assertEqual(response.json['pending'], len(DATA))
+
+        response = self.app.delete_json(self.url + '?async=1', ['Doraemon'])
+        self.assertEqual(response.status_int, 202)
+        delete_url = response.headers['Location']
+        self.assertGreater(self.run_tasks(), 0)
+        self.assertSearchIndexSize(len(DATA) - 1)
+        response = self.app.get(put_url)
+        self.assertEqual(response.json['state'], 'done')
+        self.assertEqual(response.json['written'], len(DATA) - 1)
+        self.assertEqual(response.json['superseded'], 1)
+        response = self.app.get(delete_url)
+        self.assertEqual(response.json['written'], 1)
+
+        response = self.app.get('/jobs/foobar', status=404)
+        self.assertEqual(response.status_int, 404)
+        response = self.app.delete_json(self.url + '?async=1', [
+            str(i) for i in xrange(0, main._SAFETY_LIMIT + 1)], status=413)
+        self.assertEqual(response.status_int, 413)
+
     def test_safety_limit(self):
         """Test exceeding the safety limit."""
         response = self.app.delete_json(self.url, [
@@ -316,6 +1956,376 @@ class WSGITest(BaseTestCase):
         self.assertEqual(response.status_int, 413)
         self.assertSearchIndexSize(0)
 
+    def test_search_many(self):
+        """Test searching for many queries in one request."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+
+        for value in [None, {}, 'cat']:
+            response = self.app.post_json('/search', value)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.json, {'errors': {}, 'results': {}})
+        response = self.app.post_json('/search', ['cat', 'fancy', '('])
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json, {
+            'errors': {'(': 'QueryError'},
+            'results': {'cat': ['Doraemon', 'Heathcliff'],
+                        'fancy': ['Top_Cat']}})
+        response = self.app.post_json(
+            '/search', ['cat'] * (main._MAX_QUERIES + 1), status=413)
+        self.assertEqual(response.status_int, 413)
+
+    def test_search_page(self):
+        """Test paging through search results."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+
+        for value in [{'limit': 'foobar'}, {'limit': 0},
+                      {'q': 'cat', 'cursor': 'foobar'}]:
+            response = self.app.get(self.url, params=value, status=400)
+            self.assertEqual(response.status_int, 400)
+        response = self.app.get(self.url, params={'limit': 1})
+        self.assertEqual(response.json, {'cursor': None, 'ids': []})
+
+        ids = []
+        params = {'q': 'cat', 'limit': 1, 'cursor': ''}
+        while True:
+            response = self.app.get(self.url, params=params)
+            self.assertEqual(response.status_int, 200)
+            self.assertLessEqual(len(response.json['ids']), 1)
+            ids.extend(response.json['ids'])
+            if response.json['cursor'] is None:
+                break
+            params['cursor'] = response.json['cursor']
+        self.assertEqual(ids, ['Doraemon', 'Heathcliff'])
+
+        response = self.app.get(self.url, params={'q': 'cat', 'cursor': ''})
+        self.assertEqual(response.json, {
+            'cursor': None, 'ids': ['Doraemon', 'Heathcliff']})
+
+    def test_search_stream(self):
+        """Test streaming every search result."""
+        response = self.app.get(self.url, params={'stream': 1})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json, [])
+        response = self.app.get(self.url, params={'q': 'cat', 'stream': 1})
+        self.assertEqual(response.json, [])
+
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        for value, expected in [
+            ('cat', ['Doraemon', 'Heathcliff']),
+            ('fancy', ['Top_Cat']),
+            ('foobar', [])]:
+            response = self.app.get(self.url,
+                                    params={'q': value, 'stream': 1})
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.content_type, 'application/json')
+            self.assertEqual(response.json, expected)
+
+    def test_search_fields(self):
+        """Test returning the text or snippets of the search results."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+
+        for value in [{'fields': 'foobar'}, {'fields': 'text', 'size': -1},
+                      {'fields': 'text', 'length': 'foobar'},
+                      {'fields': 'text', 'stream': 1}]:
+            response = self.app.get(self.url, params=value, status=400)
+            self.assertEqual(response.status_int, 400)
+        response = self.app.get(self.url, params={'fields': 'text'})
+        self.assertEqual(response.json, [])
+
+        response = self.app.get(self.url, params={
+            'q': 'lasagna', 'fields': 'text'})
+        self.assertEqual(response.json, [{
+            'id': 'Garfield', 'text': DATA['Garfield'], 'truncated': False}])
+        response = self.app.get(self.url, params={
+            'q': 'cat', 'fields': 'text', 'length': 5})
+        self.assertEqual(sorted(response.json), [
+            {'id': 'Doraemon', 'text': 'Robot', 'truncated': True},
+            {'id': 'Heathcliff', 'text': 'What ', 'truncated': True}])
+        response = self.app.get(self.url, params={
+            'q': 'cat', 'fields': 'text', 'size': 30})
+        self.assertEqual([len(document['text']) for document in response.json],
+                         [28, 2])
+        self.assertEqual([document['truncated'] for document in response.json],
+                         [False, True])
+
+        response = self.app.get(self.url, params={
+            'q': 'cat', 'fields': 'snippet', 'limit': 1})
+        self.assertEqual(len(response.json['documents']), 1)
+        self.assertIn('<b>cat</b>', response.json['documents'][0]['snippet'])
+        self.assertFalse(response.json['documents'][0]['truncated'])
+        self.assertIsNotNone(response.json['cursor'])
+        response = self.app.get(self.url, params={
+            'q': 'cat', 'fields': 'snippet', 'size': 0})
+        self.assertEqual(
+            [document['snippet'] for document in response.json], [None, None])
+
+        # The identifiers only result is still cached on its own
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(sorted(response.json), ['Doraemon', 'Heathcliff'])
+
+    def test_reshard(self):
+        """Test moving the documents to another number of shards."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        self.addCleanup(setattr, main, '_SHARDS', main._SHARDS)
+        self.addCleanup(setattr, main, '_PREVIOUS_SHARDS',
+                        main._PREVIOUS_SHARDS)
+        main._SHARDS = 2
+        main._PREVIOUS_SHARDS = 1
+        # Only the configured layouts are searched
+        for value in [None, [], {'from': 'foo'}, {'to': 0},
+                      {'cursor': 1}, {'from': 1, 'to': 7},
+                      {'from': 3, 'to': 2}, {'to': 10 ** 9}]:
+            response = self.app.post_json('/reshard', value, status=400)
+            self.assertEqual(response.status_int, 400)
+
+        cursor = None
+        moved = 0
+        while True:
+            response = self.app.post_json(
+                '/reshard', {'from': 1, 'to': 2, 'cursor': cursor})
+            self.assertEqual(response.status_int, 200)
+            moved += response.json['moved']
+            self.assertEqual(response.json['failed'], 0)
+            cursor = response.json['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(moved, len(DATA))
+        self.assertSearchIndexSize(0)
+        self.assertEqual(
+            sorted(main._search(
+                main._ShardedIndex(main._USERNAME, 2), 'cat')),
+            ['Doraemon', 'Heathcliff'])
+
+    def test_circuit_breaker(self):
+        """Test shedding requests while the circuit breakers are open."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(response.json, ['Doraemon', 'Heathcliff'])
+
+        for _ in xrange(0, main._BREAKER_THRESHOLD):
+            main._breakers['search'].record(
+                apiproxy_errors.OverQuotaError())
+        for method, url, params in [
+            (self.app.put_json, self.url, {'Felix': 'Cat'}),
+            (self.app.delete_json, self.url, ['Garfield']),
+            (self.app.get, self.url, {'q': 'lasagna'}),
+            (self.app.get, self.url, {'q': 'cat', 'limit': 1}),
+            (self.app.get, self.url, {'q': 'cat', 'stream': 1})]:
+            response = method(url, params, status=503)
+            self.assertEqual(response.status_int, 503)
+            self.assertEqual(response.json['error']['code'], 503)
+            self.assertGreater(int(response.headers['Retry-After']), 0)
+        # Cached searches are still answered
+        response = self.app.get(self.url, params={'q': 'cat'})
+        self.assertEqual(response.json, ['Doraemon', 'Heathcliff'])
+        response = self.app.get('/metrics')
+        self.assertIn('recap_circuit_breaker_open_search 1', response.body)
+        self.assertIn('recap_circuit_breaker_open_put 0', response.body)
+
+    def test_export(self):
+        """Test streaming the documents as newline delimited JSON."""
+        response = self.app.get('/export')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, '')
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+
+        response = self.app.get('/export')
+        self.assertEqual(response.content_type, main._NDJSON_MIMETYPE)
+        self.assertEqual(
+            [json.loads(line) for line in response.body.splitlines()],
+            [{'id': k} for k in sorted(DATA)])
+        response = self.app.get('/export', params={'cursor': 'Heathcliff'})
+        self.assertEqual([json.loads(line)['id']
+                          for line in response.body.splitlines()],
+                         ['Hello_Kitty', 'Top_Cat'])
+
+        # A failed read aborts the export instead of ending it
+        get_range = search.Index.get_range
+        def failing_get_range(*args, **kwargs):
+            raise apiproxy_errors.DeadlineExceededError()
+        search.Index.get_range = failing_get_range
+        try:
+            self.assertRaises(apiproxy_errors.DeadlineExceededError,
+                              self.app.get, '/export')
+        finally:
+            search.Index.get_range = get_range
+
+        # The export with text can be put back
+        response = self.app.get('/export', params={'text': 1})
+        body = response.body
+        self.assertEqual(
+            dict((entry['id'], entry['text']) for entry in
+                 (json.loads(line) for line in body.splitlines())), DATA)
+        response = self.app.delete_json(self.url, DATA.keys())
+        self.assertEqual(response.status_int, 200)
+        response = self.app.put(self.url, body,
+                                content_type=main._NDJSON_MIMETYPE)
+        self.assertEqual(response.json['written'], len(DATA))
+        self.assertSearchIndexSize(len(DATA))
+
+    def test_reindex(self):
+        """Test copying the documents to another index."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        for value in [None, [], {}, {'to': 1}, {'to': main._USERNAME},
+                      {'to': '!foo'}, {'to': 'OtherIndex', 'limit': 0},
+                      {'to': 'OtherIndex', 'cursor': 1}]:
+            response = self.app.post_json('/reindex', value, status=400)
+            self.assertEqual(response.status_int, 400)
+
+        cursor = None
+        copied = 0
+        while True:
+            response = self.app.post_json('/reindex', {
+                'cursor': cursor, 'limit': 2, 'to': 'OtherIndex'})
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.json['failed'], 0)
+            copied += response.json['copied']
+            cursor = response.json['cursor']
+            if cursor is None:
+                break
+        self.assertEqual(copied, len(DATA))
+        self.assertEqual(
+            sorted(main._search(search.Index(name='OtherIndex'), 'cat')),
+            ['Doraemon', 'Heathcliff'])
+
+        get_range = search.Index.get_range
+        def failing_get_range(self, **kwargs):
+            raise search.InternalError()
+        search.Index.get_range = failing_get_range
+        try:
+            response = self.app.post_json('/reindex', {'to': 'OtherIndex'},
+                                          status=503)
+        finally:
+            search.Index.get_range = get_range
+        self.assertEqual(response.status_int, 503)
+
+    def test_get_conditional(self):
+        """Test conditional and compressed search responses."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        for params in [{'q': 'cat'}, {'q': 'cat', 'limit': 1}]:
+            response = self.app.get(self.url, params=params)
+            self.assertEqual(response.status_int, 200)
+            etag = response.headers['ETag']
+            self.assertIsNone(response.headers.get('Content-Encoding'))
+            response = self.app.get(self.url, params=params,
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_int, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(response.body, '')
+            response = self.app.get(self.url, params=params,
+                                    headers={'If-None-Match': '"foobar"'})
+            self.assertEqual(response.status_int, 200)
+
+        # Writes change the ETag even if the result is the same
+        response = self.app.delete_json(self.url, ['Garfield'])
+        self.assertEqual(response.status_int, 200)
+        response = self.app.get(self.url, params={'q': 'cat'},
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        self.addCleanup(setattr, main, '_COMPRESS_THRESHOLD',
+                        main._COMPRESS_THRESHOLD)
+        main._COMPRESS_THRESHOLD = 0
+        # webtest decodes compressed bodies so use the Flask test client
+        client = main.app.test_client()
+        authorization = 'Basic ' + base64.b64encode(
+            '{0}:{1}'.format(main._USERNAME, main._PASSWORD))
+        for encoding, wbits in [('gzip', 16 + zlib.MAX_WBITS),
+                                ('deflate', zlib.MAX_WBITS)]:
+            headers = {'Accept-Encoding': encoding,
+                       'Authorization': authorization}
+            response = client.get(self.url, query_string={'q': 'cat'},
+                                  headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], encoding)
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            self.assertEqual(
+                json.loads(zlib.decompress(response.get_data(), wbits)),
+                ['Doraemon', 'Heathcliff'])
+            headers['If-None-Match'] = response.headers['ETag']
+            response = client.get(self.url, query_string={'q': 'cat'},
+                                  headers=headers)
+            self.assertEqual(response.status_code, 304)
+        response = client.get(self.url, query_string={'q': 'cat'},
+                              headers={'Accept-Encoding': 'gzip;q=0',
+                                       'Authorization': authorization})
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+
+    def test_suggest(self):
+        """Test suggesting documents as the query is typed."""
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        for params, expected in [
+            ({}, []),
+            ({'q': ''}, []),
+            ({'q': 'ca'}, ['Doraemon', 'Heathcliff']),
+            ({'q': 'ca', 'limit': 1}, 1),
+            ({'q': 'fancy al'}, ['Top_Cat']),
+            ({'q': 'foobar'}, [])]:
+            response = self.app.get('/suggest', params=params)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.content_type, 'application/json')
+            if isinstance(expected, int):
+                self.assertEqual(len(response.json), expected)
+            else:
+                self.assertEqual(sorted(response.json), expected)
+        for value in ['foo', 0, main._MAX_SUGGEST_LIMIT + 1]:
+            response = self.app.get('/suggest', params={'q': 'ca',
+                                                        'limit': value},
+                                    status=400)
+            self.assertEqual(response.status_int, 400)
+
+        response = self.app.delete_json(self.url, ['Doraemon'])
+        self.assertEqual(response.status_int, 200)
+        response = self.app.get('/suggest', params={'q': 'ca'})
+        self.assertEqual(response.json, ['Heathcliff'])
+
+    def test_write_budget(self):
+        """Test the write budget shared by all requests."""
+        response = self.app.get('/budget')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json['used'], 0)
+        self.assertEqual(response.json['remaining'], main._SAFETY_LIMIT)
+
+        response = self.app.put_json(self.url, DATA)
+        self.assertEqual(response.status_int, 200)
+        response = self.app.delete_json(self.url, DATA.keys()[:2])
+        self.assertEqual(response.status_int, 200)
+        response = self.app.get('/budget')
+        self.assertEqual(response.json['used'], len(DATA) + 2)
+
+        timeout = main._BUDGET_TIMEOUT
+        main._BUDGET_TIMEOUT = 0
+        try:
+            main._write_budget.acquire(response.json['remaining'])
+            response = self.app.put_json(self.url + '?force=1', DATA,
+                                         status=503)
+            self.assertEqual(response.status_int, 503)
+            self.assertGreater(int(response.headers['Retry-After']), 0)
+            self.assertEqual(response.json['error']['code'], 503)
+            # The response tells which documents need to be put again
+            self.assertEqual(response.json['deferred'], sorted(DATA))
+            self.assertEqual(response.json['written'], 0)
+            self.assertEqual(response.json['failed'], [])
+            response = self.app.delete_json(self.url, DATA.keys(), status=503)
+            self.assertEqual(response.status_int, 503)
+            self.assertIn('Retry-After', response.headers)
+            self.assertEqual(response.json['deferred'], sorted(DATA))
+            self.assertEqual(response.json['deleted'], 0)
+        finally:
+            main._BUDGET_TIMEOUT = timeout
+        self.assertSearchIndexSize(len(DATA) - 2)
+
     def test_search(self):
         """Test searching documents in the search index."""
         response = self.app.put_json(self.url, DATA)